@@ -5,17 +5,19 @@ Created on Wed Jun 23 09:32:56 2021
 
 @author: hansb
 """
-import os, socket, tqdm
+import os, argparse, tqdm
 import numpy as np
 import pandas as pd
-import iris
-import cf_units
 import pyaerocom as pya
 from pyaerocom.trends_helpers import SEASONS
 
-
-def dummy(cube):
-    return cube
+from read_mods import read_model, get_modelfile
+from model_cache import ModelCache
+from output_store import BackgroundWriter, OutputStore
+from run_manifest import RunManifest, file_stats
+from trends_batch import (BatchTrends, MK_KEYS, MK_COLUMNS,
+                          BOOTSTRAP_KEYS, BOOTSTRAP_COLUMNS)
+from trend_store import TrendStore, affected_periods, merge_trend_table
 
 DEFAULT_RESAMPLE_HOW = 'mean'
 
@@ -25,6 +27,14 @@ PERIODS = [(2000, 2019, 14),
 
 OUTPUT_DIR = 'mod_output'
 
+# 'csv': one file per site, 'parquet': one file per variable for the series
+# and trends (see output_store.py, which also exports the csv files)
+OUTPUT_FORMAT = 'csv'
+
+# number of threads writing the csv files of the sites in the background
+# (0: write them in the site loop)
+OUTPUT_WRITER_THREADS = 4
+
 def get_first_last_year(periods):
     first=2100
     last=1900
@@ -37,20 +47,6 @@ def get_first_last_year(periods):
 
 start_yr, stop_yr = get_first_last_year(PERIODS)
 
-HOSTNAME = socket.gethostname()
-
-if HOSTNAME == 'pc5302':
-    preface = '/home/hansb'
-else:
-    preface = '/'
-    
-PATHS = {
-    '1999-2016' : f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2019_REPORTING/TRENDS/',
-    '2017'      : f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2019_REPORTING/EMEP01_L20EC_rv4_33.2017',
-    '2018'      : f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2020_REPORTING/EMEP01_rv4_35_2018_emepCRef2',
-    '2019'      : f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2020_REPORTING/EMEP01_rv4_35_2019_tnoCRef2'    
-    }
-# path = f'{preface}lustre/storeB/project/fou/kl/emep/ModelRuns/2019_REPORTING/TRENDS/'
 # years = range(1999,2020)
 years = [2016,2017]
 
@@ -67,128 +63,238 @@ EMEP_VARS = [
               # 'concso4',
              ]
 
+# read model data only at the stations in sitemeta_{var}.csv instead of
+# reading the whole domain and extracting the time series afterwards
+STATION_READ = True
+
+# number of model years read ahead while the current year is processed
+# (0: off) and directory on a local disk for them (None: in memory)
+MODEL_PREFETCH_DEPTH = 0
+MODEL_SCRATCH_DIR = None
+
+# directory of the cache of derived model data (see model_cache.py), None to
+# disable caching
+MODEL_CACHE_DIR = None
+
+# add the Mann-Kendall test (S, Z and p-value of the yearly values) to the
+# trend tables, corrected for autocorrelation (Hamed and Rao) if MK_AUTOCORR
+MANN_KENDALL = False
+MK_AUTOCORR = False
+
+# moving block bootstrap interval of the relative trends (number of samples,
+# 0: off), with blocks of BOOTSTRAP_BLOCK_SIZE years, computed in
+# BOOTSTRAP_WORKERS processes. The seed makes the results reproducible
+BOOTSTRAP_SAMPLES = 0
+BOOTSTRAP_BLOCK_SIZE = 3
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_WORKERS = 1
+
+# keep the monthly series and yearly aggregates of all sites in
+# TREND_STORE_DIR (see trend_store.py, None: off). With a store, setting
+# UPDATE_YEARS to a list of years reads only these model years, updates the
+# store and rewrites only the trends of the periods containing them
+TREND_STORE_DIR = None
+UPDATE_YEARS = None
+
 #example syntax. Not implemented yet
 CALCULATE_HOW = {'concox':{'req_vars':['conco3','concno2'],
                            'function':pya.io.aux_read_cubes.add_cubes}}
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute trends of EMEP model data at the EBAS sites')
+    parser.add_argument('--force', action='store_true',
+                        help='process all variables, also if their inputs '
+                             'did not change since the last run')
+    args = parser.parse_args()
 
-    for var in EMEP_VARS:
-        print(f'Processing {var}')
-        try:
-            site_info = pd.read_csv(f'obs_output/sitemeta_{var}.csv',index_col=0)
-        except FileNotFoundError:
-            print(f'No sitemeta file found for {var}, skipping...')
-            continue
-        
-        try:
-            calculate_how = CALCULATE_HOW[var]
-        except KeyError:
-            calculate_how = {'req_vars' : [var],'function' : dummy}
+    model_cache = None
+    if MODEL_CACHE_DIR is not None:
+        model_cache = ModelCache(MODEL_CACHE_DIR)
+
+    # optional columns of the trend tables
+    extra_keys, extra_columns = [], []
+    if MANN_KENDALL:
+        extra_keys += MK_KEYS
+        extra_columns += MK_COLUMNS
+    if BOOTSTRAP_SAMPLES > 0:
+        extra_keys += BOOTSTRAP_KEYS
+        extra_columns += BOOTSTRAP_COLUMNS
+
+    read_years = years
+    if UPDATE_YEARS is not None:
+        if TREND_STORE_DIR is None:
+            raise ValueError('UPDATE_YEARS needs a TREND_STORE_DIR')
+        read_years = sorted(UPDATE_YEARS)
+
+    # variables whose model files, sites and settings did not change since
+    # their output was written are skipped (see run_manifest.py)
+    manifest = RunManifest(OUTPUT_DIR)
+
+    writer = None
+    if OUTPUT_WRITER_THREADS > 0:
+        writer = BackgroundWriter(OUTPUT_WRITER_THREADS)
+
+    try:
+        for var in EMEP_VARS:
+            print(f'Processing {var}')
+            try:
+                site_info = pd.read_csv(f'obs_output/sitemeta_{var}.csv',index_col=0)
+            except FileNotFoundError:
+                print(f'No sitemeta file found for {var}, skipping...')
+                continue
+            output = OutputStore(OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                 writer=writer)
+
+            data_freq = var_info[var]['data_freq']
+            inputs = dict(script='calc_modtrends',
+                          model_files=file_stats([get_modelfile(year, data_freq)
+                                                  for year in read_years]),
+                          sitemeta_files=file_stats(
+                              [f'obs_output/sitemeta_{var}.csv']),
+                          periods=PERIODS, seasons=SEASONS,
+                          var_info=var_info[var], resample_how=DEFAULT_RESAMPLE_HOW,
+                          mann_kendall=[MANN_KENDALL, MK_AUTOCORR],
+                          bootstrap=[BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                     BOOTSTRAP_SEED],
+                          trend_store=[TREND_STORE_DIR, UPDATE_YEARS],
+                          output_format=OUTPUT_FORMAT,
+                          pyaerocom=pya.__version__)
+            if not args.force and manifest.is_current(var, inputs,
+                                                      [output.path('trends')]):
+                print(f'Inputs of {var} did not change, skipping (use --force '
+                      f'to process it)')
+                continue
         
-        data_freq =  var_info[var]['data_freq']
-        data = []
-        for year in years:
-            if year < 2017:
-                path = PATHS['1999-2016']
-                data_id = f'{path}/{year}/Base_{data_freq}.nc'
-            elif year == 2017:
-                path = PATHS['2017']
-                data_id = f'{path}/Base_{data_freq}.nc'
-            elif year == 2018:
-                path = PATHS['2018']
-                data_id = f'{path}/Base_{data_freq}.nc'
-            elif year == 2019:
-                path = PATHS['2019']
-                data_id = f'{path}/Base_{data_freq}.nc'
+            if STATION_READ:
+                # read only the grid cells at the stations
+                station_data = read_model(var, get_modelfile, read_years[0],
+                                          read_years[-1] + 1,
+                                          var_info, CALCULATE_HOW, stations=site_info,
+                                          cache=model_cache,
+                                          prefetch_depth=MODEL_PREFETCH_DEPTH,
+                                          scratch_dir=MODEL_SCRATCH_DIR)
             else:
-                raise ValueError
-        
-            reader = pya.io.ReadMscwCtm(data_id)
-            
+                concatenated = read_model(var, get_modelfile, read_years[0],
+                                          read_years[-1] + 1,
+                                          var_info, CALCULATE_HOW, cache=model_cache,
+                                          prefetch_depth=MODEL_PREFETCH_DEPTH,
+                                          scratch_dir=MODEL_SCRATCH_DIR)
 
-            temp_data = []    
-            for req_var in calculate_how['req_vars']:
-                temp = reader.read_var(req_var)
-                if temp.cube.units == 'unknown':
-                    temp.cube.units=var_info[req_var]['units']
-                tcoord = temp.cube.coords('time')[0]
-                if tcoord.units.calendar == 'proleptic_gregorian':
-                    tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
-                
-                temp_data.append(temp.cube)
-            
-            calc_temp = calculate_how['function'](*temp_data)
-            data.append(calc_temp)
-            
-        concatenated = pya.GriddedData(pya.io.iris_io.concatenate_iris_cubes(iris.cube.CubeList(data),True))
-        
-        longitudes = list(site_info['longitude'])
-        latitudes = list(site_info['latitude'])
-        
-        station_metadata = {'station_id':site_info['station_id'],
-                            'station_name':site_info['station_name'],
-                            'latitude':site_info['latitude'],'longitude':site_info['longitude'],
-                            'altitude':site_info['altitude']}
-        
-        station_data = concatenated.to_time_series(longitude=longitudes,latitude=latitudes,add_meta=station_metadata)
-        
-        del concatenated
-        
-        tst = 'monthly'
-        trendtab =  []
-        for site in station_data:
-            try:
-                site = site.resample_time(
-                    var_name=var,
-                    ts_type=tst,
-                    how=DEFAULT_RESAMPLE_HOW)
-            except pya.exceptions.TemporalResolutionError:
-                continue # lower res than monthly
+                longitudes = list(site_info['longitude'])
+                latitudes = list(site_info['latitude'])
+
+                station_metadata = {'station_id':site_info['station_id'],
+                                    'station_name':site_info['station_name'],
+                                    'latitude':site_info['latitude'],'longitude':site_info['longitude'],
+                                    'altitude':site_info['altitude']}
+
+                station_data = concatenated.to_time_series(longitude=longitudes,latitude=latitudes,add_meta=station_metadata)
+
+                del concatenated
+
+            tst = 'monthly'
+            trendtab =  []
+            site_ts = []
+            site_ids = []
+            for site in station_data:
+                try:
+                    site = site.resample_time(
+                        var_name=var,
+                        ts_type=tst,
+                        how=DEFAULT_RESAMPLE_HOW)
+                except pya.exceptions.TemporalResolutionError:
+                    continue # lower res than monthly
             
-            te = pya.trends_engine.TrendsEngine
-            ts = site[var].loc[start_yr:stop_yr]
+                ts = site[var].loc[start_yr:stop_yr]
             
-            subdir = os.path.join(OUTPUT_DIR, f'data_{var}')
+                site_id = site.station_id
             
-            site_id = site.station_id
-            os.makedirs(subdir, exist_ok=True)
-            fname = f'data_{var}_{site_id}_{tst}.csv'
+                unit = str(site.var_info[var]['units'])
+                site_ts.append(ts)
+                site_ids.append((site_id, unit))
 
-            siteout = os.path.join(subdir, fname)
-            ts.to_csv(siteout)
-            
-            unit = str(site.var_info[var]['units'])
-            
-            for (start,stop,min_yrs) in PERIODS:
-                for seas in SEASONS:
-                    trend = te.compute_trend(ts, tst, start, stop, min_yrs,
-                                              seas)
+            trend_periods = PERIODS
+            data_out = [(site_id, ts) for (site_id, _), ts in zip(site_ids, site_ts)]
+            if TREND_STORE_DIR is not None:
+                store_path = os.path.join(TREND_STORE_DIR, f'store_{var}.pkl')
+                if UPDATE_YEARS is None:
+                    # all years were read, start a new store
+                    store = TrendStore(store_path, SEASONS)
+                else:
+                    store = TrendStore.load(store_path, SEASONS)
+                new_data = dict(data_out)
+                changed = store.update(new_data, read_years[0], read_years[-1],
+                                       {site_id: {'unit': unit}
+                                        for site_id, unit in site_ids})
+                store.save()
+                if UPDATE_YEARS is not None:
+                    trend_periods = affected_periods(PERIODS, changed)
+                # write the complete series of the updated sites
+                data_out = [(site_id, store.series(site_id))
+                            for site_id in new_data]
+                site_ids = [(site_id, store.info[site_id]['unit'])
+                            for site_id in store.ids]
+
+            for site_id, ts in data_out:
+                fname = f'data_{var}_{site_id}_{tst}.csv'
+                output.write_series(fname, ts, station_id=site_id, ts_type=tst)
+
+            # trends of all sites, periods and seasons at once (same results as
+            # TrendsEngine.compute_trend for each)
+            if len(site_ids) > 0:
+                if TREND_STORE_DIR is not None:
+                    trends = store.trends(trend_periods,
+                                          mann_kendall=MANN_KENDALL,
+                                          mk_autocorr=MK_AUTOCORR)
+                else:
+                    trends = BatchTrends.from_series(
+                        site_ts, PERIODS, SEASONS, mann_kendall=MANN_KENDALL,
+                        mk_autocorr=MK_AUTOCORR)
+                if BOOTSTRAP_SAMPLES > 0:
+                    trends.bootstrap(BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                     seed=BOOTSTRAP_SEED,
+                                     num_workers=BOOTSTRAP_WORKERS)
 
-                    row = [var, site_id, trend['period'], trend['season'],
-                            trend[f'slp_{start}'], trend[f'slp_{start}_err'],
-                            trend[f'reg0_{start}'], trend['m'], trend['m_err'],
-                            trend['n'], trend['pval'], unit]
+            for i, (site_id, unit) in enumerate(site_ids):
+                for (start,stop,min_yrs) in trend_periods:
+                    for seas in SEASONS:
+                        trend = trends.result(i, start, stop, seas)
 
-                    trendtab.append(row)                    
+                        row = [var, site_id, trend['period'], trend['season'],
+                                trend[f'slp_{start}'], trend[f'slp_{start}_err'],
+                                trend[f'reg0_{start}'], trend['m'], trend['m_err'],
+                                trend['n'], trend['pval'], unit]
+
+                        row += [trend[key] for key in extra_keys]
+
+                        trendtab.append(row)                    
 
         
 
-        trenddf = pd.DataFrame(trendtab,
-                               columns=['var',
-                                       'station_id',
-                                       'period',
-                                       'season',
-                                       'trend [%/yr]',
-                                       'trend err [%/yr]',
-                                       'yoffs',
-                                       'slope',
-                                       'slope err',
-                                       'num yrs',
-                                       'pval',
-                                       'unit'
-                                       ])
-
-        trendout = os.path.join(OUTPUT_DIR, f'trends_{var}.csv')
-
-        trenddf.to_csv(trendout)
\ No newline at end of file
+            trenddf = pd.DataFrame(trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit'
+                                           ] + extra_columns)
+
+            if UPDATE_YEARS is not None:
+                # keep the trends of the periods that did not change
+                trenddf = merge_trend_table(output.read_table('trends'), trenddf,
+                                            trend_periods)
+
+            output.write_table('trends', trenddf)
+            output.close()
+            manifest.update(var, inputs)
+    finally:
+        if writer is not None:
+            writer.shutdown()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trends of yearly percentiles of daily max. O3 from hourly model output
+
+Model counterpart of calc_obstrends_o3.py: the hourly model data
+(Base_hour.nc) is streamed with o3_metrics, a few days at a time, to daily
+maxima at the stations in obs_output/sitemeta_{var}.csv. The yearly
+percentiles of the daily maxima and their trends are computed with the same
+constraints as for the observations. Optionally, the yearly percentile
+fields of the whole grid are written to GRID_OUTPUT_DIR.
+"""
+import os, argparse
+import numpy as np
+import pandas as pd
+
+from helper_functions import get_first_last_year
+from read_mods import EMEP_VAR_UNITS, get_modelfile
+from o3_metrics import grid_percentiles, station_daily_max
+from output_store import BackgroundWriter, OutputStore
+from resample_batch import resample_percentiles
+from run_manifest import RunManifest, file_stats
+from trends_batch import BatchTrends
+from variables import O3_PERCENTILES, O3_PERIODS, O3_RESAMPLE_CONSTRAINTS
+
+# same constraints, percentiles and periods as for the observations (see
+# calc_obstrends_o3.py)
+DEFAULT_RESAMPLE_CONSTRAINTS = O3_RESAMPLE_CONSTRAINTS
+PERECENTILES = O3_PERCENTILES
+PERIODS = O3_PERIODS
+
+# variables to be processed in this script
+EMEP_VARS = ['vmro3']
+
+# where results are stored
+OUTPUT_DIR = 'mod_output'
+
+# 'csv': one file per site and per site, period and percentile, 'parquet':
+# one file per variable for the series and trends (see output_store.py,
+# which also exports the csv files)
+OUTPUT_FORMAT = 'csv'
+
+# number of threads writing the csv files of the sites in the background
+# (0: write them in the site loop)
+OUTPUT_WRITER_THREADS = 4
+
+# approximate size in MB of one chunk of hourly model data
+MEMORY_BUDGET_MB = 256
+
+# directory of the stored station-to-grid indices (see station_index.py),
+# None to compute them in each run
+STATION_INDEX_DIR = None
+
+# write the yearly percentile fields of the whole grid to this directory
+# (None: off). The daily maxima of one year are buffered in
+# GRID_SCRATCH_DIR (e.g. on a local disk, None: in memory)
+GRID_OUTPUT_DIR = None
+GRID_SCRATCH_DIR = None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute trends of O3 percentiles of hourly model data')
+    parser.add_argument('--force', action='store_true',
+                        help='process all variables, also if their inputs '
+                             'did not change since the last run')
+    args = parser.parse_args()
+
+    start_yr, stop_yr = get_first_last_year(PERIODS)
+    years = range(int(start_yr), int(stop_yr))
+
+    # variables whose model files, sites and settings did not change since
+    # their output was written are skipped (see run_manifest.py)
+    manifest = RunManifest(OUTPUT_DIR)
+
+    writer = None
+    if OUTPUT_WRITER_THREADS > 0:
+        writer = BackgroundWriter(OUTPUT_WRITER_THREADS)
+
+    try:
+        for var in EMEP_VARS:
+            print(f'Processing {var}')
+            try:
+                site_info = pd.read_csv(f'obs_output/sitemeta_{var}.csv',
+                                        index_col=0)
+            except FileNotFoundError:
+                print(f'No sitemeta file found for {var}, skipping...')
+                continue
+
+            output = OutputStore(OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                 writer=writer)
+            inputs = dict(script='calc_modtrends_o3',
+                          model_files=file_stats([get_modelfile(year, 'hour')
+                                                  for year in years]),
+                          sitemeta_files=file_stats(
+                              [f'obs_output/sitemeta_{var}.csv']),
+                          periods=PERIODS, percentiles=PERECENTILES,
+                          resample_constraints=DEFAULT_RESAMPLE_CONSTRAINTS,
+                          output_format=OUTPUT_FORMAT,
+                          grid_output_dir=GRID_OUTPUT_DIR)
+            outputs = [output.path('trends')]
+            if GRID_OUTPUT_DIR is not None:
+                outputs += [os.path.join(GRID_OUTPUT_DIR,
+                                         f'{var}_percentiles_{year}.nc')
+                            for year in years]
+            if not args.force and manifest.is_current(var, inputs, outputs):
+                print(f'Inputs of {var} did not change, skipping (use --force '
+                      f'to process it)')
+                continue
+            unit = EMEP_VAR_UNITS[var]
+
+            daily = station_daily_max(var, get_modelfile, years, site_info,
+                                      DEFAULT_RESAMPLE_CONSTRAINTS,
+                                      memory_budget_mb=MEMORY_BUDGET_MB,
+                                      index_dir=STATION_INDEX_DIR)
+            yearly = resample_percentiles(daily, ['daily'] * len(daily), 'yearly',
+                                          PERECENTILES,
+                                          min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
+
+            site_ids = []
+            for site_id, ts in zip(site_info['station_id'], daily):
+                ts = ts.loc[start_yr:stop_yr]
+                if len(ts) == 0 or np.isnan(ts).all(): # skip
+                    continue
+                output.write_series(f'{var}_{site_id}_daily.csv', ts,
+                                    station_id=site_id, ts_type='daily')
+                site_ids.append(site_id)
+
+            trendtab = []
+            tst = 'yearly'
+            for percentile in PERECENTILES:
+                # sites with at least one yearly value
+                sites = [(site_id, ts[percentile].rename(var))
+                         for site_id, ts in zip(site_info['station_id'], yearly)
+                         if site_id in site_ids
+                         and not np.isnan(ts[percentile]).all()]
+                if len(sites) == 0:
+                    continue
+                trends = BatchTrends.from_series([ts for _, ts in sites], PERIODS,
+                                                 ['all'], ts_type=tst)
+                for i, (site_id, _) in enumerate(sites):
+                    for (start, stop, min_yrs) in PERIODS:
+                        trend = trends.result(i, start, stop, 'all')
+
+                        row = [var, site_id, trend['period'], trend['season'],
+                               trend[f'slp_{start}'], trend[f'slp_{start}_err'],
+                               trend[f'reg0_{start}'], trend['m'], trend['m_err'],
+                               trend['n'], trend['pval'], unit, percentile]
+
+                        trendtab.append(row)
+
+                        fname = f'{var}_{site_id}_{start}-{stop}_{percentile}p_yearly.csv'
+                        if trend['data'] is not None:
+                            output.write_series(fname, trend['data'],
+                                                kind='yearly', station_id=site_id,
+                                                period=trend['period'],
+                                                percentile=percentile)
+
+            trenddf = pd.DataFrame(trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit',
+                                           'percentile'
+                                           ])
+
+            output.write_table('trends', trenddf)
+            output.close()
+
+            if GRID_OUTPUT_DIR is not None:
+                os.makedirs(GRID_OUTPUT_DIR, exist_ok=True)
+                for year, fields in grid_percentiles(
+                        var, get_modelfile, years, PERECENTILES,
+                        DEFAULT_RESAMPLE_CONSTRAINTS,
+                        memory_budget_mb=MEMORY_BUDGET_MB,
+                        scratch_dir=GRID_SCRATCH_DIR):
+                    fields.attrs['units'] = unit
+                    fname = f'{var}_percentiles_{year}.nc'
+                    fields.to_netcdf(os.path.join(GRID_OUTPUT_DIR, fname))
+                    print(f'Wrote {fname}')
+            manifest.update(var, inputs)
+    finally:
+        if writer is not None:
+            writer.shutdown()
@@ -5,7 +5,7 @@ Created on Tue Jun 15 11:16:33 2021
 
 @author: jonasg
 """
-import os, tqdm
+import os, argparse, tqdm
 import numpy as np
 import pandas as pd
 import pyaerocom as pya
@@ -14,6 +14,13 @@ from pyaerocom.trends_helpers import SEASONS
 from helper_functions import (delete_outdated_output, clear_output,
                               get_first_last_year)
 
+from obs_cache import EbasCache, ebas_file_set, read_ebas_vars
+from output_store import BackgroundWriter, OutputStore
+from resample_batch import resample_sites
+from run_manifest import RunManifest
+from trends_batch import (BatchTrends, MK_KEYS, MK_COLUMNS,
+                          BOOTSTRAP_KEYS, BOOTSTRAP_COLUMNS)
+from trend_store import TrendStore, affected_periods, merge_trend_table
 from variables import ALL_EBAS_VARS
 
 SEASONS = ['all'] + list(SEASONS)
@@ -66,7 +73,52 @@ EBAS_BASE_FILTERS = dict(set_flags_nan   = True,
 
 OUTPUT_DIR = 'obs_output'
 
+# 'csv': one file per site and per site, period and season, 'parquet': one
+# file per variable for the series, trends and site metadata (see
+# output_store.py, which also exports the csv files)
+OUTPUT_FORMAT = 'csv'
+
+# number of threads writing the csv files of the sites in the background
+# (0: write them in the site loop)
+OUTPUT_WRITER_THREADS = 4
+
+# directory of the cache of filtered EBAS data (see obs_cache.py), None to
+# read all EBAS files in each run
+OBS_CACHE_DIR = None
+
+# read all EBAS_VARS in one pass over the EBAS files before processing, so
+# that files containing several variables are parsed only once (needs more
+# memory)
+EBAS_BATCH_READ = False
+
+# add the Mann-Kendall test (S, Z and p-value of the yearly values) to the
+# trend tables, corrected for autocorrelation (Hamed and Rao) if MK_AUTOCORR
+MANN_KENDALL = False
+MK_AUTOCORR = False
+
+# moving block bootstrap interval of the relative trends (number of samples,
+# 0: off), with blocks of BOOTSTRAP_BLOCK_SIZE years, computed in
+# BOOTSTRAP_WORKERS processes. The seed makes the results reproducible
+BOOTSTRAP_SAMPLES = 0
+BOOTSTRAP_BLOCK_SIZE = 3
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_WORKERS = 1
+
+# keep the series and yearly aggregates of all sites in TREND_STORE_DIR (see
+# trend_store.py, None: off). With a store, setting UPDATE_YEARS to a list of
+# years processes only the observations of these years, updates the store
+# and rewrites only the trends of the periods containing them
+TREND_STORE_DIR = None
+UPDATE_YEARS = None
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute trends of EBAS observations')
+    parser.add_argument('--force', action='store_true',
+                        help='process all variables, also if their inputs '
+                             'did not change since the last run')
+    args = parser.parse_args()
+
     if not os.path.exists(OUTPUT_DIR):
         os.mkdir(OUTPUT_DIR)
 
@@ -80,139 +132,234 @@ if __name__ == '__main__':
     delete_outdated_output(OUTPUT_DIR, ALL_EBAS_VARS)
 
     start_yr, stop_yr = get_first_last_year(PERIODS)
+    read_start, read_stop = start_yr, stop_yr
+    if UPDATE_YEARS is not None:
+        if TREND_STORE_DIR is None:
+            raise ValueError('UPDATE_YEARS needs a TREND_STORE_DIR')
+        read_start, read_stop = str(min(UPDATE_YEARS)), str(max(UPDATE_YEARS))
 
     oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
+    obs_cache = None
+    if OBS_CACHE_DIR is not None:
+        obs_cache = EbasCache(oreader, EBAS_ID, OBS_CACHE_DIR)
+
+    # variables whose EBAS files and settings did not change since their
+    # output was written are skipped (see run_manifest.py)
+    manifest = RunManifest(OUTPUT_DIR)
+    inputs = {}
+    for var in EBAS_VARS:
+        inputs[var] = dict(script='calc_obstrends',
+                           ebas_files=ebas_file_set(
+                               oreader.get_lowlevel_reader(EBAS_ID), var),
+                           periods=PERIODS, seasons=SEASONS,
+                           filters=EBAS_BASE_FILTERS,
+                           resample_constraints=DEFAULT_RESAMPLE_CONSTRAINTS,
+                           resample_how=DEFAULT_RESAMPLE_HOW,
+                           mann_kendall=[MANN_KENDALL, MK_AUTOCORR],
+                           bootstrap=[BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                      BOOTSTRAP_SEED],
+                           trend_store=[TREND_STORE_DIR, UPDATE_YEARS],
+                           output_format=OUTPUT_FORMAT,
+                           pyaerocom=pya.__version__)
+    outputs = {var: [OutputStore(OUTPUT_DIR, var,
+                                 OUTPUT_FORMAT).path('trends')]
+               for var in EBAS_VARS}
+    process_vars = [var for var in EBAS_VARS
+                    if args.force or not manifest.is_current(var, inputs[var],
+                                                             outputs[var])]
+
+    if EBAS_BATCH_READ:
+        odata_all = read_ebas_vars(oreader, EBAS_ID, process_vars,
+                                   EBAS_BASE_FILTERS, obs_cache)
     #mreader = pya.io.ReadGMscwCtm
 
 
-    for var in EBAS_VARS:
-        if not var in ALL_EBAS_VARS:
-            raise ValueError('invalid variable ', var, '. Please register'
-                             'in variables.py')
-        # delete former output for that variable if it exists
-        clear_output(OUTPUT_DIR, var)
-        sitemeta = []
-        trendtab = []
-
-        data = oreader.read(vars_to_retrieve=var)
-        data = data.apply_filters(**EBAS_BASE_FILTERS)
-        #data = data.apply_filters(station_name='Birkenes II')
-
-        sitedata = data.to_station_data_all(var, start=int(start_yr)-1, stop=int(stop_yr)+1,
-                                            resample_how=DEFAULT_RESAMPLE_HOW,
-                                            min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
+    # optional columns of the trend tables
+    extra_keys, extra_columns = [], []
+    if MANN_KENDALL:
+        extra_keys += MK_KEYS
+        extra_columns += MK_COLUMNS
+    if BOOTSTRAP_SAMPLES > 0:
+        extra_keys += BOOTSTRAP_KEYS
+        extra_columns += BOOTSTRAP_COLUMNS
+
+    writer = None
+    if OUTPUT_WRITER_THREADS > 0:
+        writer = BackgroundWriter(OUTPUT_WRITER_THREADS)
+
+    try:
+        for var in EBAS_VARS:
+            if not var in ALL_EBAS_VARS:
+                raise ValueError('invalid variable ', var, '. Please register'
+                                 'in variables.py')
+            if not var in process_vars:
+                print(f'Inputs of {var} did not change, skipping (use --force '
+                      f'to process it)')
+                continue
+            # delete former output for that variable if it exists
+            if UPDATE_YEARS is None:
+                clear_output(OUTPUT_DIR, var)
+            output = OutputStore(OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                 writer=writer)
+            sitemeta = []
+            trendtab = []
+            site_ts = []
+            site_info = []
+            data_files = []
+
+            if EBAS_BATCH_READ:
+                if var not in odata_all:
+                    continue
+                data = odata_all[var]
+            elif obs_cache is not None:
+                data = obs_cache.read(var, EBAS_BASE_FILTERS)
+            else:
+                data = oreader.read(vars_to_retrieve=var)
+                data = data.apply_filters(**EBAS_BASE_FILTERS)
+            #data = data.apply_filters(station_name='Birkenes II')
+
+            sitedata = data.to_station_data_all(var, start=int(read_start)-1, stop=int(read_stop)+1,
+                                                resample_how=DEFAULT_RESAMPLE_HOW,
+                                                min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
         
-        for site in tqdm.tqdm(sitedata['stats'], desc=var):
-            tst = 'daily'
-            try:
-                site = site.resample_time(
-                    var_name=var,
-                    ts_type=tst,
-                    min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-                    how=DEFAULT_RESAMPLE_HOW)
-            except pya.exceptions.TemporalResolutionError:
-                tst = 'monthly'
-                try:
-                    site = site.resample_time(
-                    var_name=var,
-                    ts_type=tst,
-                    min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-                    how=DEFAULT_RESAMPLE_HOW)
-                except pya.exceptions.TemporalResolutionError:
+            # daily, or monthly where the data is not daily or finer, resampled
+            # for all sites at once
+            resampled = resample_sites(sitedata['stats'], var, ['daily', 'monthly'],
+                                       min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                                       how=DEFAULT_RESAMPLE_HOW)
+
+            for site, site_resampled in tqdm.tqdm(zip(sitedata['stats'], resampled),
+                                                  desc=var,
+                                                  total=len(resampled)):
+                if site_resampled is None:
                     continue
-
-            ts = site[var].loc[start_yr:stop_yr]
-            if len(ts) == 0 or np.isnan(ts).all(): # skip
-                continue
-            subdir = os.path.join(OUTPUT_DIR, f'data_{var}')
-
-            site_id = site.station_id
-            os.makedirs(subdir, exist_ok=True)
-            fname = f'data_{var}_{site_id}_{tst}.csv'
-
-            siteout = os.path.join(subdir, fname)
-            ts.to_csv(siteout)
-            unit = site.get_unit(var)
-            sitemeta.append([var,
-                             site_id,
-                             site.station_name,
-                             site.latitude,
-                             site.longitude,
-                             site.altitude,
-                             unit,
-                             tst,
-                             site.framework,
-                             site.var_info[var]['matrix']
-                             ])
+                resampled_ts, tst = site_resampled
+                ts = resampled_ts.loc[read_start:read_stop]
+                if len(ts) == 0 or np.isnan(ts).all(): # skip
+                    continue
+                site_id = site.station_id
+                fname = f'data_{var}_{site_id}_{tst}.csv'
+
+                data_files.append((fname, site_id, tst))
+                unit = site.get_unit(var)
+                sitemeta.append([var,
+                                 site_id,
+                                 site.station_name,
+                                 site.latitude,
+                                 site.longitude,
+                                 site.altitude,
+                                 unit,
+                                 tst,
+                                 site.framework,
+                                 site.var_info[var]['matrix']
+                                 ])
             
-            if tst == 'daily':
-                site = site.resample_time(
-                    var_name=var,
-                    ts_type='monthly',
-                    min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-                    how=DEFAULT_RESAMPLE_HOW)
-                tst = 'monthly'
-
-            te = pya.trends_engine.TrendsEngine
-
-
-            for (start, stop, min_yrs) in PERIODS:
-                for seas in SEASONS:
-                    trend = te.compute_trend(ts, tst, start, stop, min_yrs,
-                                             seas)
-
-                    row = [var, site_id, trend['period'], trend['season'],
-                           trend[f'slp_{start}'], trend[f'slp_{start}_err'],
-                           trend[f'reg0_{start}'], trend['m'], trend['m_err'],
-                           trend['n'], trend['pval'], unit]
-
-                    trendtab.append(row)
+                # the trends are computed from ts (daily or monthly), the
+                # yearly and seasonal means are averages of its values
+                site_ts.append(ts)
+                site_info.append((site_id, unit))
+
+            trend_periods = PERIODS
+            if TREND_STORE_DIR is not None:
+                store_path = os.path.join(TREND_STORE_DIR, f'store_{var}.pkl')
+                if UPDATE_YEARS is None:
+                    # all years were processed, start a new store
+                    store = TrendStore(store_path, SEASONS)
+                else:
+                    store = TrendStore.load(store_path, SEASONS)
+                new_data = {info[0]: ts for info, ts in zip(site_info, site_ts)}
+                changed = store.update(
+                    new_data, int(read_start), int(read_stop),
+                    {info[0]: {'unit': info[1], 'meta': meta}
+                     for info, meta in zip(site_info, sitemeta)})
+                store.save()
+                if UPDATE_YEARS is not None:
+                    trend_periods = affected_periods(PERIODS, changed)
+                # complete series of the updated sites
+                site_ts = [store.series(site_id) for site_id in new_data]
+                sitemeta = [store.info[site_id]['meta'] for site_id in store.ids]
+
+            for (fname, site_id, tst), ts in zip(data_files, site_ts):
+                output.write_series(fname, ts, station_id=site_id, ts_type=tst)
+
+            # trends of all sites, periods and seasons at once (same results as
+            # TrendsEngine.compute_trend for each)
+            if TREND_STORE_DIR is not None:
+                site_info = [(site_id, store.info[site_id]['unit'])
+                             for site_id in store.ids]
+            if len(site_info) > 0:
+                if TREND_STORE_DIR is not None:
+                    trends = store.trends(trend_periods,
+                                          mann_kendall=MANN_KENDALL,
+                                          mk_autocorr=MK_AUTOCORR)
+                else:
+                    trends = BatchTrends.from_series(
+                        site_ts, PERIODS, SEASONS, mann_kendall=MANN_KENDALL,
+                        mk_autocorr=MK_AUTOCORR)
+                if BOOTSTRAP_SAMPLES > 0:
+                    trends.bootstrap(BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                     seed=BOOTSTRAP_SEED,
+                                     num_workers=BOOTSTRAP_WORKERS)
+
+            for i, (site_id, unit) in enumerate(site_info):
+                for (start, stop, min_yrs) in trend_periods:
+                    for seas in SEASONS:
+                        trend = trends.result(i, start, stop, seas)
+
+                        row = [var, site_id, trend['period'], trend['season'],
+                               trend[f'slp_{start}'], trend[f'slp_{start}_err'],
+                               trend[f'reg0_{start}'], trend['m'], trend['m_err'],
+                               trend['n'], trend['pval'], unit]
+
+                        row += [trend[key] for key in extra_keys]
+
+                        trendtab.append(row)
                     
-                    fname = f'{var}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
-                    try:
-                        trend['data'].to_csv(os.path.join(subdir, fname))
-                    except AttributeError:
-                        pass
+                        fname = f'{var}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
+                        if trend['data'] is not None:
+                            output.write_series(fname, trend['data'],
+                                                kind='yearly', station_id=site_id,
+                                                period=trend['period'],
+                                                season=seas)
                     
-        metadf = pd.DataFrame(sitemeta,
-                              columns=['var',
-                                       'station_id',
-                                       'station_name',
-                                       'latitude',
-                                       'longitude',
-                                       'altitude',
-                                       'unit',
-                                       'freq',
-                                       'framework',
-                                       'matrix'
-                                       ])
-
-        metaout = os.path.join(OUTPUT_DIR, f'sitemeta_{var}.csv')
-
-        metadf.to_csv(metaout)
-
-        trenddf = pd.DataFrame(trendtab,
-                               columns=['var',
-                                       'station_id',
-                                       'period',
-                                       'season',
-                                       'trend [%/yr]',
-                                       'trend err [%/yr]',
-                                       'yoffs',
-                                       'slope',
-                                       'slope err',
-                                       'num yrs',
-                                       'pval',
-                                       'unit'
-                                       ])
-
-        trendout = os.path.join(OUTPUT_DIR, f'trends_{var}.csv')
-
-        trenddf.to_csv(trendout)
-
-
-
-
-
-
-
+            metadf = pd.DataFrame(sitemeta,
+                                  columns=['var',
+                                           'station_id',
+                                           'station_name',
+                                           'latitude',
+                                           'longitude',
+                                           'altitude',
+                                           'unit',
+                                           'freq',
+                                           'framework',
+                                           'matrix'
+                                           ])
+
+            output.write_table('sitemeta', metadf)
+
+            trenddf = pd.DataFrame(trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit'
+                                           ] + extra_columns)
+
+            if UPDATE_YEARS is not None:
+                # keep the trends of the periods that did not change
+                trenddf = merge_trend_table(output.read_table('trends'), trenddf,
+                                            trend_periods)
+
+            output.write_table('trends', trenddf)
+            output.close()
+            manifest.update(var, inputs[var])
+    finally:
+        if writer is not None:
+            writer.shutdown()
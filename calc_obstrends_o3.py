@@ -5,54 +5,33 @@ Created on Tue Jun 15 11:16:33 2021
 
 @author: jonasg
 """
-import os, tqdm
+import os, argparse, tqdm
 import numpy as np
 import pandas as pd
 import pyaerocom as pya
 
-from helper_functions import (clear_obs_output, delete_outdated_output,
+from helper_functions import (clear_output, delete_outdated_output,
                               get_first_last_year)
 
-from variables import ALL_EBAS_VARS
+from obs_cache import EbasCache, ebas_file_set
+from output_store import BackgroundWriter, OutputStore
+from resample_batch import resample_percentiles, resample_sites
+from run_manifest import RunManifest
+from variables import (ALL_EBAS_VARS, O3_PERCENTILES, O3_PERIODS,
+                       O3_RESAMPLE_CONSTRAINTS)
 
 EBAS_LOCAL = '/home/jonasg/MyPyaerocom/data/obsdata/EBASMultiColumn/data'
 EBAS_ID = 'EBASMC'
 
-# email with Sverre and David on 22 June 2021
-DEFAULT_RESAMPLE_CONSTRAINTS = dict(yearly     =   dict(daily      = 330),
-                                    daily      =   dict(hourly     = 18))
+# resampling constraints, O3 percentiles for daily -> yearly and analysis
+# periods, shared with calc_modtrends_o3.py (see variables.py)
+DEFAULT_RESAMPLE_CONSTRAINTS = O3_RESAMPLE_CONSTRAINTS
+PERECENTILES = O3_PERCENTILES
+PERIODS = O3_PERIODS
 
-# daily to yearly will be added below for each percentile
+# daily maxima of hourly O3, daily -> yearly are the percentiles above
 RESAMPLE_HOW = dict(daily = dict(hourly='max'))
 
-# O3 percentiles for daily -> yearly
-PERECENTILES = [10, 50, 75, 95, 98, 99]
-
-def get_rs_how(percentile):
-    """
-
-
-    Parameters
-    ----------
-    percentile : int
-        integer percentile to be used for daily -> yearly
-
-    Returns
-    -------
-    dict
-        resample_how dictionary
-
-    """
-    rs_how = {**RESAMPLE_HOW}
-    rs_how['yearly'] = dict(daily=f'{percentile}percentile')
-    return rs_how
-
-# analysis periods and minimum no. of years required for trends retrieval
-PERIODS = [(2000, 2019, 14),
-           (2000, 2010, 7),
-           (2010, 2019, 7),
-           (2005, 2019, 10)]
-
 # variables to be processed in this script
 EBAS_VARS = ['vmro3']
 
@@ -65,7 +44,27 @@ EBAS_BASE_FILTERS = dict(set_flags_nan   = True,
 # where results are stored
 OUTPUT_DIR = 'obs_output'
 
+# 'csv': one file per site and per site, period and percentile, 'parquet':
+# one file per variable for the series, trends and site metadata (see
+# output_store.py, which also exports the csv files)
+OUTPUT_FORMAT = 'csv'
+
+# number of threads writing the csv files of the sites in the background
+# (0: write them in the site loop)
+OUTPUT_WRITER_THREADS = 4
+
+# directory of the cache of filtered EBAS data (see obs_cache.py), None to
+# read all EBAS files in each run
+OBS_CACHE_DIR = None
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute trends of O3 percentiles of EBAS observations')
+    parser.add_argument('--force', action='store_true',
+                        help='process all variables, also if their inputs '
+                             'did not change since the last run')
+    args = parser.parse_args()
+
     if not os.path.exists(OUTPUT_DIR):
         os.mkdir(OUTPUT_DIR)
 
@@ -81,141 +80,159 @@ if __name__ == '__main__':
     start_yr, stop_yr = get_first_last_year(PERIODS)
 
     oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
-
-
-    for var in EBAS_VARS:
-        if not var in ALL_EBAS_VARS:
-            raise ValueError('invalid variable ', var, '. Please register'
-                             'in variables.py')
-
-        # delete previous output
-        clear_obs_output(OUTPUT_DIR, var)
-        sitemeta = []
-        trendtab = []
-
-        data = oreader.read(vars_to_retrieve=var)
-        data = data.apply_filters(**EBAS_BASE_FILTERS)
-        # data = data.apply_filters(station_id='GB0013R')
-
-        sitedata = data.to_station_data_all(var,
-                                            resample_how=RESAMPLE_HOW,
-                                            min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
-
-        for site in tqdm.tqdm(sitedata['stats'], desc=var):
-            tst = 'daily'
-            try:
-                site = site.resample_time(
-                    var_name=var,
-                    ts_type=tst,
-                    min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-                    how=RESAMPLE_HOW)
-            except pya.exceptions.TemporalResolutionError:
-                continue # lower res than monthly
-
-            ts = site[var].loc[start_yr:stop_yr]
-            if len(ts) == 0 or np.isnan(ts).all(): # skip
+    obs_cache = None
+    if OBS_CACHE_DIR is not None:
+        obs_cache = EbasCache(oreader, EBAS_ID, OBS_CACHE_DIR)
+
+    # variables whose EBAS files and settings did not change since their
+    # output was written are skipped (see run_manifest.py)
+    manifest = RunManifest(OUTPUT_DIR)
+
+    writer = None
+    if OUTPUT_WRITER_THREADS > 0:
+        writer = BackgroundWriter(OUTPUT_WRITER_THREADS)
+
+    try:
+        for var in EBAS_VARS:
+            if not var in ALL_EBAS_VARS:
+                raise ValueError('invalid variable ', var, '. Please register'
+                                 'in variables.py')
+            inputs = dict(script='calc_obstrends_o3',
+                          ebas_files=ebas_file_set(
+                              oreader.get_lowlevel_reader(EBAS_ID), var),
+                          periods=PERIODS, percentiles=PERECENTILES,
+                          filters=EBAS_BASE_FILTERS,
+                          resample_constraints=DEFAULT_RESAMPLE_CONSTRAINTS,
+                          resample_how=RESAMPLE_HOW,
+                          output_format=OUTPUT_FORMAT,
+                          pyaerocom=pya.__version__)
+            trends_path = OutputStore(OUTPUT_DIR, var, OUTPUT_FORMAT).path('trends')
+            if not args.force and manifest.is_current(var, inputs, [trends_path]):
+                print(f'Inputs of {var} did not change, skipping (use --force '
+                      f'to process it)')
                 continue
 
-            subdir = os.path.join(OUTPUT_DIR, f'data_{var}')
-
-            site_id = site.station_id
-            os.makedirs(subdir, exist_ok=True)
-            fname = f'{var}_{site_id}_{tst}.csv'
-
-            siteout = os.path.join(subdir, fname)
-            ts.to_csv(siteout)
-            unit = site.get_unit(var)
-            sitemeta.append([var,
-                             site_id,
-                             site.station_name,
-                             site.latitude,
-                             site.longitude,
-                             site.altitude,
-                             unit,
-                             tst,
-                             site.framework,
-                             site.var_info[var]['matrix']
-                             ])
-
-            tst = 'yearly'
-            for percentile in PERECENTILES:
-                rs_how = get_rs_how(percentile)
-                try:
-                    site_trend = site.resample_time(
-                        var_name=var,
-                        ts_type=tst,
-                        min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-                        how=rs_how,inplace=False)
-                except pya.exceptions.TemporalResolutionError:
-                    continue # lower res than monthly
-
-                ts = site_trend[var]
+            # delete previous output
+            clear_output(OUTPUT_DIR, var)
+            output = OutputStore(OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                 writer=writer)
+            sitemeta = []
+            trendtab = []
+
+            if obs_cache is not None:
+                data = obs_cache.read(var, EBAS_BASE_FILTERS)
+            else:
+                data = oreader.read(vars_to_retrieve=var)
+                data = data.apply_filters(**EBAS_BASE_FILTERS)
+            # data = data.apply_filters(station_id='GB0013R')
+
+            sitedata = data.to_station_data_all(var,
+                                                resample_how=RESAMPLE_HOW,
+                                                min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
+
+            # daily maxima of all sites, then all yearly percentiles at once
+            # from the daily maxima
+            sites = sitedata['stats']
+            daily = resample_sites(sites, var, ['daily'],
+                                   min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                                   how=RESAMPLE_HOW)
+            valid = [i for i, res in enumerate(daily) if res is not None]
+            yearly = resample_percentiles([daily[i][0] for i in valid],
+                                          ['daily'] * len(valid), 'yearly',
+                                          PERECENTILES,
+                                          min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                                          how=RESAMPLE_HOW)
+            yearly = dict(zip(valid, yearly))
+
+            for i in tqdm.tqdm(valid, desc=var):
+                site = sites[i]
+                daily_ts, tst = daily[i]
+
+                ts = daily_ts.loc[start_yr:stop_yr]
                 if len(ts) == 0 or np.isnan(ts).all(): # skip
                     continue
 
-                te = pya.trends_engine.TrendsEngine
+                site_id = site.station_id
+                fname = f'{var}_{site_id}_{tst}.csv'
 
+                output.write_series(fname, ts, station_id=site_id, ts_type=tst)
+                unit = site.get_unit(var)
+                sitemeta.append([var,
+                                 site_id,
+                                 site.station_name,
+                                 site.latitude,
+                                 site.longitude,
+                                 site.altitude,
+                                 unit,
+                                 tst,
+                                 site.framework,
+                                 site.var_info[var]['matrix']
+                                 ])
 
-                for (start, stop, min_yrs) in PERIODS:
-
-                    trend = te.compute_trend(ts, tst, start, stop, min_yrs,
-                                             'all')
-
-                    row = [var, site_id, trend['period'], trend['season'],
-                           trend[f'slp_{start}'], trend[f'slp_{start}_err'],
-                           trend[f'reg0_{start}'], trend['m'], trend['m_err'],
-                           trend['n'], trend['pval'], unit, percentile]
-
-                    trendtab.append(row)
-                    
-                    fname = f'{var}_{site_id}_{start}-{stop}_{percentile}p_yearly.csv'
-                    try:
-                        trend['data'].to_csv(os.path.join(subdir, fname))
-                    except AttributeError:
-                        pass
-                        
-
-        metadf = pd.DataFrame(sitemeta,
-                              columns=['var',
-                                       'station_id',
-                                       'station_name',
-                                       'latitude',
-                                       'longitude',
-                                       'altitude',
-                                       'unit',
-                                       'freq',
-                                       'framework',
-                                       'matrix'
-
-                                       ])
-
-        metaout = os.path.join(OUTPUT_DIR, f'sitemeta_{var}.csv')
-
-        metadf.to_csv(metaout)
-
-        trenddf = pd.DataFrame(trendtab,
-                               columns=['var',
-                                       'station_id',
-                                       'period',
-                                       'season',
-                                       'trend [%/yr]',
-                                       'trend err [%/yr]',
-                                       'yoffs',
-                                       'slope',
-                                       'slope err',
-                                       'num yrs',
-                                       'pval',
-                                       'unit',
-                                       'percentile'
-                                       ])
-
-        trendout = os.path.join(OUTPUT_DIR, f'trends_{var}.csv')
-
-        trenddf.to_csv(trendout)
+                tst = 'yearly'
+                for percentile in PERECENTILES:
+                    ts = yearly[i][percentile].rename(daily_ts.name)
+                    if len(ts) == 0 or np.isnan(ts).all(): # skip
+                        continue
 
+                    te = pya.trends_engine.TrendsEngine
 
 
+                    for (start, stop, min_yrs) in PERIODS:
 
+                        trend = te.compute_trend(ts, tst, start, stop, min_yrs,
+                                                 'all')
 
+                        row = [var, site_id, trend['period'], trend['season'],
+                               trend[f'slp_{start}'], trend[f'slp_{start}_err'],
+                               trend[f'reg0_{start}'], trend['m'], trend['m_err'],
+                               trend['n'], trend['pval'], unit, percentile]
 
+                        trendtab.append(row)
+                    
+                        fname = f'{var}_{site_id}_{start}-{stop}_{percentile}p_yearly.csv'
+                        if trend['data'] is not None:
+                            output.write_series(fname, trend['data'],
+                                                kind='yearly', station_id=site_id,
+                                                period=trend['period'],
+                                                percentile=percentile)
+                        
 
+            metadf = pd.DataFrame(sitemeta,
+                                  columns=['var',
+                                           'station_id',
+                                           'station_name',
+                                           'latitude',
+                                           'longitude',
+                                           'altitude',
+                                           'unit',
+                                           'freq',
+                                           'framework',
+                                           'matrix'
+
+                                           ])
+
+            output.write_table('sitemeta', metadf)
+
+            trenddf = pd.DataFrame(trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit',
+                                           'percentile'
+                                           ])
+
+            output.write_table('trends', trenddf)
+            output.close()
+            manifest.update(var, inputs)
+    finally:
+        if writer is not None:
+            writer.shutdown()
@@ -5,7 +5,7 @@ Created on Tue Jun 15 11:16:33 2021
 
 @author: jonasg
 """
-import os, socket, tqdm
+import os, socket, argparse, tqdm
 import numpy as np
 import pandas as pd
 import pyaerocom as pya
@@ -13,9 +13,21 @@ from pyaerocom.trends_helpers import SEASONS
 
 from helper_functions import (delete_outdated_output, clear_output,
                               get_first_last_year)
-from read_mods import read_model, get_modelfile, CALCULATE_HOW, EMEP_VAR_UNITS
+from read_mods import (read_model, read_models, iter_model_years,
+                       get_modelfile, CALCULATE_HOW, EMEP_VAR_UNITS,
+                       select_data_freq, validate_data_freq)
+from model_cache import ModelCache
+from model_catalog import ModelCatalog
 import derive_cubes as der
-
+from colocate import (colocate_gridded_ungridded, colocate_years,
+                      colocated_arrays)
+from station_meta import StationMetaIndex
+
+from obs_cache import EbasCache, ebas_file_set, read_ebas_vars
+from output_store import BackgroundWriter, OutputStore
+from run_manifest import RunManifest, file_stats
+from trends_batch import (BatchTrends, MK_KEYS, MK_COLUMNS,
+                          BOOTSTRAP_KEYS, BOOTSTRAP_COLUMNS)
 from variables import ALL_EBAS_VARS
 
 SEASONS = ['all'] + list(SEASONS)
@@ -74,9 +86,99 @@ MODEL_OUTPUT_DIR = 'mod_output'
 #OBS_OUTPUT_DIR = '/home/eivindgw/testdata/obs_output'  #!!!!!! for testing
 #MODEL_OUTPUT_DIR = '/home/eivindgw/testdata/mod_output'  #!!!!!!! for testing
 
-DATA_FREQ = 'day'
+# 'csv': one file per site and per site, period and season, 'parquet': one
+# file per variable for the series, trends and site metadata (see
+# output_store.py, which also exports the csv files)
+OUTPUT_FORMAT = 'csv'
+
+# number of threads writing the csv files of the sites in the background
+# (0: write them in the site loop)
+OUTPUT_WRITER_THREADS = 4
+
+# directory of the cache of filtered EBAS data (see obs_cache.py), None to
+# read all EBAS files in each run
+OBS_CACHE_DIR = None
+
+# read all EBAS_VARS in one pass over the EBAS files before processing, so
+# that files containing several variables are parsed only once (needs more
+# memory)
+EBAS_BATCH_READ = False
+
+# add the Mann-Kendall test (S, Z and p-value of the yearly values) to the
+# trend tables, corrected for autocorrelation (Hamed and Rao) if MK_AUTOCORR
+MANN_KENDALL = False
+MK_AUTOCORR = False
+
+# moving block bootstrap interval of the relative trends (number of samples,
+# 0: off), with blocks of BOOTSTRAP_BLOCK_SIZE years, computed in
+# BOOTSTRAP_WORKERS processes. The seed makes the results reproducible
+BOOTSTRAP_SAMPLES = 0
+BOOTSTRAP_BLOCK_SIZE = 3
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_WORKERS = 1
+
+# colocate the model data with the daily observations before averaging to
+# monthly, so that model and obs cover the same days. This needs daily model
+# data, otherwise the (much smaller) monthly model files are used
+MATCH_OBS_COVERAGE = True
+DATA_FREQ = select_data_freq('monthly', MATCH_OBS_COVERAGE)
+
+# compare monthly data averaged from the daily model files with the monthly
+# model files for each variable, for the year given here (None: no check)
+VALIDATE_DATA_FREQ_YEAR = None
+
+# number of processes used to read the annual model files (1: serial), e.g.
+# os.cpu_count(), and max. number of years read or held at the same time
+MODEL_READ_WORKERS = 1
+MODEL_READ_MAX_IN_FLIGHT = None
+
+# keep model data as chunked (dask) arrays until colocation, with chunks of
+# approx. MODEL_MEMORY_BUDGET_MB (can not be used with MODEL_READ_WORKERS > 1)
+MODEL_LAZY_READ = False
+MODEL_MEMORY_BUDGET_MB = 256
+
+# read the model data of all EBAS_VARS before processing, so that raw model
+# fields needed by several variables are read only once (needs more memory)
+MODEL_SHARED_READ = False
+
+# number of model years read ahead in a background thread while the current
+# year is processed (0: off, can not be used with MODEL_READ_WORKERS > 1),
+# and directory on a local disk for the prefetched data (None: in memory)
+MODEL_PREFETCH_DEPTH = 0
+MODEL_SCRATCH_DIR = None
+
+# index file of the model files (see model_catalog.py), None to use
+# read_mods.get_modelfile without checking the model files before the run
+MODEL_CATALOG_FILE = None
+
+# directory of the cache of derived model data (see model_cache.py), None to
+# disable caching
+MODEL_CACHE_DIR = None
+
+# gather the model values at the stations with a station index (see
+# colocate.py) instead of the colocation of pyaerocom. The model grid cells
+# of the stations are stored in STATION_INDEX_DIR (None to compute them in
+# each run, e.g. station_index.INDEX_DIR to store them). With
+# COLOCATE_BILINEAR the model is interpolated bilinearly to the stations
+# instead of using the nearest grid cell
+COLOCATE_STATION_INDEX = False
+STATION_INDEX_DIR = None
+COLOCATE_BILINEAR = False
+
+# read and colocate the model data one year at a time, so that only one year
+# of model data is in memory (not with MODEL_SHARED_READ or
+# MODEL_READ_WORKERS > 1)
+STREAM_COLOCATION = False
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute trends of EBAS observations and colocated EMEP '
+                    'model data')
+    parser.add_argument('--force', action='store_true',
+                        help='process all variables, also if their inputs '
+                             'did not change since the last run')
+    args = parser.parse_args()
+
     if not os.path.exists(OBS_OUTPUT_DIR):
         os.mkdir(OBS_OUTPUT_DIR)
     if not os.path.exists(MODEL_OUTPUT_DIR):
@@ -97,169 +199,326 @@ if __name__ == '__main__':
     print(start_yr, stop_yr)
 
     oreader = pya.io.ReadUngridded(EBAS_ID, data_dirs=data_dir)
-
+    obs_cache = None
+    if OBS_CACHE_DIR is not None:
+        obs_cache = EbasCache(oreader, EBAS_ID, OBS_CACHE_DIR)
+
+    model_cache = None
+    if MODEL_CACHE_DIR is not None:
+        model_cache = ModelCache(MODEL_CACHE_DIR)
+
+    getfile = get_modelfile
+    catalog = None
+    if MODEL_CATALOG_FILE is not None:
+        if os.path.exists(MODEL_CATALOG_FILE):
+            catalog = ModelCatalog.load(MODEL_CATALOG_FILE)
+        else:
+            catalog = ModelCatalog.build()
+            catalog.save(MODEL_CATALOG_FILE)
+        # fail before the long run if model variables are missing
+        catalog.check(EBAS_VARS,
+                      {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}
+                       for var in EBAS_VARS},
+                      start_yr, stop_yr, CALCULATE_HOW)
+        getfile = catalog.get_modelfile
+
+    # variables whose EBAS files, model files and settings did not change
+    # since their output was written are skipped (see run_manifest.py)
+    obs_manifest = RunManifest(OBS_OUTPUT_DIR)
+    mod_manifest = RunManifest(MODEL_OUTPUT_DIR)
+    model_files = file_stats([getfile(year, DATA_FREQ) for year in
+                              range(int(start_yr), int(stop_yr))])
+    inputs = {}
+    process_vars = []
     for var in EBAS_VARS:
-        print('var=', var)
-        if var not in ALL_EBAS_VARS:
-            raise ValueError('invalid variable ', var, '. Please register'
-                             'in variables.py')
-        # delete former output for that variable if it exists
-        clear_output(OBS_OUTPUT_DIR, var)
-        clear_output(MODEL_OUTPUT_DIR, var)
-        sitemeta = []
-        obs_trendtab = []
-        mod_trendtab = []
-
-        data = oreader.read(vars_to_retrieve=var)
-        data = data.apply_filters(**EBAS_BASE_FILTERS)
-        #data = data.apply_filters(station_name='Birkenes II')
-        var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}}
-        mdata = read_model(var, get_modelfile, start_yr, stop_yr, var_info, CALCULATE_HOW)
-
-        #remove:
-        # sitedata = data.to_station_data_all(var, start=int(start_yr)-1, stop=int(stop_yr)+1,
-        #                                     resample_how=DEFAULT_RESAMPLE_HOW,
-        #                                     min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
-        coldata = pya.colocation.colocate_gridded_ungridded(
-                    mdata, data, ts_type='monthly', start=start_yr, stop=stop_yr,
-                    colocate_time=True, resample_how=DEFAULT_RESAMPLE_HOW,
-                    min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS
-                    )
-
-        #loop over stations in colcated data
-        sitelist = list(coldata.data.station_name.values)
-        for site in tqdm.tqdm(sitelist, desc=var):
-            tst = 'monthly'
-
-            obs_site = coldata.data.sel(station_name=site).isel(data_source=0).to_series()
-            mod_site = coldata.data.sel(station_name=site).isel(data_source=1).to_series()
-            obs_ts = obs_site.loc[start_yr:stop_yr]
-            mod_ts = mod_site.loc[start_yr:stop_yr]
-            if len(obs_ts) == 0 or np.isnan(obs_ts).all(): # skip
+        inputs[var] = dict(script='calc_trends',
+                           ebas_files=ebas_file_set(
+                               oreader.get_lowlevel_reader(EBAS_ID), var),
+                           model_files=model_files,
+                           periods=PERIODS, seasons=SEASONS,
+                           filters=EBAS_BASE_FILTERS,
+                           resample_constraints=DEFAULT_RESAMPLE_CONSTRAINTS,
+                           resample_how=DEFAULT_RESAMPLE_HOW,
+                           match_obs_coverage=MATCH_OBS_COVERAGE,
+                           colocate_bilinear=COLOCATE_BILINEAR,
+                           mann_kendall=[MANN_KENDALL, MK_AUTOCORR],
+                           bootstrap=[BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                      BOOTSTRAP_SEED],
+                           output_format=OUTPUT_FORMAT,
+                           pyaerocom=pya.__version__)
+        outputs = [OutputStore(output_dir, var, OUTPUT_FORMAT).path('trends')
+                   for output_dir in [OBS_OUTPUT_DIR, MODEL_OUTPUT_DIR]]
+        if (args.force
+                or not obs_manifest.is_current(var, inputs[var], outputs)
+                or not mod_manifest.is_current(var, inputs[var], outputs)):
+            process_vars.append(var)
+
+    if EBAS_BATCH_READ:
+        odata_all = read_ebas_vars(oreader, EBAS_ID, process_vars,
+                                   EBAS_BASE_FILTERS, obs_cache)
+
+    if VALIDATE_DATA_FREQ_YEAR is not None:
+        for var in process_vars:
+            validate_data_freq(var, getfile, VALIDATE_DATA_FREQ_YEAR,
+                               EMEP_VAR_UNITS[var], CALCULATE_HOW)
+
+    if MODEL_SHARED_READ:
+        var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}
+                    for var in process_vars}
+        mdata_all = read_models(process_vars, getfile, start_yr, stop_yr,
+                                var_info, CALCULATE_HOW,
+                                num_workers=MODEL_READ_WORKERS,
+                                max_in_flight=MODEL_READ_MAX_IN_FLIGHT,
+                                lazy=MODEL_LAZY_READ,
+                                memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+                                prefetch_depth=MODEL_PREFETCH_DEPTH,
+                                scratch_dir=MODEL_SCRATCH_DIR,
+                                catalog=catalog, cache=model_cache)
+
+    # optional columns of the trend tables
+    extra_keys, extra_columns = [], []
+    if MANN_KENDALL:
+        extra_keys += MK_KEYS
+        extra_columns += MK_COLUMNS
+    if BOOTSTRAP_SAMPLES > 0:
+        extra_keys += BOOTSTRAP_KEYS
+        extra_columns += BOOTSTRAP_COLUMNS
+
+    writer = None
+    if OUTPUT_WRITER_THREADS > 0:
+        writer = BackgroundWriter(OUTPUT_WRITER_THREADS)
+
+    try:
+        for var in EBAS_VARS:
+            print('var=', var)
+            if var not in ALL_EBAS_VARS:
+                raise ValueError('invalid variable ', var, '. Please register'
+                                 'in variables.py')
+            if not var in process_vars:
+                print(f'Inputs of {var} did not change, skipping (use --force '
+                      f'to process it)')
                 continue
-            obs_subdir = os.path.join(OBS_OUTPUT_DIR, f'data_{var}')
-            mod_subdir = os.path.join(MODEL_OUTPUT_DIR, f'data_{var}')
-
-            sitedata_for_meta = data.to_station_data(
-                site, var, start=int(start_yr)-1, stop=int(stop_yr)+1,
-                resample_how=DEFAULT_RESAMPLE_HOW,
-                min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS
-            )
-
-            site_id = sitedata_for_meta.station_id
-            os.makedirs(obs_subdir, exist_ok=True)
-            os.makedirs(mod_subdir, exist_ok=True)
-            fname = f'data_{var}_{site_id}_{tst}.csv'
-
-            obs_siteout = os.path.join(obs_subdir, fname)
-            obs_ts.to_csv(obs_siteout)
-
-            mod_siteout = os.path.join(mod_subdir, fname)
-            mod_ts.to_csv(mod_siteout)
-
-            unit = sitedata_for_meta.get_unit(var)
-            sitemeta.append([var,
-                             site_id,
-                             sitedata_for_meta.station_name,
-                             sitedata_for_meta.latitude,
-                             sitedata_for_meta.longitude,
-                             sitedata_for_meta.altitude,
-                             unit,
-                             tst,
-                             sitedata_for_meta.framework,
-                             sitedata_for_meta.var_info[var]['matrix']
-                             ])
-
-            # if tst == 'daily':
-            #     site = site.resample_time(
-            #         var_name=var,
-            #         ts_type='monthly',
-            #         min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
-            #         how=DEFAULT_RESAMPLE_HOW)
-            #     tst = 'monthly'
-
-            te = pya.trends_engine.TrendsEngine
-
-
-            for (start, stop, min_yrs) in PERIODS:
-                for seas in SEASONS:
-                    obs_trend = te.compute_trend(obs_ts, tst, start, stop, min_yrs,
-                                             seas)
-
-                    obs_row = [var, site_id, obs_trend['period'], obs_trend['season'],
-                           obs_trend[f'slp_{start}'], obs_trend[f'slp_{start}_err'],
-                           obs_trend[f'reg0_{start}'], obs_trend['m'], obs_trend['m_err'],
-                           obs_trend['n'], obs_trend['pval'], unit]
-
-                    obs_trendtab.append(obs_row)
-
-                    mod_trend = te.compute_trend(mod_ts, tst, start, stop, min_yrs,
-                                             seas)
-
-                    mod_row = [var, site_id, mod_trend['period'], mod_trend['season'],
-                           mod_trend[f'slp_{start}'], mod_trend[f'slp_{start}_err'],
-                           mod_trend[f'reg0_{start}'], mod_trend['m'], mod_trend['m_err'],
-                           mod_trend['n'], mod_trend['pval'], unit]
-
-                    mod_trendtab.append(mod_row)
-
-                    fname = f'{var}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
-                    try:
-                        obs_trend['data'].to_csv(os.path.join(obs_subdir, fname))
-                        mod_trend['data'].to_csv(os.path.join(mod_subdir, fname))
-                    except AttributeError:
-                        pass
-
-        metadf = pd.DataFrame(sitemeta,
-                              columns=['var',
-                                       'station_id',
-                                       'station_name',
-                                       'latitude',
-                                       'longitude',
-                                       'altitude',
-                                       'unit',
-                                       'freq',
-                                       'framework',
-                                       'matrix'
-                                       ])
-
-        metaout = os.path.join(OBS_OUTPUT_DIR, f'sitemeta_{var}.csv')
-
-        metadf.to_csv(metaout)
-
-        obs_trenddf = pd.DataFrame(obs_trendtab,
-                               columns=['var',
-                                       'station_id',
-                                       'period',
-                                       'season',
-                                       'trend [%/yr]',
-                                       'trend err [%/yr]',
-                                       'yoffs',
-                                       'slope',
-                                       'slope err',
-                                       'num yrs',
-                                       'pval',
-                                       'unit'
-                                       ])
-
-        mod_trenddf = pd.DataFrame(mod_trendtab,
-                               columns=['var',
-                                       'station_id',
-                                       'period',
-                                       'season',
-                                       'trend [%/yr]',
-                                       'trend err [%/yr]',
-                                       'yoffs',
-                                       'slope',
-                                       'slope err',
-                                       'num yrs',
-                                       'pval',
-                                       'unit'
-                                       ])
-
-        obs_trendout = os.path.join(OBS_OUTPUT_DIR, f'trends_{var}.csv')
-        obs_trenddf.to_csv(obs_trendout)
-
-        mod_trendout = os.path.join(MODEL_OUTPUT_DIR, f'trends_{var}.csv')
-        mod_trenddf.to_csv(mod_trendout)
-        print('Processing of variable %s done.' % var)
+            # delete former output for that variable if it exists
+            clear_output(OBS_OUTPUT_DIR, var)
+            clear_output(MODEL_OUTPUT_DIR, var)
+            obs_output = OutputStore(OBS_OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                     writer=writer)
+            mod_output = OutputStore(MODEL_OUTPUT_DIR, var, OUTPUT_FORMAT,
+                                     writer=writer)
+            sitemeta = []
+            obs_trendtab = []
+            mod_trendtab = []
+            site_info = []
+
+            if EBAS_BATCH_READ:
+                if var not in odata_all:
+                    continue
+                data = odata_all[var]
+            elif obs_cache is not None:
+                data = obs_cache.read(var, EBAS_BASE_FILTERS)
+            else:
+                data = oreader.read(vars_to_retrieve=var)
+                data = data.apply_filters(**EBAS_BASE_FILTERS)
+            #data = data.apply_filters(station_name='Birkenes II')
+            if MODEL_SHARED_READ:
+                mdata = mdata_all.pop(var)
+            elif STREAM_COLOCATION:
+                var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}}
+                mdata = iter_model_years(var, getfile, start_yr, stop_yr, var_info,
+                                         CALCULATE_HOW, cache=model_cache,
+                                         lazy=MODEL_LAZY_READ,
+                                         memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+                                         prefetch_depth=MODEL_PREFETCH_DEPTH,
+                                         scratch_dir=MODEL_SCRATCH_DIR,
+                                         catalog=catalog)
+            else:
+                var_info = {var: {'units': EMEP_VAR_UNITS[var], 'data_freq': DATA_FREQ}}
+                mdata = read_model(var, getfile, start_yr, stop_yr, var_info, CALCULATE_HOW,
+                                   num_workers=MODEL_READ_WORKERS,
+                                   max_in_flight=MODEL_READ_MAX_IN_FLIGHT,
+                                   cache=model_cache, lazy=MODEL_LAZY_READ,
+                                   memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+                                   prefetch_depth=MODEL_PREFETCH_DEPTH,
+                                   scratch_dir=MODEL_SCRATCH_DIR,
+                                   catalog=catalog)
+
+            #remove:
+            # sitedata = data.to_station_data_all(var, start=int(start_yr)-1, stop=int(stop_yr)+1,
+            #                                     resample_how=DEFAULT_RESAMPLE_HOW,
+            #                                     min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS)
+            if STREAM_COLOCATION and not MODEL_SHARED_READ:
+                coldata = colocate_years(
+                        mdata, data, ts_type='monthly',
+                        colocate_time=MATCH_OBS_COVERAGE, resample_how=DEFAULT_RESAMPLE_HOW,
+                        min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                        use_index=COLOCATE_STATION_INDEX,
+                        index_dir=STATION_INDEX_DIR, bilinear=COLOCATE_BILINEAR
+                        )
+            else:
+                coldata = colocate_gridded_ungridded(
+                        mdata, data, ts_type='monthly', start=start_yr, stop=stop_yr,
+                        colocate_time=MATCH_OBS_COVERAGE, resample_how=DEFAULT_RESAMPLE_HOW,
+                        min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                        use_index=COLOCATE_STATION_INDEX,
+                        index_dir=STATION_INDEX_DIR, bilinear=COLOCATE_BILINEAR
+                        )
+            del mdata
+
+            # obs and model values of all stations (station, time), without
+            # stations that have no obs in the period
+            times, obs_values, mod_values, stations = colocated_arrays(
+                coldata, start_yr, stop_yr)
+            has_obs = ~np.isnan(obs_values).all(axis=1)
+            obs_values, mod_values = obs_values[has_obs], mod_values[has_obs]
+            stations = stations[has_obs].reset_index(drop=True)
+
+            # metadata of all stations, from the metadata blocks of the obs
+            # (stations not found there are converted with to_station_data)
+            meta_index = StationMetaIndex(data, var, start=int(start_yr)-1,
+                                          stop=int(stop_yr)+1)
+
+            for i, site in enumerate(tqdm.tqdm(stations['station_name'], desc=var)):
+                tst = 'monthly'
+
+                obs_ts = pd.Series(obs_values[i], index=times,
+                                   name=coldata.data.name)
+                mod_ts = pd.Series(mod_values[i], index=times,
+                                   name=coldata.data.name)
+                site_meta = meta_index[(var, site)]
+
+                site_id = site_meta['station_id']
+                fname = f'data_{var}_{site_id}_{tst}.csv'
+
+                obs_output.write_series(fname, obs_ts, station_id=site_id,
+                                        ts_type=tst)
+                mod_output.write_series(fname, mod_ts, station_id=site_id,
+                                        ts_type=tst)
+
+                unit = site_meta['unit']
+                sitemeta.append([var,
+                                 site_id,
+                                 site_meta['station_name'],
+                                 site_meta['latitude'],
+                                 site_meta['longitude'],
+                                 site_meta['altitude'],
+                                 unit,
+                                 tst,
+                                 site_meta['framework'],
+                                 site_meta['matrix']
+                                 ])
+
+                # if tst == 'daily':
+                #     site = site.resample_time(
+                #         var_name=var,
+                #         ts_type='monthly',
+                #         min_num_obs=DEFAULT_RESAMPLE_CONSTRAINTS,
+                #         how=DEFAULT_RESAMPLE_HOW)
+                #     tst = 'monthly'
+
+                site_info.append((site_id, unit))
+
+            # trends of all sites, periods and seasons at once (same results as
+            # TrendsEngine.compute_trend for each)
+            if len(site_info) > 0:
+                obs_trends = BatchTrends(
+                    obs_values, times, PERIODS, SEASONS, mann_kendall=MANN_KENDALL,
+                    mk_autocorr=MK_AUTOCORR)
+                mod_trends = BatchTrends(
+                    mod_values, times, PERIODS, SEASONS, mann_kendall=MANN_KENDALL,
+                    mk_autocorr=MK_AUTOCORR)
+                if BOOTSTRAP_SAMPLES > 0:
+                    for trends in [obs_trends, mod_trends]:
+                        trends.bootstrap(BOOTSTRAP_SAMPLES, BOOTSTRAP_BLOCK_SIZE,
+                                         seed=BOOTSTRAP_SEED,
+                                         num_workers=BOOTSTRAP_WORKERS)
+
+            for i, (site_id, unit) in enumerate(site_info):
+                for (start, stop, min_yrs) in PERIODS:
+                    for seas in SEASONS:
+                        obs_trend = obs_trends.result(i, start, stop, seas)
+
+                        obs_row = [var, site_id, obs_trend['period'], obs_trend['season'],
+                               obs_trend[f'slp_{start}'], obs_trend[f'slp_{start}_err'],
+                               obs_trend[f'reg0_{start}'], obs_trend['m'], obs_trend['m_err'],
+                               obs_trend['n'], obs_trend['pval'], unit]
+
+                        obs_row += [obs_trend[key] for key in extra_keys]
+
+                        obs_trendtab.append(obs_row)
+
+                        mod_trend = mod_trends.result(i, start, stop, seas)
+
+                        mod_row = [var, site_id, mod_trend['period'], mod_trend['season'],
+                               mod_trend[f'slp_{start}'], mod_trend[f'slp_{start}_err'],
+                               mod_trend[f'reg0_{start}'], mod_trend['m'], mod_trend['m_err'],
+                               mod_trend['n'], mod_trend['pval'], unit]
+
+                        mod_row += [mod_trend[key] for key in extra_keys]
+
+                        mod_trendtab.append(mod_row)
+
+                        fname = f'{var}_{site_id}_{start}-{stop}_{seas}_yearly.csv'
+                        keys = dict(kind='yearly', station_id=site_id,
+                                    period=obs_trend['period'], season=seas)
+                        if obs_trend['data'] is not None:
+                            obs_output.write_series(fname, obs_trend['data'],
+                                                    **keys)
+                            if mod_trend['data'] is not None:
+                                mod_output.write_series(fname, mod_trend['data'],
+                                                        **keys)
+
+            metadf = pd.DataFrame(sitemeta,
+                                  columns=['var',
+                                           'station_id',
+                                           'station_name',
+                                           'latitude',
+                                           'longitude',
+                                           'altitude',
+                                           'unit',
+                                           'freq',
+                                           'framework',
+                                           'matrix'
+                                           ])
+
+            obs_output.write_table('sitemeta', metadf)
+
+            obs_trenddf = pd.DataFrame(obs_trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit'
+                                           ] + extra_columns)
+
+            mod_trenddf = pd.DataFrame(mod_trendtab,
+                                   columns=['var',
+                                           'station_id',
+                                           'period',
+                                           'season',
+                                           'trend [%/yr]',
+                                           'trend err [%/yr]',
+                                           'yoffs',
+                                           'slope',
+                                           'slope err',
+                                           'num yrs',
+                                           'pval',
+                                           'unit'
+                                           ] + extra_columns)
+
+            obs_output.write_table('trends', obs_trenddf)
+            mod_output.write_table('trends', mod_trenddf)
+            obs_output.close()
+            mod_output.close()
+            obs_manifest.update(var, inputs[var])
+            mod_manifest.update(var, inputs[var])
+            print('Processing of variable %s done.' % var)
+    finally:
+        if writer is not None:
+            writer.shutdown()
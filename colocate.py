@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Colocation of model data with station observations using a StationIndex
+
+Optionally (use_index), the model time series at the stations are gathered
+from the model array with a stored station_index.StationIndex instead of a
+nearest neighbour lookup of every station in every call. This is a copy of
+pyaerocom.colocation.colocate_gridded_ungridded (for the options used in
+this repository) that relies on private helpers of pyaerocom, so it is only
+used with the pyaerocom versions in INDEX_COLOCATION_VERSIONS. Otherwise
+the colocation of pyaerocom is used.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+
+from station_index import StationIndex
+
+# pyaerocom versions whose private colocation helpers the StationIndex
+# colocation was checked against
+INDEX_COLOCATION_VERSIONS = ['0.10', '0.11', '0.12']
+
+
+def _has_index_colocation():
+    """Whether the StationIndex colocation works with this pyaerocom"""
+    version = '.'.join(pya.__version__.split('.')[:2])
+    return version in INDEX_COLOCATION_VERSIONS
+
+
+def colocate_gridded_ungridded(data, data_ref, ts_type=None, start=None,
+                               stop=None, min_num_obs=None,
+                               colocate_time=False, resample_how=None,
+                               use_index=False, index_dir=None,
+                               bilinear=False, **kwargs):
+    """
+    Colocate gridded with ungridded data
+
+    Same as pyaerocom.colocation.colocate_gridded_ungridded unless use_index
+    or bilinear is set.
+
+    Parameters
+    ----------
+    data : pyaerocom.GriddedData
+        Model data.
+    data_ref : pyaerocom.UngriddedData
+        Observations (of a single dataset).
+    ts_type : str, optional
+        Output frequency.
+    start, stop : optional
+        Time range.
+    min_num_obs : int or dict, optional
+        Minimum number of observations for resampling of time.
+    colocate_time : bool, optional
+        Colocate in time before resampling to ts_type.
+    resample_how : str or dict, optional
+        How to aggregate when resampling in time.
+    use_index : bool, optional
+        Gather the model values at the stations with a StationIndex. Falls
+        back to the colocation of pyaerocom (with a message) if the
+        installed pyaerocom is not in INDEX_COLOCATION_VERSIONS. Default is
+        False.
+    index_dir : str, optional
+        Only used with use_index. Directory where the station index is
+        stored. Default is None, i.e. not stored.
+    bilinear : bool, optional
+        Interpolate the model bilinearly to the stations instead of using
+        the nearest grid cell. Implies use_index, and raises ValueError if
+        the installed pyaerocom is not supported.
+    **kwargs
+        Passed to UngriddedData.to_station_data_all.
+
+    Returns
+    -------
+    pyaerocom.ColocatedData
+        Colocated data, as returned by colocate_gridded_ungridded in
+        pyaerocom.
+    """
+    if use_index or bilinear:
+        if _has_index_colocation():
+            return _colocate_with_index(data, data_ref, ts_type, start, stop,
+                                        min_num_obs, colocate_time,
+                                        resample_how, index_dir, bilinear,
+                                        **kwargs)
+        if bilinear:
+            raise ValueError(f'bilinear colocation is not available for '
+                             f'pyaerocom {pya.__version__}')
+        print(f'StationIndex colocation not available for pyaerocom '
+              f'{pya.__version__}, using pyaerocom colocation')
+    return pya.colocation.colocate_gridded_ungridded(
+        data, data_ref, ts_type=ts_type, start=start, stop=stop,
+        min_num_obs=min_num_obs, colocate_time=colocate_time,
+        resample_how=resample_how, **kwargs)
+
+
+def _colocate_with_index(data, data_ref, ts_type, start, stop, min_num_obs,
+                         colocate_time, resample_how, index_dir, bilinear,
+                         **kwargs):
+    """Colocation with a StationIndex, see colocate_gridded_ungridded"""
+    from pyaerocom import const, StationData, ColocatedData
+    from pyaerocom import __version__ as pya_ver
+    from pyaerocom.colocation import (_resolve_var_name, _check_time_ival,
+                                      _check_ts_type,
+                                      _colocate_site_data_helper,
+                                      _colocate_site_data_helper_timecol)
+    from pyaerocom.exceptions import (DimensionOrderError,
+                                      VarNotAvailableError,
+                                      TemporalResolutionError, MetaDataError)
+    from pyaerocom.filter import Filter
+    from pyaerocom.helpers import make_datetime_index
+    from pyaerocom.tstype import TsType
+
+    try:
+        data.check_dimcoords_tseries()
+    except DimensionOrderError:
+        data.reorder_dimensions_tseries()
+
+    var, var_aerocom = _resolve_var_name(data)
+    var_ref, var_ref_aerocom = var_aerocom, var_aerocom
+    if not var_ref in data_ref.contains_vars:
+        raise VarNotAvailableError(f'Variable {var_ref} is not available in '
+                                   f'ungridded data (which contains '
+                                   f'{data_ref.contains_vars})')
+    elif len(data_ref.contains_datasets) > 1:
+        raise AttributeError(f'Colocation can only be performed with '
+                             f'ungridded data objects that only contain a '
+                             f'single dataset (input data contains: '
+                             f'{data_ref.contains_datasets}.')
+    dataset_ref = data_ref.contains_datasets[0]
+
+    regfilter = Filter(name=const.DEFAULT_REG_FILTER)
+    data_ref = regfilter.apply(data_ref)
+    data = regfilter.apply(data)
+
+    start, stop = _check_time_ival(data, start, stop)
+    data = data.crop(time_range=(start, stop))
+
+    ts_type_src_data = data.ts_type
+    ts_type, ts_type_data = _check_ts_type(data, ts_type)
+    if not colocate_time and ts_type < ts_type_data:
+        data = data.resample_time(str(ts_type), min_num_obs=min_num_obs,
+                                  how=resample_how)
+    col_freq = str(ts_type)
+
+    grid_lats = data.latitude.points
+    grid_lons = data.longitude.points
+    # use only sites that are within model domain
+    data_ref = data_ref.filter_by_meta(
+        latitude=[np.min(grid_lats), np.max(grid_lats)],
+        longitude=[np.min(grid_lons), np.max(grid_lons)])
+
+    all_stats = data_ref.to_station_data_all(vars_to_convert=var_ref,
+                                             start=start, stop=stop,
+                                             by_station_name=True, **kwargs)
+    obs_stat_data = all_stats['stats']
+    if len(obs_stat_data) == 0:
+        raise VarNotAvailableError(f'Variable {var_ref} is not available in '
+                                   f'specified time interval ({start}-{stop})')
+
+    # model time series at all stations at once
+    index = StationIndex.load_or_build(grid_lats, grid_lons,
+                                       all_stats['latitude'],
+                                       all_stats['longitude'], bilinear,
+                                       index_dir)
+    model_values = index.gather(data.cube.core_data(), bilinear)
+    # masked cells are NaN, as in GriddedData.to_time_series
+    model_values = np.ma.filled(np.ma.asarray(model_values, dtype=float),
+                                np.nan)
+    model_times = data.time_stamps()
+    model_unit = data.units
+
+    time_idx = make_datetime_index(start, stop,
+                                   TsType(col_freq).to_pandas_freq())
+    arr = np.full((2, len(time_idx), len(obs_stat_data)), np.nan)
+    lons, lats, alts, station_names = [], [], [], []
+    data_ref_unit = None
+    ts_type_src_ref = None
+    data_unit = None
+    for i, obs_stat in enumerate(obs_stat_data):
+        lons.append(obs_stat.longitude)
+        lats.append(obs_stat.latitude)
+        alts.append(obs_stat.altitude)
+        station_names.append(obs_stat.station_name)
+
+        if ts_type_src_ref is None:
+            ts_type_src_ref = obs_stat['ts_type_src']
+        elif obs_stat['ts_type_src'] != ts_type_src_ref:
+            spl = ts_type_src_ref.split(';')
+            if not obs_stat['ts_type_src'] in spl:
+                spl.append(obs_stat['ts_type_src'])
+            ts_type_src_ref = ';'.join(spl)
+
+        try:
+            unit = obs_stat['var_info'][var_ref]['units']
+        except Exception:
+            unit = None
+        if data_ref_unit is None:
+            data_ref_unit = unit
+        if not unit == data_ref_unit:
+            raise ValueError(f'Cannot perform colocation. Ungridded data '
+                             f'object contains different units ({var_ref})')
+
+        grid_stat = StationData(latitude=grid_lats[index.iy[i]]
+                                if grid_lats.ndim == 1 else None,
+                                longitude=grid_lons[index.ix[i]]
+                                if grid_lons.ndim == 1 else None,
+                                data_id=data.name, ts_type=data.ts_type)
+        grid_stat.var_info[var] = {'units': model_unit}
+        grid_stat[var] = pd.Series(model_values[:, i], index=model_times)
+        grid_unit = grid_stat.get_unit(var)
+        obs_unit = obs_stat.get_unit(var_ref)
+        if not grid_unit == obs_unit:
+            grid_stat.convert_unit(var, obs_unit)
+        if data_unit is None:
+            data_unit = obs_unit
+
+        helper = (_colocate_site_data_helper_timecol if colocate_time
+                  else _colocate_site_data_helper)
+        try:
+            _df = helper(stat_data=grid_stat, stat_data_ref=obs_stat,
+                         var=var, var_ref=var_ref, ts_type=col_freq,
+                         resample_how=resample_how, min_num_obs=min_num_obs,
+                         use_climatology_ref=False)
+            try:
+                arr[0, :, i] = _df['ref'].values
+                arr[1, :, i] = _df['data'].values
+            except ValueError:
+                try:
+                    _df = _df.loc[_df.index.intersection(time_idx)]
+                    arr[0, :, i] = _df['ref'].values
+                    arr[1, :, i] = _df['data'].values
+                except ValueError as e:
+                    const.print_log.warning(
+                        f'Failed to colocate time for station '
+                        f'{obs_stat.station_name}. This station will be '
+                        f'skipped (error: {e})')
+        except TemporalResolutionError as e:
+            const.print_log.warning(
+                f'{var_ref} data from site {obs_stat.station_name} will not '
+                f'be added to ColocatedData. Reason: {e}')
+
+    try:
+        revision = data_ref.data_revision[dataset_ref]
+    except Exception:
+        try:
+            revision = data_ref._get_data_revision_helper(dataset_ref)
+        except MetaDataError:
+            revision = 'MULTIPLE'
+        except Exception:
+            revision = 'n/a'
+
+    meta = {'data_source': [dataset_ref, data.name],
+            'var_name': [var_ref_aerocom, var_aerocom],
+            'var_name_input': [var_ref, var],
+            'ts_type': col_freq,
+            'filter_name': const.DEFAULT_REG_FILTER,
+            'ts_type_src': [ts_type_src_ref, ts_type_src_data],
+            'var_units': [data_ref_unit, data_unit],
+            'data_level': 3,
+            'revision_ref': revision,
+            'from_files': [os.path.basename(x) for x in data.from_files],
+            'from_files_ref': None,
+            'colocate_time': colocate_time,
+            'obs_is_clim': False,
+            'pyaerocom': pya_ver,
+            'min_num_obs': min_num_obs,
+            'resample_how': resample_how}
+
+    coords = {'data_source': meta['data_source'],
+              'time': time_idx,
+              'station_name': station_names,
+              'latitude': ('station_name', lats),
+              'longitude': ('station_name', lons),
+              'altitude': ('station_name', alts)}
+    dims = ['data_source', 'time', 'station_name']
+    coldata = ColocatedData(data=arr, coords=coords, dims=dims, name=var,
+                            attrs=meta)
+    coldata.latitude.attrs['standard_name'] = data.latitude.standard_name
+    coldata.latitude.attrs['units'] = str(data.latitude.units)
+    coldata.longitude.attrs['standard_name'] = data.longitude.standard_name
+    coldata.longitude.attrs['units'] = str(data.longitude.units)
+    return coldata
+
+
+def colocated_arrays(coldata, start=None, stop=None):
+    """
+    Observations and model values of all stations in colocated data
+
+    Replaces the selection of each station in the colocated data array.
+
+    Parameters
+    ----------
+    coldata : pyaerocom.ColocatedData
+        Output of colocate_gridded_ungridded.
+    start, stop : optional
+        Time range (e.g. years as str, inclusive), default is all times.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        Time stamps.
+    numpy.ndarray
+        Observations, shape (station, time).
+    numpy.ndarray
+        Model values, shape (station, time).
+    pandas.DataFrame
+        Station name, latitude, longitude and altitude of each station (in
+        the order of the arrays).
+    """
+    arr = coldata.data
+    times = pd.DatetimeIndex(arr['time'].values, name='time')
+    sl = times.slice_indexer(start, stop)
+    values = arr.transpose('data_source', 'station_name', 'time').values
+    stations = pd.DataFrame(
+        {key: arr[key].values for key in
+         ['station_name', 'latitude', 'longitude', 'altitude']})
+    return times[sl], values[0, :, sl], values[1, :, sl], stations
+
+
+def colocate_years(model_years, data_ref, ts_type=None, **kwargs):
+    """
+    Colocate model data that is read year by year
+
+    Each year of model data is colocated with the observations of that year
+    (see colocate_gridded_ungridded) and only the colocated values are kept,
+    so that peak memory does not depend on the number of years. Since the
+    colocated time stamps (e.g. months) do not cross year boundaries, the
+    result is the same as the colocation of all years at once.
+
+    Parameters
+    ----------
+    model_years : iterable
+        (year, pyaerocom.GriddedData) for each year in increasing order, e.g.
+        read_mods.iter_model_years.
+    data_ref : pyaerocom.UngriddedData
+        Observations (of a single dataset).
+    ts_type : str, optional
+        Output frequency.
+    **kwargs
+        Passed to colocate_gridded_ungridded (except start and stop).
+
+    Returns
+    -------
+    pyaerocom.ColocatedData
+        Colocated data of all years, with all stations that have
+        observations in any of the years.
+    """
+    from pyaerocom import ColocatedData
+    from pyaerocom.colocation import _check_ts_type
+    from pyaerocom.exceptions import VarNotAvailableError
+    from pyaerocom.helpers import make_datetime_index
+    from pyaerocom.tstype import TsType
+
+    times, values, stations = [], [], {}
+    meta, coords_attrs, from_files, var_name = None, None, [], None
+    for year, data in model_years:
+        try:
+            coldata = colocate_gridded_ungridded(data, data_ref,
+                                                 ts_type=ts_type, **kwargs)
+        except VarNotAvailableError:
+            # no observations in this year
+            col_freq = str(_check_ts_type(data, ts_type)[0])
+            year_times = make_datetime_index(
+                data.start, data.stop, TsType(col_freq).to_pandas_freq())
+            times.append(year_times)
+            values.append((np.full((2, len(year_times), 0), np.nan), []))
+            continue
+        finally:
+            del data
+        arr = coldata.data
+        names = list(arr['station_name'].values)
+        for name, lat, lon, alt in zip(names, arr['latitude'].values,
+                                       arr['longitude'].values,
+                                       arr['altitude'].values):
+            stations.setdefault(name, (lat, lon, alt))
+        times.append(pd.DatetimeIndex(arr['time'].values))
+        values.append((arr.values, names))
+        from_files.extend(arr.attrs['from_files'])
+        meta = dict(arr.attrs)
+        var_name = arr.name
+        coords_attrs = {key: dict(arr[key].attrs)
+                        for key in ['latitude', 'longitude']}
+        print(f'Colocated {year}: {len(names)} stations')
+    if meta is None:
+        raise VarNotAvailableError('No observations in any of the years')
+
+    # the growing (station, time) result, filled year by year
+    station_names = list(stations)
+    column = {name: i for i, name in enumerate(station_names)}
+    time_idx = times[0].append(times[1:]) if len(times) > 1 else times[0]
+    arr = np.full((2, len(time_idx), len(station_names)), np.nan)
+    i0 = 0
+    for (year_values, names), year_times in zip(values, times):
+        cols = [column[name] for name in names]
+        arr[:, i0:i0 + len(year_times), cols] = year_values
+        i0 += len(year_times)
+
+    meta['from_files'] = from_files
+    lats, lons, alts = zip(*stations.values())
+    coords = {'data_source': meta['data_source'],
+              'time': time_idx,
+              'station_name': station_names,
+              'latitude': ('station_name', list(lats)),
+              'longitude': ('station_name', list(lons)),
+              'altitude': ('station_name', list(alts))}
+    dims = ['data_source', 'time', 'station_name']
+    coldata = ColocatedData(data=arr, coords=coords, dims=dims,
+                            name=var_name, attrs=meta)
+    for key, attrs in coords_attrs.items():
+        coldata.data[key].attrs.update(attrs)
+    return coldata
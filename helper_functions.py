@@ -9,16 +9,19 @@ import os, shutil, glob
 
 
 def delete_outdated_output(outdir, varlist):
-    files = glob.glob(f'{outdir}/sitemeta*.csv')
+    files = (glob.glob(f'{outdir}/sitemeta*.csv') +
+             glob.glob(f'{outdir}/sitemeta*.parquet'))
     for file in files:
         fname = os.path.basename(file)
-        var = fname.split('_')[-1].split('.csv')[0]
+        var = os.path.splitext(fname.split('_')[-1])[0]
         if var not in varlist:
             clear_output(outdir, var)
 
 
 def clear_output(outdir, var):
-    files = glob.glob(f'{outdir}/*{var}*.csv')
+    # csv files or consolidated output (see output_store.py)
+    files = (glob.glob(f'{outdir}/*{var}*.csv') +
+             glob.glob(f'{outdir}/*{var}*.parquet'))
     if len(files) > 0:
         print(f'delete output for {var} in {outdir}')
     for file in files:
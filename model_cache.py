@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of derived model data
+
+Each entry holds one year of one derived variable, as returned by the per
+year readers in read_mods, and is keyed by the variable, year, data_freq,
+derivation function (name and source code), station set, the path, mtime
+and size of the source file and CACHE_VERSION. Changing any of these (e.g. a
+rerun of the model) results in a new key, so these entries never need to be
+invalidated explicitly.
+
+The key does not cover the code that reads the model files (e.g.
+_read_model_year in read_mods.py or the unit conversion). After changing it,
+increase CACHE_VERSION or run purge, otherwise the old entries are used.
+
+Station time series are stored as .npz files, full-domain cubes as
+compressed netCDF. The cache is limited in size and the least recently used
+entries are deleted first.
+
+Usage:
+    python model_cache.py [--cache-dir DIR] info
+    python model_cache.py [--cache-dir DIR] purge [--var VAR]
+    python model_cache.py [--cache-dir DIR] evict [--max-size-gb SIZE]
+"""
+import os, glob, json, hashlib, inspect, argparse
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'emep_trends')
+
+# maximum total size of the cache in GB
+MAX_SIZE_GB = 50
+
+# version of the processing of the cached data (reading, unit conversion and
+# derivation in read_mods.py and derive_cubes.py), part of the keys. Increase
+# it when changing the processing, so that older entries are not used
+CACHE_VERSION = 1
+
+
+def _source_hash(func):
+    """Hash of the source code of a function (None if not available)"""
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        return None
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+class ModelCache(object):
+    """
+    Cache of derived annual model data
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory where the cache entries are stored.
+    max_size_gb : float, optional
+        Maximum total size of the cache. See evict.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size_gb=MAX_SIZE_GB):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(var, year, data_freq, calculate_how, filepath,
+                 stations=None, neighbourhood=0):
+        """
+        Compute cache key of one year of a derived variable
+
+        Parameters
+        ----------
+        var : str
+            Variable name.
+        year : int
+            Year.
+        data_freq : str
+            Time frequency of model file, e.g. 'day'.
+        calculate_how : dict
+            Dict with "req_vars" and "function", see read_mods.read_model.
+        filepath : str
+            Path to model file. Its mtime and size are part of the key.
+        stations : pandas.DataFrame, optional
+            Station locations, if station time series are cached.
+        neighbourhood : int, optional
+            Neighbourhood used for station extraction.
+
+        Returns
+        -------
+        str
+            Key (hex digest).
+        dict
+            Content the key was computed from.
+        """
+        stat = os.stat(filepath)
+        func = calculate_how['function']
+        content = {'var': var,
+                   'year': int(year),
+                   'data_freq': data_freq,
+                   'req_vars': list(calculate_how['req_vars']),
+                   'function': f'{func.__module__}.{func.__qualname__}',
+                   'function_source': _source_hash(func),
+                   'version': CACHE_VERSION,
+                   'filepath': os.path.abspath(filepath),
+                   'mtime': stat.st_mtime,
+                   'size': stat.st_size}
+        if stations is not None:
+            content['latitude'] = [float(x) for x in stations['latitude']]
+            content['longitude'] = [float(x) for x in stations['longitude']]
+            content['neighbourhood'] = int(neighbourhood)
+        key = hashlib.sha1(json.dumps(content, sort_keys=True).encode())
+        return key.hexdigest(), content
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, f'{key}{ext}')
+
+    def _find(self, key):
+        for ext in ['.npz', '.nc']:
+            path = self._path(key, ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def load(self, key):
+        """
+        Load a cache entry
+
+        Returns
+        -------
+        tuple or iris.cube.Cube or None
+            (times, values, var_name, units) for station entries, a cube for
+            full-domain entries, or None if there is no entry for key.
+        """
+        path = self._find(key)
+        if path is None:
+            return None
+        # update access time for LRU eviction
+        os.utime(path)
+        if path.endswith('.npz'):
+            with np.load(path) as npz:
+                return (pd.DatetimeIndex(npz['times']), npz['values'],
+                        str(npz['var_name']), str(npz['units']))
+        import iris
+        return iris.load_cube(path)
+
+    def save(self, key, content, data):
+        """
+        Save a cache entry
+
+        Parameters
+        ----------
+        key : str
+            Key from make_key.
+        content : dict
+            Content from make_key, stored next to the entry for inspection.
+        data : tuple or iris.cube.Cube
+            See load.
+        """
+        if isinstance(data, tuple):
+            path = self._path(key, '.npz')
+            tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+            times, values, var_name, units = data
+            np.savez(tmp_path, times=np.asarray(times, dtype='datetime64[ns]'),
+                     values=values, var_name=var_name, units=str(units))
+        else:
+            import iris
+            path = self._path(key, '.nc')
+            tmp_path = f'{path}.{os.getpid()}.tmp.nc'
+            # netCDF attributes are strings or numbers, pyaerocom also adds
+            # bools (e.g. "computed") and objects (e.g. "reader")
+            data = data.copy(data=data.core_data())
+            for name, value in data.attributes.items():
+                if isinstance(value, (bool, np.bool_)):
+                    data.attributes[name] = int(value)
+                elif not isinstance(value, (str, int, float, np.number,
+                                            np.ndarray)):
+                    data.attributes[name] = str(value)
+            iris.save(data, tmp_path, zlib=True)
+        with open(f'{tmp_path}.json', 'w') as f:
+            json.dump(content, f)
+        # atomic, so that parallel workers never see partial entries
+        os.replace(f'{tmp_path}.json', self._path(key, '.json'))
+        os.replace(tmp_path, path)
+
+    def entries(self):
+        """
+        List all cache entries
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per entry, with key, size, last access time and the
+            content the key was computed from. Sorted by last access.
+        """
+        rows = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            key = os.path.basename(path)[:-len('.json')]
+            datapath = self._find(key)
+            if datapath is None:
+                continue
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+                stat = os.stat(datapath)
+            except (OSError, ValueError):
+                # removed or being written by another process
+                continue
+            rows.append({'key': key,
+                         'var': content['var'],
+                         'year': content['year'],
+                         'data_freq': content['data_freq'],
+                         'stations': len(content.get('latitude', [])),
+                         'size_mb': (stat.st_size + os.path.getsize(path)) / 1e6,
+                         'last_access': pd.Timestamp(stat.st_mtime, unit='s'),
+                         'filepath': content['filepath']})
+        columns = ['key', 'var', 'year', 'data_freq', 'stations', 'size_mb',
+                   'last_access', 'filepath']
+        entries = pd.DataFrame(rows, columns=columns)
+        return entries.sort_values('last_access').reset_index(drop=True)
+
+    def remove(self, key):
+        """Remove a cache entry (if it exists)"""
+        for ext in ['.npz', '.nc', '.json']:
+            try:
+                os.remove(self._path(key, ext))
+            except FileNotFoundError:
+                pass
+
+    def purge(self, var=None):
+        """
+        Remove all cache entries, or all entries of one variable
+
+        Returns
+        -------
+        int
+            Number of removed entries.
+        """
+        entries = self.entries()
+        if var is not None:
+            entries = entries[entries['var'] == var]
+        for key in entries['key']:
+            self.remove(key)
+        return len(entries)
+
+    def evict(self, max_size_gb=None):
+        """
+        Remove least recently used entries until the cache fits max_size_gb
+
+        Returns
+        -------
+        int
+            Number of removed entries.
+        """
+        if max_size_gb is None:
+            max_size_gb = self.max_size_gb
+        entries = self.entries()
+        size_mb = entries['size_mb'].sum()
+        removed = 0
+        for key, entry_mb in zip(entries['key'], entries['size_mb']):
+            if size_mb <= max_size_gb * 1e3:
+                break
+            self.remove(key)
+            size_mb -= entry_mb
+            removed += 1
+        return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Inspect or purge the cache of derived model data')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info', help='list cache entries')
+    purge_parser = subparsers.add_parser('purge', help='remove cache entries')
+    purge_parser.add_argument('--var', default=None,
+                              help='only remove entries of this variable')
+    evict_parser = subparsers.add_parser(
+        'evict', help='remove least recently used entries')
+    evict_parser.add_argument('--max-size-gb', type=float, default=MAX_SIZE_GB)
+    args = parser.parse_args()
+
+    cache = ModelCache(args.cache_dir)
+    if args.command == 'info':
+        entries = cache.entries()
+        with pd.option_context('display.max_rows', None,
+                               'display.width', None):
+            print(entries.drop(columns='key'))
+        print(f'{len(entries)} entries, {entries["size_mb"].sum():.1f} MB '
+              f'in {cache.cache_dir}')
+    elif args.command == 'purge':
+        print(f'Removed {cache.purge(args.var)} entries')
+    elif args.command == 'evict':
+        print(f'Removed {cache.evict(args.max_size_gb)} entries')
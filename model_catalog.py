@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Catalog of EMEP model output files
+
+The model run directories are scanned once and the metadata of each annual
+Base_{data_freq}.nc file (year, frequency, variables and their units, grid,
+time axis and calendar) is stored in a small JSON index. Model files can
+then be looked up without opening them (ModelCatalog.get_modelfile can be
+used as getfile in read_mods.read_model, or the catalog passed to it), and
+missing variables and unexpected or inconsistent units are detected before
+a long run starts.
+
+Usage:
+    python model_catalog.py [--index FILE] build [--freqs hour day month]
+    python model_catalog.py [--index FILE] show
+"""
+import os, json, argparse
+import xarray as xr
+import cf_units
+import pyaerocom as pya
+from pyaerocom.units_helpers import UALIASES
+
+from read_mods import (MODEL_RUN_DIRS, MODEL_DATA_FREQS, get_modelfile,
+                       model_var_names)
+
+CATALOG_FILE = 'model_catalog.json'
+
+
+def scan_modelfile(filepath, year, data_freq):
+    """
+    Read metadata of one model file
+
+    Parameters
+    ----------
+    filepath : str
+        Path to model file.
+    year : int
+        Year of the model run.
+    data_freq : str
+        Time frequency of the file, e.g. 'day'.
+
+    Returns
+    -------
+    dict
+        Metadata of the file.
+    """
+    stat = os.stat(filepath)
+    with xr.open_dataset(filepath, decode_times=False) as ds:
+        time = ds['time']
+        grid = {dim: int(ds.sizes[dim]) for dim in ds.dims if dim != 'time'}
+        for coord in ['lat', 'lon']:
+            if coord in ds.coords and ds[coord].ndim == 1:
+                vals = ds[coord].values
+                grid[f'{coord}_range'] = [float(vals[0]), float(vals[-1])]
+        variables = {name: {'units': str(ds[name].attrs.get('units', '')),
+                            'dims': list(ds[name].dims)}
+                     for name in ds.data_vars}
+        return {'path': os.path.abspath(filepath),
+                'year': int(year),
+                'data_freq': data_freq,
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'grid': grid,
+                'time': {'size': int(time.size),
+                         'units': str(time.attrs.get('units', '')),
+                         'calendar': str(time.attrs.get('calendar', 'standard')),
+                         'first': float(time.values[0]),
+                         'last': float(time.values[-1])},
+                'variables': variables}
+
+
+class ModelCatalog(object):
+    """
+    Index of model files with their metadata
+
+    Parameters
+    ----------
+    entries : dict, optional
+        Metadata of each file (see scan_modelfile), with keys
+        "{year}_{data_freq}".
+    """
+    def __init__(self, entries=None):
+        if entries is None:
+            entries = {}
+        self.entries = entries
+
+    @staticmethod
+    def _key(year, data_freq):
+        return f'{int(year)}_{data_freq}'
+
+    @classmethod
+    def build(cls, getfile=get_modelfile, years=MODEL_RUN_DIRS,
+              data_freqs=MODEL_DATA_FREQS, previous=None):
+        """
+        Scan model files and build catalog
+
+        Parameters
+        ----------
+        getfile : function (int, str) -> str, optional
+            See read_mods.read_model. Default is read_mods.get_modelfile.
+        years : iterable of int, optional
+            Years to scan. Default is all years in read_mods.MODEL_RUN_DIRS.
+        data_freqs : list, optional
+            Frequencies to scan. Files that do not exist are skipped.
+        previous : ModelCatalog, optional
+            Entries of files that have not changed (same mtime and size) are
+            taken from this catalog instead of reopening the files.
+
+        Returns
+        -------
+        ModelCatalog
+        """
+        entries = {}
+        for year in years:
+            for data_freq in data_freqs:
+                filepath = getfile(year, data_freq)
+                if not os.path.exists(filepath):
+                    continue
+                key = cls._key(year, data_freq)
+                if previous is not None and key in previous.entries:
+                    entry = previous.entries[key]
+                    stat = os.stat(filepath)
+                    if (entry['path'] == os.path.abspath(filepath)
+                            and entry['mtime'] == stat.st_mtime
+                            and entry['size'] == stat.st_size):
+                        entries[key] = entry
+                        continue
+                print(f'Scanning {filepath}')
+                entries[key] = scan_modelfile(filepath, year, data_freq)
+        return cls(entries)
+
+    @classmethod
+    def load(cls, filepath=CATALOG_FILE):
+        """Load catalog from JSON index file"""
+        with open(filepath) as f:
+            return cls(json.load(f))
+
+    def save(self, filepath=CATALOG_FILE):
+        """Save catalog to JSON index file"""
+        with open(filepath, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+
+    def get_entry(self, year, data_freq):
+        """
+        Get metadata of the model file of a year and frequency
+
+        Raises
+        ------
+        ValueError
+            If the catalog has no such file.
+        """
+        try:
+            return self.entries[self._key(year, data_freq)]
+        except KeyError:
+            raise ValueError(f'No {data_freq} model data for year {year} in '
+                             f'catalog')
+
+    def get_modelfile(self, year, data_freq):
+        """
+        Function to use as input argument 'getfile' in function read_model
+        """
+        return self.get_entry(year, data_freq)['path']
+
+    def check(self, var_list, var_info, start_yr, stop_yr, calc_how={}):
+        """
+        Check that all variables needed for a run are in the model files
+
+        Verifies, without opening any files, that the model files exist for
+        all years, that they contain all raw fields needed to compute the
+        variables, that each raw field has the same units in all years and
+        that these can be converted to the units of the field in pyaerocom.
+        For variables that are read without derivation, the units of the
+        variable in pyaerocom must be the expected units in var_info.
+
+        Parameters
+        ----------
+        var_list : list
+            Variables to be read (in pyaerocom).
+        var_info : dict
+            See read_mods.read_model. Needs "data_freq" for each variable,
+            and "units" for the expected units (e.g. EMEP_VAR_UNITS).
+        start_yr, stop_yr : str or int
+            Years as in read_mods.read_model (stop_yr is not included).
+        calc_how : dict, optional
+            See read_mods.read_model.
+
+        Raises
+        ------
+        ValueError
+            Listing all problems found.
+        """
+        errors = []
+        for var in var_list:
+            req_vars = calc_how.get(var, {'req_vars': [var]})['req_vars']
+            data_freq = var_info[var]['data_freq']
+            expected = var_info[var].get('units')
+            if var not in calc_how and expected is not None:
+                units = pya.const.VARS[var].units
+                if cf_units.Unit(units) != cf_units.Unit(expected):
+                    errors.append(f'{var}: is read in units {units}, '
+                                  f'expected are {expected}')
+            try:
+                names = {req_var: model_var_names([req_var])
+                         for req_var in req_vars}
+            except ValueError as e:
+                errors.append(f'{var}: {e}')
+                continue
+            units = {}
+            for year in range(int(start_yr), int(stop_yr)):
+                try:
+                    entry = self.get_entry(year, data_freq)
+                except ValueError as e:
+                    errors.append(f'{var}: {e}')
+                    continue
+                for req_var, req_names in names.items():
+                    for name in req_names:
+                        if name not in entry['variables']:
+                            errors.append(f'{var}: {name} missing in '
+                                          f'{entry["path"]}')
+                            continue
+                        units.setdefault((req_var, name), set()).add(
+                            entry['variables'][name]['units'])
+            for (req_var, name), name_units in units.items():
+                if len(name_units) > 1:
+                    errors.append(f'{var}: {name} has different units in '
+                                  f'different years: {sorted(name_units)}')
+                elif len(names[req_var]) == 1:
+                    # read directly, converted to the units in pyaerocom
+                    error = self._check_units(name, name_units.pop(), req_var,
+                                              var_info)
+                    if error is not None:
+                        errors.append(f'{var}: {error}')
+        if len(errors) > 0:
+            raise ValueError('Model data check failed:\n' + '\n'.join(errors))
+
+    @staticmethod
+    def _check_units(name, units, req_var, var_info):
+        """Check that a raw field can be converted to its pyaerocom units"""
+        units = UALIASES.get(units, units)
+        if units in ['', 'unknown'] and req_var in var_info:
+            # see read_mods.read_model
+            units = var_info[req_var]['units']
+        to_unit = pya.const.VARS[req_var].units
+        try:
+            convertible = cf_units.Unit(units).is_convertible(to_unit)
+        except ValueError:
+            return f'{name} has invalid units {units}'
+        if not convertible:
+            return (f'{name} has units {units}, which can not be converted '
+                    f'to {to_unit} ({req_var})')
+        return None
+
+    def summary(self):
+        """
+        Overview of the catalog, one line per file
+
+        Returns
+        -------
+        list of str
+        """
+        lines = []
+        for key in sorted(self.entries):
+            entry = self.entries[key]
+            grid = ' x '.join(f'{dim}={n}' for dim, n in entry['grid'].items()
+                              if not dim.endswith('_range'))
+            lines.append(f'{entry["year"]} {entry["data_freq"]:5s} '
+                         f'ntime={entry["time"]["size"]:5d} '
+                         f'{entry["time"]["calendar"]:19s} {grid} '
+                         f'nvars={len(entry["variables"])} {entry["path"]}')
+        return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalog of EMEP model files')
+    parser.add_argument('--index', default=CATALOG_FILE,
+                        help='catalog index file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser(
+        'build', help='scan model files (only new or changed files are opened)')
+    build_parser.add_argument('--freqs', nargs='+', default=MODEL_DATA_FREQS)
+    subparsers.add_parser('show', help='print catalog')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        previous = None
+        if os.path.exists(args.index):
+            previous = ModelCatalog.load(args.index)
+        catalog = ModelCatalog.build(data_freqs=args.freqs, previous=previous)
+        catalog.save(args.index)
+        print(f'{len(catalog.entries)} model files in {args.index}')
+    elif args.command == 'show':
+        catalog = ModelCatalog.load(args.index)
+        print('\n'.join(catalog.summary()))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming O3 metrics (daily maxima and yearly percentiles) of hourly model
+data
+
+Hourly model output (Base_hour.nc) of all years and the full grid does not
+fit into memory with read_mods.read_model. iter_daily_max reads the hourly
+files of several years as one stream, a few days at a time, and yields the
+daily maxima (as resample_time with how dict(daily=dict(hourly='max')) and
+the same minimum number of hours per day). A day that is split between two
+files (e.g. the 00:00 time step of the next year) is completed with the
+hours of the next file.
+
+Daily maxima at stations (station_daily_max) are small and the yearly
+percentiles are computed exactly from the daily series with
+resample_batch.resample_percentiles, as for the observations in
+calc_obstrends_o3.py. For gridded output (grid_percentiles), the daily
+maxima of one year are kept in a buffer (in memory or in a scratch
+directory) and the exact percentiles are computed in tiles of grid rows, so
+that memory does not grow with the number of years.
+"""
+import os, shutil, tempfile, warnings
+import numpy as np
+import pandas as pd
+import xarray as xr
+import cf_units
+import pyaerocom as pya
+from pyaerocom.units_helpers import UALIASES
+
+from read_mods import DEFAULT_MEMORY_BUDGET_MB, model_var_names
+from station_index import StationIndex
+
+
+def _hourly_name(var):
+    """Name of a model variable in the hourly files"""
+    names = model_var_names([var])
+    if len(names) > 1:
+        raise ValueError(f'{var} is derived from {names}, only variables '
+                         f'that are in the model files are supported')
+    return names[0]
+
+
+def _hours_per_chunk(arr, memory_budget_mb):
+    """Number of time steps of a variable that fit into the budget"""
+    field_size = max(arr.size // arr.sizes['time'], 1)
+    return max(int(memory_budget_mb * 1e6 // (field_size * 8)), 1)
+
+
+def _iter_hourly(var, getfile, years, select=None,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Read hourly model data of several years in chunks of whole days
+
+    Yields
+    ------
+    pandas.DatetimeIndex
+        Time stamps of the chunk.
+    numpy.ndarray
+        Values (time, lat, lon), or the output of select for these.
+    """
+    name = _hourly_name(var)
+    to_unit = pya.const.VARS[var].units
+    for year in years:
+        with xr.open_dataset(getfile(year, 'hour')) as ds:
+            arr = ds[name]
+            if not ('lat' in arr.dims and 'lon' in arr.dims):
+                raise ValueError(f'Hourly O3 metrics need a regular lat/lon '
+                                 f'grid, {name} has dimensions {arr.dims}')
+            arr = arr.transpose('time', 'lat', 'lon')
+            times = arr.indexes['time']
+            if not isinstance(times, pd.DatetimeIndex):
+                times = times.to_datetimeindex()
+            units = arr.attrs['units']
+            units = cf_units.Unit(UALIASES.get(units, units))
+            # chunks end at day boundaries (at least one day per chunk)
+            day_starts = np.flatnonzero(np.diff(times.floor('D').asi8,
+                                                prepend=-1))
+            max_hours = max(_hours_per_chunk(arr, memory_budget_mb), 24)
+            i0 = 0
+            while i0 < len(times):
+                ends = day_starts[day_starts > i0]
+                ends = np.append(ends, len(times))
+                fit = ends[ends - i0 <= max_hours]
+                i1 = fit[-1] if len(fit) > 0 else ends[0]
+                values = arr.isel(time=slice(i0, i1)).values
+                if units != to_unit:
+                    values = units.convert(values.astype(np.float64), to_unit)
+                if select is not None:
+                    values = select(values)
+                yield times[i0:i1], values
+                i0 = i1
+
+
+def iter_daily_max(var, getfile, years, min_num_obs, select=None,
+                   memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Daily maxima of hourly model data, a few days at a time
+
+    Parameters
+    ----------
+    var : str
+        Variable name (in pyaerocom), e.g. 'vmro3'.
+    getfile : function (int, str) -> str
+        See read_mods.read_model (data_freq 'hour' is used).
+    years : iterable of int
+        Years to read.
+    min_num_obs : dict
+        Resampling constraints, the minimum number of hours per day is
+        min_num_obs['daily']['hourly'] (e.g. 18).
+    select : function, optional
+        Function applied to each chunk of hourly values (time, lat, lon)
+        before the daily maxima are computed, e.g. StationIndex.gather.
+    memory_budget_mb : float, optional
+        Approximate size in MB of one chunk of hourly values.
+
+    Yields
+    ------
+    pandas.DatetimeIndex
+        Days (midnight time stamps) of the years.
+    numpy.ndarray
+        Daily maxima (day, ...), NaN for days with less valid hours.
+    """
+    years = list(years)
+    min_hours = min_num_obs['daily']['hourly']
+    # hours of the last day of the previous chunk, which may continue
+    pending_times, pending = None, None
+    for times, values in _iter_hourly(var, getfile, years, select,
+                                      memory_budget_mb):
+        if pending is not None:
+            times = pending_times.append(times)
+            values = np.concatenate([pending, values])
+        days = times.floor('D')
+        last = days.searchsorted(days[-1])
+        pending_times, pending = times[last:], values[last:]
+        if last > 0:
+            yield _daily_max(days[:last], values[:last], min_hours, years)
+    if pending is not None:
+        yield _daily_max(pending_times.floor('D'), pending, min_hours, years)
+
+
+def _daily_max(days, values, min_hours, years):
+    """Max. of the hourly values of each day (days sorted) in years"""
+    starts = np.flatnonzero(np.diff(days.asi8, prepend=days.asi8[0] - 1))
+    maxima = np.fmax.reduceat(values, starts, axis=0)
+    counts = np.add.reduceat(~np.isnan(values), starts, axis=0)
+    maxima = np.where(counts < max(min_hours, 1), np.nan, maxima)
+    # e.g. the first time step of the next year at the end of a file
+    keep = np.isin(days[starts].year, years)
+    return days[starts][keep], maxima[keep]
+
+
+def _grid_coords(var, getfile, year):
+    """Latitudes and longitudes of the hourly model grid"""
+    with xr.open_dataset(getfile(year, 'hour')) as ds:
+        arr = ds[_hourly_name(var)]
+        return arr['lat'].values, arr['lon'].values
+
+
+def station_daily_max(var, getfile, years, stations, min_num_obs,
+                      memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                      index_dir=None):
+    """
+    Daily maxima of hourly model data at stations
+
+    Parameters
+    ----------
+    var, getfile, years, min_num_obs, memory_budget_mb
+        See iter_daily_max.
+    stations : pandas.DataFrame
+        Station locations, with columns "latitude" and "longitude" (e.g. the
+        content of a sitemeta file).
+    index_dir : str, optional
+        Directory of the stored station indices, see
+        station_index.StationIndex.load_or_build.
+
+    Returns
+    -------
+    list
+        pandas.Series of daily maxima for each row in stations.
+    """
+    years = list(years)
+    grid_lats, grid_lons = _grid_coords(var, getfile, years[0])
+    index = StationIndex.load_or_build(grid_lats, grid_lons,
+                                       stations['latitude'].values,
+                                       stations['longitude'].values,
+                                       index_dir=index_dir)
+    days, values = [], []
+    for chunk_days, chunk in iter_daily_max(var, getfile, years, min_num_obs,
+                                            index.gather, memory_budget_mb):
+        days.append(chunk_days)
+        values.append(np.asarray(chunk, dtype=np.float64))
+    days = pd.DatetimeIndex(np.concatenate([d.values for d in days]))
+    values = np.concatenate(values)
+    return [pd.Series(values[:, i], index=days, name=var)
+            for i in range(len(stations))]
+
+
+def _year_percentiles(buffer, percentiles, min_days, memory_budget_mb):
+    """Percentiles of the daily maxima of each cell, in tiles of rows"""
+    num_days, ny, nx = buffer.shape
+    rows = max(int(memory_budget_mb * 1e6 // (num_days * nx * 8)), 1)
+    result = np.full((len(percentiles), ny, nx), np.nan)
+    for y0 in range(0, ny, rows):
+        tile = np.asarray(buffer[:, y0:y0 + rows], dtype=np.float64)
+        counts = np.sum(~np.isnan(tile), axis=0)
+        with warnings.catch_warnings():
+            # cells without valid days
+            warnings.simplefilter('ignore', RuntimeWarning)
+            values = np.nanpercentile(tile, percentiles, axis=0)
+        values[:, counts < max(min_days, 1)] = np.nan
+        result[:, y0:y0 + rows] = values
+    return result
+
+
+def grid_percentiles(var, getfile, years, percentiles, min_num_obs,
+                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                     scratch_dir=None):
+    """
+    Yearly percentiles of the daily maxima of hourly model data on the grid
+
+    Same as the yearly percentiles of the stations, i.e. the percentiles of
+    the daily maxima of each year if at least min_num_obs['yearly']['daily']
+    days are valid.
+
+    Parameters
+    ----------
+    var, getfile, years, min_num_obs, memory_budget_mb
+        See iter_daily_max.
+    percentiles : list
+        Percentiles, e.g. PERECENTILES in calc_obstrends_o3.py.
+    scratch_dir : str, optional
+        Directory (e.g. on a local disk) where the daily maxima of the year
+        being processed are buffered. Default is to keep them in memory.
+
+    Yields
+    ------
+    int
+        Year.
+    xarray.DataArray
+        Percentiles of the year, dimensions (percentile, lat, lon).
+    """
+    years = list(years)
+    min_days = min_num_obs['yearly']['daily']
+    grid_lats, grid_lons = _grid_coords(var, getfile, years[0])
+    # NaN on Dec 31 of years with 365 days
+    shape = (366, len(grid_lats), len(grid_lons))
+
+    def new_buffer():
+        if scratch_dir is None:
+            return np.full(shape, np.nan, dtype=np.float32), None
+        tmp_dir = tempfile.mkdtemp(prefix=f'{var}_daily_max_', dir=scratch_dir)
+        buffer = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, 'daily_max.npy'), mode='w+',
+            dtype=np.float32, shape=shape)
+        buffer[:] = np.nan
+        return buffer, tmp_dir
+
+    def finish(year, buffer, tmp_dir):
+        values = _year_percentiles(buffer, percentiles, min_days,
+                                   memory_budget_mb)
+        del buffer
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return year, xr.DataArray(values, name=var,
+                                  dims=('percentile', 'lat', 'lon'),
+                                  coords={'percentile': list(percentiles),
+                                          'lat': grid_lats,
+                                          'lon': grid_lons})
+
+    year, buffer, tmp_dir = None, None, None
+    for days, maxima in iter_daily_max(var, getfile, years, min_num_obs,
+                                       memory_budget_mb=memory_budget_mb):
+        for day_year in np.unique(days.year):
+            if day_year != year:
+                if buffer is not None:
+                    yield finish(year, buffer, tmp_dir)
+                year = day_year
+                buffer, tmp_dir = new_buffer()
+            in_year = days.year == year
+            buffer[days[in_year].dayofyear - 1] = maxima[in_year]
+    if buffer is not None:
+        yield finish(year, buffer, tmp_dir)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local cache of filtered EBAS observations
+
+Parsing the EBAS NASA-Ames files is the slowest part of the observation
+processing. This cache stores the filtered UngriddedData of each variable
+(pickled) together with the list of EBAS files it was read from and their
+mtime and size. Entries are keyed by data_id, variable, filter settings, EBAS
+data directory and pyaerocom version. When files are added, changed or
+removed, only these files are (re)read and the entry is updated, all other
+data is taken from the cache.
+
+This works since all filters used here (meta data filters, set_flags_nan,
+remove_outliers) act on each file separately.
+
+Usage:
+    python obs_cache.py [--cache-dir DIR] info
+    python obs_cache.py [--cache-dir DIR] purge [--var VAR]
+"""
+import os, glob, json, pickle, hashlib, argparse
+import pandas as pd
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'emep_trends',
+                         'obs')
+
+
+def ebas_file_set(reader, var):
+    """
+    Names, mtime and size of the EBAS files containing a variable
+
+    Parameters
+    ----------
+    reader : pyaerocom.io.ReadEbas
+        Low level EBAS reader, e.g. oreader.get_lowlevel_reader('EBASMC').
+    var : str
+        Variable name (in pyaerocom).
+
+    Returns
+    -------
+    dict
+        [mtime, size] for each file name.
+    """
+    files = {}
+    for path in reader.get_file_list(var):
+        stat = os.stat(path)
+        files[os.path.basename(path)] = [stat.st_mtime, stat.st_size]
+    return files
+
+
+class EbasCache(object):
+    """
+    Cache of filtered EBAS data, one entry per variable and filter settings
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader used to read EBAS files that are not in the cache.
+    data_id : str
+        ID of the EBAS dataset, e.g. 'EBASMC'.
+    cache_dir : str, optional
+        Directory where the cache entries are stored.
+    """
+    def __init__(self, oreader, data_id, cache_dir=CACHE_DIR):
+        self.oreader = oreader
+        self.data_id = data_id
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def reader(self):
+        """Low level reader of the EBAS files (pyaerocom.io.ReadEbas)"""
+        return self.oreader.get_lowlevel_reader(self.data_id)
+
+    def make_key(self, var, filters):
+        """
+        Compute cache key of a variable and filter settings
+
+        Returns
+        -------
+        str
+            Key (hex digest).
+        dict
+            Content the key was computed from.
+        """
+        import pyaerocom as pya
+        content = {'data_id': self.data_id,
+                   'var': var,
+                   'filters': filters,
+                   'file_dir': self.reader.file_dir,
+                   'pyaerocom': pya.__version__}
+        key = hashlib.sha1(json.dumps(content, sort_keys=True,
+                                      default=str).encode())
+        return key.hexdigest(), content
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, f'{key}{ext}')
+
+    def file_set(self, var):
+        """Names, mtime and size of the EBAS files containing var"""
+        return ebas_file_set(self.reader, var)
+
+    def _read_files(self, var, filenames, filters):
+        """Read and filter var from some EBAS files"""
+        from pyaerocom import UngriddedData
+        from pyaerocom.exceptions import DataExtractionError
+        reader = self.reader
+        paths = [os.path.join(reader.file_dir, name) for name in filenames]
+        data = reader.read(vars_to_retrieve=var, files=paths)
+        if data.is_empty:
+            return data
+        try:
+            return data.apply_filters(**filters)
+        except DataExtractionError:
+            # no data passes the filters
+            return UngriddedData()
+
+    def has_entry(self, var, filters):
+        """Check if there is an entry for var and filters (possibly outdated)"""
+        key, _ = self.make_key(var, filters)
+        return os.path.exists(self._path(key, '.pkl'))
+
+    def save(self, var, filters, data, files):
+        """
+        Store filtered data of a variable
+
+        Parameters
+        ----------
+        var : str
+            Variable name (in pyaerocom).
+        filters : dict
+            Filters that were applied to data.
+        data : pyaerocom.UngriddedData
+            Filtered data of var.
+        files : dict
+            Names, mtime and size of the EBAS files data was read from, as
+            returned by file_set (which must be called before reading).
+        """
+        key, content = self.make_key(var, filters)
+        content['files'] = files
+        tmp_path = f'{self._path(key, ".pkl")}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(f'{tmp_path}.json', 'w') as f:
+            json.dump(content, f, default=str)
+        os.replace(f'{tmp_path}.json', self._path(key, '.json'))
+        os.replace(tmp_path, self._path(key, '.pkl'))
+
+    def read(self, var, filters):
+        """
+        Read filtered data of a variable, from the cache where possible
+
+        Equivalent to oreader.read(data_id, var).apply_filters(**filters).
+
+        Parameters
+        ----------
+        var : str
+            Variable name (in pyaerocom).
+        filters : dict
+            Input to UngriddedData.apply_filters, e.g. EBAS_BASE_FILTERS.
+
+        Returns
+        -------
+        pyaerocom.UngriddedData
+            Filtered data.
+        """
+        from pyaerocom import UngriddedData
+        from pyaerocom.exceptions import DataExtractionError
+
+        key, _ = self.make_key(var, filters)
+        files = self.file_set(var)
+
+        data = UngriddedData()
+        cached_files = {}
+        if os.path.exists(self._path(key, '.pkl')):
+            with open(self._path(key, '.json')) as f:
+                cached_files = json.load(f)['files']
+            with open(self._path(key, '.pkl'), 'rb') as f:
+                data = pickle.load(f)
+
+        stale = [name for name in cached_files if files.get(name) !=
+                 cached_files[name]]
+        new = [name for name in files if files[name] !=
+               cached_files.get(name)]
+        if len(stale) == 0 and len(new) == 0:
+            print(f'Loaded {var} from EBAS cache ({len(files)} files)')
+            return data
+        removed = [name for name in cached_files if name not in files]
+        print(f'Updating EBAS cache of {var}: reading {len(new)} new or '
+              f'changed files, {len(removed)} files removed, '
+              f'{len(files) - len(new)} files unchanged')
+
+        if len(stale) > 0 and not data.is_empty:
+            try:
+                data = data.filter_by_meta(negate=['filename'], filename=stale)
+            except DataExtractionError:
+                # all cached data is from stale files
+                data = UngriddedData()
+        if len(new) > 0:
+            data = data.merge(self._read_files(var, new, filters))
+
+        self.save(var, filters, data, files)
+        return data
+
+    def entries(self):
+        """
+        List all cache entries
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per entry, with key, variable, filters, number of files
+            and size.
+        """
+        rows = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            key = os.path.basename(path)[:-len('.json')]
+            datapath = self._path(key, '.pkl')
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+                size = os.path.getsize(datapath) + os.path.getsize(path)
+            except (OSError, ValueError):
+                continue
+            rows.append({'key': key,
+                         'data_id': content['data_id'],
+                         'var': content['var'],
+                         'filters': str(content['filters']),
+                         'files': len(content['files']),
+                         'size_mb': size / 1e6})
+        columns = ['key', 'data_id', 'var', 'filters', 'files', 'size_mb']
+        return pd.DataFrame(rows, columns=columns)
+
+    def purge(self, var=None):
+        """
+        Remove all cache entries, or all entries of one variable
+
+        Returns
+        -------
+        int
+            Number of removed entries.
+        """
+        entries = self.entries()
+        if var is not None:
+            entries = entries[entries['var'] == var]
+        for key in entries['key']:
+            for ext in ['.pkl', '.json']:
+                try:
+                    os.remove(self._path(key, ext))
+                except FileNotFoundError:
+                    pass
+        return len(entries)
+
+
+def read_ebas_vars(oreader, data_id, var_list, filters, cache=None):
+    """
+    Read several EBAS variables in one pass over the EBAS files
+
+    All variables are read with one call of the reader, so that each EBAS
+    file is parsed once, even if it contains several of the variables (e.g.
+    the different nitrate and ammonium species). The filters are applied
+    once to the combined data, which is then split into one UngriddedData
+    per variable.
+
+    Parameters
+    ----------
+    oreader : pyaerocom.io.ReadUngridded
+        Reader.
+    data_id : str
+        ID of the EBAS dataset, e.g. 'EBASMC'.
+    var_list : list
+        Variable names (in pyaerocom). Duplicates are ignored.
+    filters : dict
+        Input to UngriddedData.apply_filters, e.g. EBAS_BASE_FILTERS.
+    cache : EbasCache, optional
+        If provided, variables that are already in the cache are updated
+        incrementally (see EbasCache.read) and only the other variables are
+        read in the shared pass, and then added to the cache.
+
+    Returns
+    -------
+    dict
+        Filtered pyaerocom.UngriddedData for each variable. Variables without
+        any data after filtering are missing.
+    """
+    from pyaerocom.exceptions import DataExtractionError
+
+    var_list = list(dict.fromkeys(var_list))
+    result = {}
+    to_read = var_list
+    if cache is not None:
+        to_read = [var for var in var_list
+                   if not cache.has_entry(var, filters)]
+        for var in var_list:
+            if var not in to_read:
+                result[var] = cache.read(var, filters)
+        # before reading, so that files changed meanwhile are updated later
+        files = {var: cache.file_set(var) for var in to_read}
+    if len(to_read) == 0:
+        return result
+
+    print(f'Reading {to_read} from {data_id}')
+    data = oreader.read(data_id, vars_to_retrieve=to_read)
+    try:
+        data = data.apply_filters(**filters)
+    except DataExtractionError:
+        return result
+    for var in to_read:
+        if var not in data.contains_vars:
+            print(f'No {data_id} data for {var} after filtering')
+            continue
+        result[var] = data.extract_var(var)
+        if cache is not None:
+            cache.save(var, filters, result[var], files[var])
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Inspect or purge the cache of filtered EBAS data')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info', help='list cache entries')
+    purge_parser = subparsers.add_parser('purge', help='remove cache entries')
+    purge_parser.add_argument('--var', default=None,
+                              help='only remove entries of this variable')
+    args = parser.parse_args()
+
+    # entries and purge do not need a reader
+    cache = EbasCache(None, None, args.cache_dir)
+    if args.command == 'info':
+        entries = cache.entries()
+        with pd.option_context('display.max_rows', None,
+                               'display.width', None):
+            print(entries.drop(columns='key'))
+        print(f'{len(entries)} entries, {entries["size_mb"].sum():.1f} MB '
+              f'in {cache.cache_dir}')
+    elif args.command == 'purge':
+        print(f'Removed {cache.purge(args.var)} entries')
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated output of the trend scripts
+
+The scripts write one csv file per site (data_{var}/data_{var}_{site}_{tst}.csv)
+and per site, period and season ({var}_{site}_{start}-{stop}_{seas}_yearly.csv),
+tens of thousands of small files whose creation (and later reading) is
+dominated by per-file overhead on lustre. With format 'parquet', OutputStore
+collects these series and writes all of them into one Parquet file per
+variable (data_{var}.parquet), in long format with one row per value and
+the columns
+
+    file, kind, station_id, ts_type, period, season, percentile, time, value
+
+sorted by station, period and season, so that single sites can be read
+with filters. The trend table and the site metadata are written to
+trends_{var}.parquet and sitemeta_{var}.parquet. With format 'csv' the
+legacy csv files are written, and export_csv regenerates them from the
+Parquet files.
+
+The csv files can be written in the background by a BackgroundWriter, so
+that the site loops do not wait for the filesystem. Writes are collected in
+batches, which are written by a pool of threads; the number of batches
+waiting to be written is bounded, so that memory stays bounded if the
+filesystem is slower than the computation. OutputStore.close waits until
+all files of the variable are written and raises the first error.
+
+Parquet needs pyarrow (or fastparquet), which is only imported when the
+format is used.
+
+Usage:
+    python output_store.py export OUTPUT_DIR [--var VAR ...] [--csv-dir DIR]
+    python output_store.py info OUTPUT_DIR [--var VAR ...]
+"""
+import os, glob, argparse, threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import pandas as pd
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+# key columns of the data table (see OutputStore.write_series)
+KEY_COLUMNS = ['station_id', 'ts_type', 'period', 'season', 'percentile']
+
+TABLES = ['trends', 'sitemeta']
+
+
+def _run_batch(batch):
+    for func, args in batch:
+        func(*args)
+
+
+class BackgroundWriter(object):
+    """
+    Write files in background threads
+
+    Parameters
+    ----------
+    num_threads : int, optional
+        Number of writing threads.
+    batch_size : int, optional
+        Number of writes per batch (task of a thread).
+    max_pending : int, optional
+        Maximum number of batches submitted but not yet written. submit
+        blocks when this is reached.
+    """
+    def __init__(self, num_threads=4, batch_size=16, max_pending=64):
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(max_workers=num_threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._batch = []
+        self._futures = []
+
+    def submit(self, func, *args):
+        """Call func(*args) in the background, e.g. ts.to_csv, path"""
+        self._batch.append((func, args))
+        if len(self._batch) >= self.batch_size:
+            self._submit_batch()
+
+    def _submit_batch(self):
+        if len(self._batch) == 0:
+            return
+        batch, self._batch = self._batch, []
+        self._slots.acquire()
+        future = self._pool.submit(_run_batch, batch)
+        future.add_done_callback(lambda _: self._slots.release())
+        # keep only futures that may still raise
+        self._futures = [f for f in self._futures
+                         if not f.done() or f.exception() is not None]
+        self._futures.append(future)
+
+    def flush(self):
+        """Wait until all submitted writes are done, raise the first error"""
+        self._submit_batch()
+        futures, self._futures = self._futures, []
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def shutdown(self):
+        """Flush and stop the threads"""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+
+
+class OutputStore(object):
+    """
+    Output of one variable, as csv files or consolidated Parquet files
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory, e.g. 'obs_output'.
+    var : str
+        Variable name.
+    fmt : str, optional
+        'csv' (legacy files, written immediately) or 'parquet' (written by
+        close).
+    writer : BackgroundWriter, optional
+        Writes the csv files of the series in the background (default is to
+        write them immediately). Can be shared by several stores.
+    """
+    def __init__(self, output_dir, var, fmt='csv', writer=None):
+        if not fmt in OUTPUT_FORMATS:
+            raise ValueError(f'fmt must be one of {OUTPUT_FORMATS}')
+        self.output_dir = output_dir
+        self.var = var
+        self.fmt = fmt
+        self.writer = writer
+        self._data_dir_exists = False
+        self._series = []
+        self._tables = {}
+
+    @property
+    def data_dir(self):
+        """Directory of the csv files of the series"""
+        return os.path.join(self.output_dir, f'data_{self.var}')
+
+    def path(self, name):
+        """Path of a table ('data', 'trends' or 'sitemeta')"""
+        ext = 'csv' if self.fmt == 'csv' and name != 'data' else 'parquet'
+        return os.path.join(self.output_dir, f'{name}_{self.var}.{ext}')
+
+    def write_series(self, fname, ts, kind='series', **keys):
+        """
+        Write a time series
+
+        Parameters
+        ----------
+        fname : str
+            Name of the csv file in data_dir, e.g. data_{var}_{site}_{tst}.csv.
+        ts : pandas.Series
+            Series with time index.
+        kind : str, optional
+            'series' (data of a site) or 'yearly' (yearly values of a trend).
+        **keys
+            Values of KEY_COLUMNS, e.g. station_id, ts_type, period and
+            season.
+        """
+        if self.fmt == 'csv':
+            if not self._data_dir_exists:
+                os.makedirs(self.data_dir, exist_ok=True)
+                self._data_dir_exists = True
+            path = os.path.join(self.data_dir, fname)
+            if self.writer is None:
+                ts.to_csv(path)
+            else:
+                self.writer.submit(ts.to_csv, path)
+            return
+        for key in keys:
+            if not key in KEY_COLUMNS:
+                raise ValueError(f'invalid key {key}')
+        self._series.append((fname, kind, keys, ts.index.name, ts.name,
+                             pd.DatetimeIndex(ts.index).values,
+                             np.asarray(ts.values, dtype=np.float64)))
+
+    def write_table(self, name, table):
+        """Write the trend table or the site metadata (see TABLES)"""
+        if self.fmt == 'csv':
+            os.makedirs(self.output_dir, exist_ok=True)
+            table.to_csv(self.path(name))
+        else:
+            self._tables[name] = table
+
+    def read_table(self, name):
+        """Previously written table, or None if there is none"""
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        if self.fmt == 'csv':
+            return pd.read_csv(path, index_col=0)
+        return pd.read_parquet(path)
+
+    def read_data(self, **keys):
+        """
+        Series in the data table (format 'parquet' only)
+
+        Parameters
+        ----------
+        **keys
+            Values of KEY_COLUMNS or kind, only these rows are read.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Rows of the data table.
+        """
+        filters = [(key, '==', val) for key, val in keys.items()]
+        return pd.read_parquet(self.path('data'), filters=filters or None)
+
+    def close(self):
+        """
+        Write the collected series and tables (format 'parquet')
+
+        Series whose file name was written before are replaced, the other
+        series already in data_{var}.parquet are kept (as the csv files of a
+        partial update). With a writer, waits until the csv files are
+        written and raises the first error.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        if self.fmt == 'csv':
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        if len(self._series) > 0:
+            data = self._data_table()
+            old_path = self.path('data')
+            if os.path.exists(old_path):
+                old = pd.read_parquet(old_path)
+                old = old[~old['file'].isin(data['file'].unique())]
+                data = pd.concat([old, data], ignore_index=True)
+            data = data.sort_values(['station_id', 'period', 'season',
+                                     'file'], kind='stable')
+            _write_parquet(data.reset_index(drop=True), old_path)
+            self._series = []
+        for name, table in self._tables.items():
+            _write_parquet(table, self.path(name))
+        self._tables = {}
+
+    def _data_table(self):
+        """Collected series in long format"""
+        sizes = np.array([max(len(item[5]), 1) for item in self._series])
+
+        def column(values):
+            return np.repeat(np.array(values, dtype=object), sizes)
+
+        table = {'file': column([item[0] for item in self._series]),
+                 'kind': column([item[1] for item in self._series])}
+        for key in KEY_COLUMNS:
+            table[key] = column([item[2].get(key) for item in self._series])
+        # an empty series is kept as one row without time stamp
+        times, values = [], []
+        for item in self._series:
+            times.append(item[5] if len(item[5]) > 0
+                         else np.array(['NaT'], dtype='datetime64[ns]'))
+            values.append(item[6] if len(item[6]) > 0 else np.array([np.nan]))
+        table['time'] = np.concatenate(times).astype('datetime64[ns]')
+        table['value'] = np.concatenate(values)
+        table['index_name'] = column([item[3] for item in self._series])
+        table['name'] = column([None if item[4] is None else str(item[4])
+                                for item in self._series])
+        return pd.DataFrame(table)
+
+
+def _write_parquet(table, path):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    table.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def stored_vars(output_dir):
+    """Variables with a data_{var}.parquet file in output_dir"""
+    paths = glob.glob(os.path.join(output_dir, 'data_*.parquet'))
+    return sorted(os.path.basename(path)[len('data_'):-len('.parquet')]
+                  for path in paths)
+
+
+def export_csv(output_dir, var, csv_dir=None):
+    """
+    Regenerate the legacy csv files of a variable from its Parquet files
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory of the Parquet files.
+    var : str
+        Variable name.
+    csv_dir : str, optional
+        Output directory of the csv files, default is output_dir.
+
+    Returns
+    -------
+    int
+        Number of csv files written.
+    """
+    if csv_dir is None:
+        csv_dir = output_dir
+    store = OutputStore(output_dir, var, 'parquet')
+    csv_store = OutputStore(csv_dir, var, 'csv')
+    num = 0
+    for name in TABLES:
+        table = store.read_table(name)
+        if table is not None:
+            csv_store.write_table(name, table)
+            num += 1
+    if not os.path.exists(store.path('data')):
+        return num
+    data = store.read_data()
+    for fname, rows in data.groupby('file', sort=False):
+        index_name, name = [None if pd.isna(val) else val for val in
+                            rows[['index_name', 'name']].iloc[0]]
+        rows = rows[rows['time'].notna()]
+        index = pd.DatetimeIndex(rows['time'].values, name=index_name)
+        csv_store.write_series(fname, pd.Series(rows['value'].values,
+                                                index=index, name=name))
+        num += 1
+    return num
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export or inspect consolidated trend output')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export',
+                                   help='write the legacy csv files')
+    export.add_argument('output_dir')
+    export.add_argument('--var', nargs='+')
+    export.add_argument('--csv-dir')
+    info = subparsers.add_parser('info', help='list stored variables')
+    info.add_argument('output_dir')
+    info.add_argument('--var', nargs='+')
+    args = parser.parse_args()
+
+    var_list = args.var or stored_vars(args.output_dir)
+    for var in var_list:
+        if args.command == 'export':
+            num = export_csv(args.output_dir, var, args.csv_dir)
+            print(f'{var}: wrote {num} csv files')
+        elif args.command == 'info':
+            data = OutputStore(args.output_dir, var, 'parquet').read_data()
+            print(f'{var}: {data["file"].nunique()} series, '
+                  f'{data["station_id"].nunique()} stations, '
+                  f'{len(data)} values')
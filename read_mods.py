@@ -5,10 +5,19 @@ Created on Wed Jun 23 09:32:56 2021
 
 @author: hansb
 """
-import os, socket, tqdm
+import os, socket, shutil, tempfile, time, weakref, tqdm
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+import numpy as np
+import pandas as pd
+import xarray as xr
 import iris
 import cf_units
 import pyaerocom as pya
+from pyaerocom.units_helpers import UALIASES
+from pyaerocom.variable_helpers import get_emep_variables
 
 import derive_cubes as der
 
@@ -75,27 +84,272 @@ else:
     preface = '/'
 
 
+MODEL_ROOT = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns'
+
+# directory of the model run for each year
+MODEL_RUN_DIRS = {year: f'{MODEL_ROOT}/2019_REPORTING/TRENDS/{year}'
+                  for year in range(1999, 2017)}
+MODEL_RUN_DIRS[2017] = f'{MODEL_ROOT}/2019_REPORTING/EMEP01_L20EC_rv4_33.2017'
+MODEL_RUN_DIRS[2018] = f'{MODEL_ROOT}/2020_REPORTING/EMEP01_rv4_35_2018_emepCRef2'
+#MODEL_RUN_DIRS[2018] = f'{MODEL_ROOT}/2021_REPORTING/TRENDS/2018'
+MODEL_RUN_DIRS[2019] = f'{MODEL_ROOT}/2020_REPORTING/EMEP01_rv4_35_2019_tnoCRef2'
+#MODEL_RUN_DIRS[2019] = f'{MODEL_ROOT}/2021_REPORTING/TRENDS/2019'
+
+
 def get_modelfile(year, data_freq):
     """
     Function to use as input argument 'getfile' in function read_model
+
+    See also model_catalog.ModelCatalog.get_modelfile
     """
-    if year < 2017 and year >= 1999:
-        folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2019_REPORTING/TRENDS/{year}'
-    elif year == 2017:
-        folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2019_REPORTING/EMEP01_L20EC_rv4_33.2017'
-    elif year == 2018:
-        folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2020_REPORTING/EMEP01_rv4_35_2018_emepCRef2'
-        #folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2021_REPORTING/TRENDS/2018'
-    elif year == 2019:
-        folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2020_REPORTING/EMEP01_rv4_35_2019_tnoCRef2'
-        #folder = f'{preface}/lustre/storeB/project/fou/kl/emep/ModelRuns/2021_REPORTING/TRENDS/2019'
-    else:
+    try:
+        folder = MODEL_RUN_DIRS[year]
+    except KeyError:
         raise ValueError(f'Location of model data for year {year} in not known')
     if data_freq not in ['hour', 'day', 'month']:
         raise ValueError('data_freq must be "hour", "day" or "month"')
     return os.path.join(folder, f'Base_{data_freq}.nc')
 
 
+# time resolution of the EMEP output files, from fine to coarse
+MODEL_DATA_FREQS = ['hour', 'day', 'month']
+
+TS_TYPE_ORDER = ['hourly', 'daily', 'monthly', 'yearly']
+
+
+def select_data_freq(ts_type, match_obs_coverage=False):
+    """
+    Select the coarsest model file that can provide data at ts_type
+
+    E.g. monthly trends can be computed directly from Base_month.nc, which
+    is roughly 30 times smaller than Base_day.nc. However, if the model
+    data is to be matched with the coverage of the observations (i.e.
+    colocated in time before averaging to ts_type), daily model data is
+    needed.
+
+    Parameters
+    ----------
+    ts_type : str
+        Target time resolution, e.g. 'monthly'.
+    match_obs_coverage : bool, optional
+        If True, the model data is colocated with the (daily) observations
+        before averaging to ts_type, and daily files are selected for
+        ts_types coarser than daily.
+
+    Returns
+    -------
+    str
+        data_freq to be used in get_modelfile, e.g. 'month'.
+    """
+    if ts_type not in TS_TYPE_ORDER:
+        raise ValueError(f'ts_type must be one of {TS_TYPE_ORDER}')
+    needed = TS_TYPE_ORDER.index(ts_type)
+    if match_obs_coverage and needed > TS_TYPE_ORDER.index('daily'):
+        print(f'Daily model data is needed to match the coverage of the '
+              f'observations for {ts_type} data')
+        needed = TS_TYPE_ORDER.index('daily')
+    codes = pya.io.ReadMscwCtm.FREQ_CODES
+    usable = [data_freq for data_freq in MODEL_DATA_FREQS
+              if TS_TYPE_ORDER.index(codes[data_freq]) <= needed]
+    return usable[-1]
+
+
+# default approximate size of one chunk of a full-domain field in lazy mode
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+
+class LazyReadMscwCtm(pya.io.ReadMscwCtm):
+    """
+    ReadMscwCtm that reads the data as chunked (dask) arrays
+
+    read_var returns GriddedData with lazy cubes, and the data is only
+    loaded chunk by chunk when it is realised (e.g. during colocation).
+
+    Parameters
+    ----------
+    filepath : str
+        Path to netcdf file.
+    memory_budget_mb : float, optional
+        Approximate size in MB of one chunk of a variable. The file is chunked
+        along time only, so each chunk holds as many full fields as fit into
+        this budget (but at least one).
+    """
+    def __init__(self, filepath, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget_mb = memory_budget_mb
+        super().__init__(filepath)
+
+    def open_file(self):
+        ds = xr.open_dataset(self.filepath)
+        # number of values of the largest field at one time step
+        field_size = max([ds[name].size // ds.sizes['time']
+                          for name in ds.data_vars if 'time' in ds[name].dims]
+                         + [1])
+        # assume float64, which derived cubes have independent of the file
+        ntime = max(int(self.memory_budget_mb * 1e6 // (field_size * 8)), 1)
+        ds = ds.chunk({'time': ntime})
+        self._filedata = ds
+        return ds
+
+
+class StagedReadMscwCtm(pya.io.ReadMscwCtm):
+    """
+    ReadMscwCtm for a model file that has already been read into memory
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the original netcdf file (used for ts_type and metadata).
+    filedata : xarray.Dataset
+        Content of the file, see _stage_model_year.
+    """
+    def __init__(self, filepath, filedata):
+        self._staged = filedata
+        super().__init__(filepath)
+
+    def open_file(self):
+        self._filedata = self._staged
+        return self._staged
+
+
+def _open_reader(data_id, lazy=False, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                 staged=None):
+    """
+    Open reader of a model file, see LazyReadMscwCtm for lazy
+
+    staged is the output of _stage_model_year: an in-memory copy of the file
+    or the path to a copy in a scratch directory, which is read instead.
+    """
+    if isinstance(staged, xr.Dataset):
+        if lazy:
+            raise ValueError('lazy reading of prefetched data needs a scratch '
+                             'directory')
+        return StagedReadMscwCtm(data_id, staged)
+    elif staged is not None:
+        data_id = staged
+    if lazy:
+        return LazyReadMscwCtm(data_id, memory_budget_mb)
+    return pya.io.ReadMscwCtm(data_id)
+
+
+def _emep_names(var, var_map, aux_requires):
+    """
+    Names of the variables in the model files that are needed to read var
+    """
+    if var in var_map:
+        return [var_map[var]]
+    elif var in aux_requires:
+        names = []
+        for aux_var in aux_requires[var]:
+            names.extend(_emep_names(aux_var, var_map, aux_requires))
+        return names
+    raise ValueError(f'{var} can not be read from EMEP model files')
+
+
+def model_var_names(req_vars):
+    """
+    Names of the variables in the model files needed to read req_vars
+
+    Parameters
+    ----------
+    req_vars : list
+        Variable names (in pyaerocom), e.g. the "req_vars" in CALCULATE_HOW.
+
+    Returns
+    -------
+    list
+        EMEP variable names, without duplicates.
+    """
+    var_map = get_emep_variables()
+    aux_requires = pya.io.ReadMscwCtm.AUX_REQUIRES
+    names = []
+    for req_var in req_vars:
+        var_name_aerocom = pya.const.VARS[req_var].var_name_aerocom
+        for name in _emep_names(var_name_aerocom, var_map, aux_requires):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def _stage_model_year(year, getfile, data_freq, names, scratch_dir=None,
+                      skip=()):
+    """
+    Read the variables needed from one model file ahead of processing
+
+    Parameters
+    ----------
+    year : int
+        Year.
+    getfile, data_freq
+        See read_model.
+    names : list
+        EMEP variable names to read, see model_var_names.
+    scratch_dir : str, optional
+        If provided, the variables are copied to a netcdf file in a new
+        subdirectory of scratch_dir (e.g. on a local disk). Otherwise they are
+        loaded into memory.
+    skip : container, optional
+        Years that are not staged (e.g. because they are in the cache).
+
+    Returns
+    -------
+    xarray.Dataset or str or None
+        In-memory data, path to the copy in scratch_dir, or None if skipped.
+        Release with _release_staged.
+    """
+    if year in skip:
+        return None
+    filepath = getfile(year, data_freq)
+    with xr.open_dataset(filepath) as ds:
+        ds = ds[[name for name in names if name in ds]]
+        if scratch_dir is None:
+            return ds.load()
+        # same file name, since ReadMscwCtm gets ts_type from it
+        path = os.path.join(tempfile.mkdtemp(prefix=f'{year}_', dir=scratch_dir),
+                            os.path.basename(filepath))
+        ds.to_netcdf(path)
+        return path
+
+
+def _release_staged(staged):
+    """Free memory or delete scratch copy of a staged model file"""
+    if isinstance(staged, xr.Dataset):
+        staged.close()
+    elif staged is not None:
+        shutil.rmtree(os.path.dirname(staged), ignore_errors=True)
+
+
+def _release_all(staged_list):
+    """Release a list of staged model files, see _release_staged"""
+    while staged_list:
+        _release_staged(staged_list.pop())
+
+
+class _StagedFiles(object):
+    """
+    Scratch copies of model files that lazy data still reads from
+
+    The files are deleted when the last object referencing this is garbage
+    collected, see _keep_staged.
+    """
+    def __init__(self, staged_list):
+        weakref.finalize(self, _release_all, list(staged_list))
+
+
+def _keep_staged(data, staged_list):
+    """
+    Keep staged model files as long as data read from them is alive
+
+    Lazy data read from the scratch copies (see _read_ahead with
+    keep_staged) reads from these files until it is realised. The files are
+    deleted when all objects in data are garbage collected.
+    """
+    if staged_list:
+        files = _StagedFiles(staged_list)
+        del staged_list[:]
+        for obj in data:
+            obj._staged_files = files
+
+
 def dummy(cube):
     return cube
 
@@ -104,7 +358,515 @@ def not_implemented(cube):
     raise NotImplementedError
 
 
-def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
+def _map_years(func, years, num_workers=None, max_in_flight=None, desc=None):
+    """
+    Apply a function to each year and yield the results in year order
+
+    Parameters
+    ----------
+    func : function (int) -> object
+        Function to apply to each year. Must be picklable (i.e. a module level
+        function or a functools.partial of one) if num_workers > 1.
+    years : iterable of int
+        Years to process.
+    num_workers : int, optional
+        Number of worker processes. None or 1 processes the years serially
+        in the current process.
+    max_in_flight : int, optional
+        Maximum number of years that are submitted to the pool but not yet
+        handed back to the caller. This bounds the memory held by finished
+        but unconsumed results. Defaults to num_workers.
+    desc : str, optional
+        Description for the progress bar.
+
+    Yields
+    ------
+    object
+        Result of func for each year, in the order of years.
+    """
+    years = list(years)
+    if num_workers is None or num_workers <= 1:
+        for year in tqdm.tqdm(years, desc=desc):
+            yield func(year)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = num_workers
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be at least 1')
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool, \
+            tqdm.tqdm(total=len(years), desc=desc) as pbar:
+        to_submit = iter(years)
+        pending = deque(pool.submit(func, year)
+                        for year in islice(to_submit, max_in_flight))
+        while pending:
+            result = pending.popleft().result()
+            year = next(to_submit, None)
+            if year is not None:
+                pending.append(pool.submit(func, year))
+            pbar.update()
+            yield result
+
+
+def _read_ahead(func, stage, years, prefetch_depth=1, desc=None,
+                keep_staged=None):
+    """
+    Apply a function to each year, staging the input of later years meanwhile
+
+    Serial alternative to _map_years for I/O bound reading: while func is
+    applied to one year, the input files of the next prefetch_depth years are
+    read in a background thread by stage. The time spent waiting for the
+    staged input and the time spent in func are printed at the end.
+
+    Parameters
+    ----------
+    func : function (int, staged) -> object
+        Function to apply to each year, with the output of stage for that
+        year as keyword argument "staged".
+    stage : function (int) -> staged
+        Function that reads the input of a year, see _stage_model_year.
+    years : iterable of int
+        Years to process.
+    prefetch_depth : int, optional
+        Number of years staged ahead of the year being processed. Memory
+        (or scratch space) of up to prefetch_depth + 1 staged years is used.
+    desc : str, optional
+        Description for the progress bar.
+    keep_staged : list, optional
+        If provided, the staged input of each year is appended to this list
+        instead of being released when func returns, because the result
+        still reads from it (lazy data read from a scratch copy). The caller
+        releases it with _release_all when the results have been used.
+
+    Yields
+    ------
+    object
+        Result of func for each year, in the order of years.
+    """
+    if prefetch_depth < 1:
+        raise ValueError('prefetch_depth must be at least 1')
+    years = list(years)
+    io_wait = 0
+    compute = 0
+    # one thread, so that the network filesystem serves one file at a time
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        to_submit = iter(years)
+        # the next year is submitted when a staged year is taken, so that
+        # prefetch_depth years are staged while func runs
+        pending = deque((year, pool.submit(stage, year))
+                        for year in islice(to_submit, prefetch_depth))
+        try:
+            with tqdm.tqdm(total=len(years), desc=desc) as pbar:
+                while pending:
+                    year, future = pending.popleft()
+                    t0 = time.perf_counter()
+                    staged = future.result()
+                    t1 = time.perf_counter()
+                    next_year = next(to_submit, None)
+                    if next_year is not None:
+                        pending.append((next_year, pool.submit(stage, next_year)))
+                    try:
+                        result = func(year, staged=staged)
+                    finally:
+                        if keep_staged is None:
+                            _release_staged(staged)
+                        else:
+                            keep_staged.append(staged)
+                    io_wait += t1 - t0
+                    compute += time.perf_counter() - t1
+                    pbar.update()
+                    yield result
+                    del result
+        finally:
+            for _, future in pending:
+                if not future.cancel():
+                    try:
+                        _release_staged(future.result())
+                    except Exception:
+                        pass
+            print(f'{desc}: {io_wait:.1f} s waiting for model I/O, '
+                  f'{compute:.1f} s computing')
+
+
+def _read_model_year(year, var, getfile, data_freq, calculate_how, cache=None,
+                     lazy=False, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                     staged=None, var_info=None):
+    """
+    Read and derive one year of model data (see read_model)
+
+    Variables without units in the model file get the units in var_info (if
+    provided).
+
+    Returns
+    -------
+    iris.cube.Cube
+        Output of calculate_how['function'] for the given year.
+    """
+    data_id = getfile(year, data_freq)
+
+    if cache is not None:
+        key, content = cache.make_key(var, year, data_freq, calculate_how,
+                                      data_id)
+        cached = cache.load(key)
+        if cached is not None:
+            return cached
+        calc_temp = _read_model_year(year, var, getfile, data_freq,
+                                     calculate_how, lazy=lazy,
+                                     memory_budget_mb=memory_budget_mb,
+                                     staged=staged, var_info=var_info)
+        cache.save(key, content, calc_temp)
+        return calc_temp
+
+    reader = _open_reader(data_id, lazy, memory_budget_mb, staged)
+
+    temp_data = []
+    for req_var in calculate_how['req_vars']:
+        temp = reader.read_var(req_var)
+        if (temp.cube.units == 'unknown' and var_info is not None
+                and req_var in var_info):
+            temp.cube.units = var_info[req_var]['units']
+        tcoord = temp.cube.coords('time')[0]
+        if tcoord.units.calendar == 'proleptic_gregorian':
+            tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
+        temp_data.append(temp.cube)
+    return calculate_how['function'](*temp_data)
+
+
+def _nearest_cells(grid_lats, grid_lons, stations):
+    """
+    Get (lat, lon) indices of the model grid cells closest to the stations
+
+    Parameters
+    ----------
+    grid_lats : numpy.ndarray
+        1D array of grid cell center latitudes.
+    grid_lons : numpy.ndarray
+        1D array of grid cell center longitudes.
+    stations : pandas.DataFrame
+        Must have columns "latitude" and "longitude".
+
+    Returns
+    -------
+    numpy.ndarray
+        Integer array of shape (number of stations, 2) with lat and lon index.
+    """
+    lats = stations['latitude'].values.astype(float)
+    lons = stations['longitude'].values.astype(float)
+    ilat = np.abs(grid_lats[np.newaxis, :] - lats[:, np.newaxis]).argmin(axis=1)
+    ilon = np.abs(grid_lons[np.newaxis, :] - lons[:, np.newaxis]).argmin(axis=1)
+    return np.stack([ilat, ilon], axis=1)
+
+
+def _read_cells(arr, cells, neighbourhood):
+    """
+    Read time series of single grid cells (or neighbourhoods) from a variable
+
+    Only the hyperslab around each cell is read from the file.
+
+    Parameters
+    ----------
+    arr : xarray.DataArray
+        Variable with dimensions time, lat and lon (not loaded into memory).
+    cells : numpy.ndarray
+        Unique (lat, lon) index pairs, see _nearest_cells.
+    neighbourhood : int
+        Number of neighbouring cells in each direction that are read
+        together with the center cell. 0 reads only the center cell.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (time, number of cells read), with the cells of the
+        neighbourhood of each center cell next to each other.
+    numpy.ndarray
+        Index of the first column of each neighbourhood, see _cell_means.
+    """
+    n = neighbourhood
+    values = []
+    starts = []
+    num = 0
+    for ilat, ilon in cells:
+        box = arr.isel(lat=slice(max(ilat - n, 0), ilat + n + 1),
+                       lon=slice(max(ilon - n, 0), ilon + n + 1))
+        box = box.transpose('time', 'lat', 'lon').values
+        values.append(box.reshape(box.shape[0], -1))
+        starts.append(num)
+        num += values[-1].shape[1]
+    return np.concatenate(values, axis=-1), np.array(starts)
+
+
+def _cell_means(values, starts):
+    """Mean of the cells of each neighbourhood (NaN ignored), see _read_cells"""
+    values = np.ma.filled(np.asarray(values, dtype=np.float64), np.nan)
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=-1)
+    counts = np.add.reduceat(valid, starts, axis=-1)
+    with np.errstate(invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+# pyaerocom versions in which ReadMscwCtm._load_var returns a variable of the
+# file as xarray.DataArray without loading it, so that only the grid cells at
+# the stations are read. Other versions use the public read_var with a lazy
+# reader, which reads the whole fields chunk by chunk
+LOAD_VAR_VERSIONS = ['0.10', '0.11', '0.12']
+
+
+def _has_load_var():
+    """Check if the pyaerocom version is in LOAD_VAR_VERSIONS"""
+    return '.'.join(pya.__version__.split('.')[:2]) in LOAD_VAR_VERSIONS
+
+
+def _load_station_var(reader, req_var):
+    """
+    Variable of a model file as xarray.DataArray, not loaded into memory
+
+    Uses the private ReadMscwCtm._load_var for the pyaerocom versions in
+    LOAD_VAR_VERSIONS, and ReadMscwCtm.read_var otherwise (reader must then
+    be lazy, see LazyReadMscwCtm).
+    """
+    if _has_load_var():
+        var_name_aerocom = pya.const.VARS[req_var].var_name_aerocom
+        return reader._load_var(var_name_aerocom, reader.ts_type)
+    return xr.DataArray.from_iris(reader.read_var(req_var).cube)
+
+
+def _read_model_year_stations(year, var, getfile, data_freq, calculate_how,
+                              stations, neighbourhood=0, cache=None,
+                              staged=None, var_info=None):
+    """
+    Read and derive one year of model data at station locations only
+
+    Like _read_model_year, but instead of reading the whole domain only the
+    grid cells (or neighbourhoods) closest to the stations are read, and the
+    derivation function is applied to cubes of shape (time, cell). The
+    neighbourhood average is taken after the derivation, as for the full
+    domain. Variables without units in the model file get the units in
+    var_info (if provided).
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        Time stamps of the year.
+    numpy.ndarray
+        Derived values of shape (time, station).
+    str
+        var_name of the derived variable.
+    cf_units.Unit
+        Units of the derived variable.
+    """
+    data_id = getfile(year, data_freq)
+
+    if cache is not None:
+        key, content = cache.make_key(var, year, data_freq, calculate_how,
+                                      data_id, stations, neighbourhood)
+        cached = cache.load(key)
+        if cached is not None:
+            return cached
+        result = _read_model_year_stations(year, var, getfile, data_freq,
+                                           calculate_how, stations,
+                                           neighbourhood, staged=staged,
+                                           var_info=var_info)
+        cache.save(key, content, result)
+        return result
+
+    # with read_var, the file is read lazily (staged data is in memory)
+    lazy = not _has_load_var() and not isinstance(staged, xr.Dataset)
+    reader = _open_reader(data_id, lazy=lazy, staged=staged)
+
+    temp_data = []
+    for req_var in calculate_how['req_vars']:
+        arr = _load_station_var(reader, req_var)
+        if not ('lat' in arr.dims and 'lon' in arr.dims):
+            raise ValueError(f'Station extraction needs a regular lat/lon '
+                             f'grid, {req_var} has dimensions {arr.dims}')
+        if len(temp_data) == 0:
+            cells = _nearest_cells(arr.lat.values, arr.lon.values, stations)
+            cells, station_cell = np.unique(cells, axis=0, return_inverse=True)
+            times = arr.indexes['time']
+            if not isinstance(times, pd.DatetimeIndex):
+                times = times.to_datetimeindex()
+
+        units = arr.attrs.get('units', 'unknown')
+        units = UALIASES.get(units, units)
+        if units == 'unknown' and var_info is not None and req_var in var_info:
+            units = var_info[req_var]['units']
+        values, starts = _read_cells(arr, cells, neighbourhood)
+        cube = iris.cube.Cube(values,
+                              var_name=pya.const.VARS[req_var].var_name_aerocom,
+                              units=units)
+        # same unit handling as in pyaerocom.GriddedData
+        to_unit = pya.const.VARS[req_var].units
+        if cube.units != to_unit:
+            cube.convert_units(to_unit)
+        temp_data.append(cube)
+    calc_temp = calculate_how['function'](*temp_data)
+    values = calc_temp.data
+    if neighbourhood > 0:
+        values = _cell_means(values, starts)
+    return (times, values[:, station_cell.ravel()], calc_temp.var_name,
+            calc_temp.units)
+
+
+def _to_station_data(var, times, values, units, stations, ts_type):
+    """
+    Convert station time series read by read_model to StationData objects
+
+    Returns
+    -------
+    list
+        List of pyaerocom.StationData, one for each row in stations.
+    """
+    meta_keys = [key for key in ['station_id', 'station_name', 'latitude',
+                                 'longitude', 'altitude']
+                 if key in stations]
+    result = []
+    for i, (_, meta) in enumerate(stations.iterrows()):
+        site = pya.StationData(**{key: meta[key] for key in meta_keys},
+                               ts_type=ts_type)
+        site.var_info[var] = {'units': str(units)}
+        site[var] = pd.Series(values[:, i], index=times)
+        result.append(site)
+    return result
+
+
+def _read_years(var, getfile, start_yr, stop_yr, var_info, calc_how,
+                num_workers, max_in_flight, stations, neighbourhood, cache,
+                lazy, memory_budget_mb, prefetch_depth, scratch_dir,
+                keep_staged=None):
+    """
+    Read and derive a model variable year by year (see read_model)
+
+    keep_staged is passed to _read_ahead if prefetch_depth > 0.
+
+    Yields
+    ------
+    object
+        Output of _read_model_year (or _read_model_year_stations if stations
+        are provided) for each year, in year order.
+    """
+    try:
+        calculate_how = calc_how[var]
+    except KeyError:
+        calculate_how = {'req_vars': [var], 'function': dummy}
+
+    data_freq = var_info[var]['data_freq']
+
+    years = range(int(start_yr), int(stop_yr))
+
+    if lazy and num_workers is not None and num_workers > 1:
+        raise ValueError('lazy reading can not be combined with num_workers > 1')
+    if prefetch_depth > 0 and num_workers is not None and num_workers > 1:
+        raise ValueError('prefetch_depth can not be combined with num_workers > 1')
+
+    if stations is not None:
+        stations = pd.DataFrame(stations)
+        read_year = partial(_read_model_year_stations, var=var,
+                            getfile=getfile, data_freq=data_freq,
+                            calculate_how=calculate_how, stations=stations,
+                            neighbourhood=neighbourhood, cache=cache,
+                            var_info=var_info)
+    else:
+        read_year = partial(_read_model_year, var=var, getfile=getfile,
+                            data_freq=data_freq, calculate_how=calculate_how,
+                            cache=cache, lazy=lazy, var_info=var_info,
+                            memory_budget_mb=memory_budget_mb)
+
+    if prefetch_depth > 0:
+        skip = set()
+        if cache is not None:
+            skip = {year for year in years
+                    if cache.make_key(var, year, data_freq, calculate_how,
+                                      getfile(year, data_freq), stations,
+                                      neighbourhood)[0] in cache}
+        stage = partial(_stage_model_year, getfile=getfile, data_freq=data_freq,
+                        names=model_var_names(calculate_how['req_vars']),
+                        scratch_dir=scratch_dir, skip=skip)
+        years_data = _read_ahead(read_year, stage, years, prefetch_depth,
+                                 desc=var, keep_staged=keep_staged)
+    else:
+        years_data = _map_years(read_year, years, num_workers, max_in_flight,
+                                desc=var)
+    try:
+        yield from years_data
+    finally:
+        # also if the caller stops early
+        if cache is not None:
+            cache.evict()
+
+
+def _catalog_getfile(catalog, getfile, var_list, start_yr, stop_yr, var_info,
+                     calc_how):
+    """
+    Check the variables against a catalog and return the getfile to use
+
+    Returns getfile if catalog is None, otherwise the lookup of the catalog
+    after checking that the model files, raw fields and units needed for
+    var_list are available (see model_catalog.ModelCatalog.check).
+    """
+    if catalog is None:
+        return getfile
+    catalog.check(var_list, var_info, start_yr, stop_yr, calc_how)
+    return catalog.get_modelfile
+
+
+def iter_model_years(var, getfile, start_yr, stop_yr, var_info, calc_how={},
+                     cache=None, lazy=False,
+                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                     prefetch_depth=0, scratch_dir=None, catalog=None):
+    """
+    Read a model variable from multiple annual EMEP runs, one year at a time
+
+    Like read_model, but the years are not concatenated: the data of each
+    year is yielded when it has been read, so that only one year (plus the
+    years staged ahead with prefetch_depth) is held in memory if the caller
+    releases each year before requesting the next one. With lazy and a
+    scratch_dir, the scratch copy of a year is deleted when the next year is
+    requested, so the data of a year must be realised (e.g. colocated)
+    before that.
+
+    Parameters
+    ----------
+    var, getfile, start_yr, stop_yr, var_info, calc_how, cache, lazy, memory_budget_mb, prefetch_depth, scratch_dir, catalog
+        See read_model.
+
+    Yields
+    ------
+    int
+        Year.
+    pyaerocom.GriddedData
+        Model data of the year.
+    """
+    print(f'Reading {var} from model output year by year')
+    getfile = _catalog_getfile(catalog, getfile, [var], start_yr, stop_yr,
+                               var_info, calc_how)
+    years = range(int(start_yr), int(stop_yr))
+    # scratch copies that lazy data of the current year reads from
+    staged = []
+    years_data = _read_years(var, getfile, start_yr, stop_yr, var_info,
+                             calc_how, None, None, None, 0, cache, lazy,
+                             memory_budget_mb, prefetch_depth, scratch_dir,
+                             keep_staged=staged if lazy else None)
+    try:
+        # iterate to the end of years_data, which evicts the cache
+        for i, cube in enumerate(years_data):
+            year = years[i]
+            data = _concatenate_years(var, [cube], var_info)
+            del cube
+            yield year, data
+            # release the year before the next one is read
+            del data
+            _release_all(staged)
+    finally:
+        _release_all(staged)
+
+
+def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={},
+               num_workers=None, max_in_flight=None, stations=None,
+               neighbourhood=0, cache=None, lazy=False,
+               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, prefetch_depth=0,
+               scratch_dir=None, catalog=None):
     """
     Read a model variable from multiple annual EMEP runs
 
@@ -115,7 +877,8 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
     getfile : function (int, str) -> str
         Function to get full path to the model data file for a specified year.
         First input argument should be the year and second should be the data
-        time frequency, e.g. 'day', 'month', 'hour'
+        time frequency, e.g. 'day', 'month', 'hour'. Not used (can be None)
+        if catalog is provided.
     start_yr : string or int
         Start year as sting or int.
     stop_yr : string or int
@@ -124,7 +887,8 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
         Dict of dicts of variable metadata/info. Needs to have a key for var
         which has at least the keys "units" and "data_freq".
         It is verified that the final cube has units equivalent to "units",
-        and "data_freq" is used as input to "getfile".
+        and "data_freq" is used as input to "getfile". Variables without
+        units in the model files get the "units" of their entry (if any).
     calc_how : dict, optional
         If var is a variable that can not be read directly from the model data,
         calc_how should be provided. The dict must then contain an entry for the
@@ -133,41 +897,112 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
         must be a fuction that calculates the variable and returns an iris.cubc.Cube
         object. This returned cube object must have properties "var_name"=var and
         units equivalent to var_info[var]['units'].
+    num_workers : int, optional
+        If larger than 1, each year is read and derived in a separate worker
+        process, using a pool of this size (e.g. os.cpu_count()). getfile and
+        the "function" in calc_how must then be picklable, i.e. defined at
+        module level. Default is to read the years serially.
+    max_in_flight : int, optional
+        Maximum number of years being read or waiting to be collected at the
+        same time when num_workers > 1. Lower this to bound memory usage of
+        full-domain daily runs. Defaults to num_workers.
+    stations : pandas.DataFrame or dict, optional
+        Station locations, with at least "latitude" and "longitude" (e.g. the
+        content of a sitemeta file). If provided, only the grid cells closest
+        to the stations are read from each file, instead of the whole domain,
+        and a list of StationData is returned. The columns "station_id",
+        "station_name" and "altitude" are added to the metadata if available.
+    neighbourhood : int, optional
+        Only used with stations. Number of cells in each direction around the
+        closest grid cell that are averaged, e.g. 1 gives the mean of 3x3
+        cells. Default is 0, i.e. closest cell only.
+    cache : model_cache.ModelCache, optional
+        If provided, derived data of each year is loaded from this cache if
+        available, and only the missing years are read from the model files
+        (and added to the cache).
+    lazy : bool, optional
+        If True, the data is read as chunked (dask) arrays and kept lazy
+        through the calendar fix, the derivation and the concatenation, so
+        that it is only loaded when it is realised (e.g. during colocation).
+        Can not be combined with num_workers > 1. Not used with stations,
+        which only reads small arrays anyway. Default is False.
+    memory_budget_mb : float, optional
+        Only used if lazy. Approximate size in MB of one chunk, see
+        LazyReadMscwCtm. Peak memory is a small multiple of this (one chunk
+        per raw field and dask thread) instead of the size of all years.
+    prefetch_depth : int, optional
+        If larger than 0, the model variables needed for the next
+        prefetch_depth years are read in a background thread while the
+        current year is derived, so that reading from a slow (network)
+        filesystem overlaps with computing. The time spent waiting for I/O
+        and computing is printed. Can not be combined with num_workers > 1.
+        Years that are in the cache are not prefetched. Default is 0.
+    scratch_dir : str, optional
+        Only used if prefetch_depth > 0. Directory (e.g. on a local disk)
+        where the prefetched variables are stored until they are used.
+        Default is to keep them in memory. Needed for lazy reading, the
+        lazy data then reads from these copies, which are deleted when the
+        returned GriddedData is garbage collected (keep it until the data is
+        realised).
+    catalog : model_catalog.ModelCatalog, optional
+        If provided, the model files are looked up in the catalog instead of
+        with getfile, and it is checked before reading that the files, raw
+        fields and expected units are available for all years, without
+        opening the files (see ModelCatalog.check).
 
     Returns
     -------
-    concatenated : pyaerocom.GriddedData
+    concatenated : pyaerocom.GriddedData or list
         GriddedData object containing the requested variable covering the requested
-        time period.
+        time period, or, if stations are provided, list of pyaerocom.StationData
+        with one time series for each station.
     """
     print(f'Reading {var} from model output')
+    getfile = _catalog_getfile(catalog, getfile, [var], start_yr, stop_yr,
+                               var_info, calc_how)
 
+    # scratch copies that lazy data reads from
+    staged = []
     try:
-        calculate_how = calc_how[var]
-    except KeyError:
-        calculate_how = {'req_vars': [var], 'function': dummy}
-
-    data_freq = var_info[var]['data_freq']
-    data = []
+        data = list(_read_years(var, getfile, start_yr, stop_yr, var_info,
+                                calc_how, num_workers, max_in_flight,
+                                stations, neighbourhood, cache, lazy,
+                                memory_budget_mb, prefetch_depth, scratch_dir,
+                                keep_staged=staged if lazy else None))
+    except BaseException:
+        _release_all(staged)
+        raise
 
-    years = range(int(start_yr), int(stop_yr))
+    if stations is not None:
+        stations = pd.DataFrame(stations)
+        times = pd.DatetimeIndex(np.concatenate([d[0] for d in data]))
+        values = np.concatenate([d[1] for d in data])
+        var_name, units = data[-1][2], cf_units.Unit(data[-1][3])
+        assert var_name == var
+        if units != var_info[var]['units']:
+            error_str = ('Calculation of variable "%s" result in units "%s", not the expected units "%s"'
+                         % (var, units, var_info[var]['units']))
+            raise ValueError(error_str)
+        ts_type = pya.io.ReadMscwCtm.FREQ_CODES[var_info[var]['data_freq']]
+        return _to_station_data(var, times, values, units, stations, ts_type)
 
-    for year in tqdm.tqdm(years, desc=var):
-        data_id = getfile(year, data_freq)
+    try:
+        concatenated = _concatenate_years(var, data, var_info)
+    except BaseException:
+        _release_all(staged)
+        raise
+    _keep_staged([concatenated], staged)
+    return concatenated
 
-        reader = pya.io.ReadMscwCtm(data_id)
 
-        temp_data = []
-        for req_var in calculate_how['req_vars']:
-            print('req_var=', req_var)
-            temp = reader.read_var(req_var)
-            tcoord = temp.cube.coords('time')[0]
-            if tcoord.units.calendar == 'proleptic_gregorian':
-                tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
-            temp_data.append(temp.cube)
-        calc_temp = calculate_how['function'](*temp_data)
-        data.append(calc_temp)
+def _concatenate_years(var, data, var_info):
+    """
+    Concatenate annual cubes of a variable and verify var_name and units
 
+    Returns
+    -------
+    pyaerocom.GriddedData
+    """
     concatenated = pya.GriddedData(pya.io.iris_io.concatenate_iris_cubes(iris.cube.CubeList(data), True))
     # verify final var_name and units
     assert concatenated.cube.var_name == var
@@ -179,6 +1014,252 @@ def read_model(var, getfile, start_yr, stop_yr, var_info, calc_how={}):
     return concatenated
 
 
+def plan_shared_reads(calculate_hows):
+    """
+    Plan reading of the raw model fields required by several variables
+
+    Parameters
+    ----------
+    calculate_hows : dict
+        Dict with variable names as keys and dicts with keys "req_vars" and
+        "function" as values (see calc_how in read_model). The derivations
+        are done in the order of this dict.
+
+    Returns
+    -------
+    list
+        Union of the required raw fields, in order of first use.
+    dict
+        For each raw field, the variable with the last derivation that needs
+        it, i.e. after which it can be released.
+    """
+    raw_fields = []
+    last_use = {}
+    for var, calculate_how in calculate_hows.items():
+        for req_var in calculate_how['req_vars']:
+            if req_var not in raw_fields:
+                raw_fields.append(req_var)
+            last_use[req_var] = var
+    return raw_fields, last_use
+
+
+def _read_models_year(year, getfile, data_freq, calculate_hows, lazy=False,
+                      memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, staged=None,
+                      var_info=None, cache=None):
+    """
+    Read and derive one year of several model variables (see read_models)
+
+    The annual file is opened once, each raw field is read once and kept
+    only until the last derivation that needs it is done. With a cache,
+    variables that are in the cache are loaded from it and only the raw
+    fields of the other variables are read.
+
+    Returns
+    -------
+    dict
+        Output of the derivation function of each variable.
+    """
+    data_id = getfile(year, data_freq)
+
+    result = {}
+    keys = {}
+    if cache is not None:
+        for var, calculate_how in calculate_hows.items():
+            keys[var] = cache.make_key(var, year, data_freq, calculate_how,
+                                       data_id)
+            cached = cache.load(keys[var][0])
+            if cached is not None:
+                result[var] = cached
+    to_derive = {var: calculate_how
+                 for var, calculate_how in calculate_hows.items()
+                 if var not in result}
+    if len(to_derive) == 0:
+        return result
+
+    reader = _open_reader(data_id, lazy, memory_budget_mb, staged)
+
+    _, last_use = plan_shared_reads(to_derive)
+    raw = {}
+    for var, calculate_how in to_derive.items():
+        for req_var in calculate_how['req_vars']:
+            if req_var in raw:
+                continue
+            temp = reader.read_var(req_var)
+            if (temp.cube.units == 'unknown' and var_info is not None
+                    and req_var in var_info):
+                temp.cube.units = var_info[req_var]['units']
+            tcoord = temp.cube.coords('time')[0]
+            if tcoord.units.calendar == 'proleptic_gregorian':
+                tcoord.units = cf_units.Unit(tcoord.units.origin, calendar='gregorian')
+            raw[req_var] = temp.cube
+        result[var] = calculate_how['function'](
+            *[raw[req_var] for req_var in calculate_how['req_vars']])
+        if cache is not None:
+            key, content = keys[var]
+            cache.save(key, content, result[var])
+        for req_var in calculate_how['req_vars']:
+            if last_use[req_var] == var:
+                raw.pop(req_var, None)
+    return {var: result[var] for var in calculate_hows}
+
+
+def read_models(var_list, getfile, start_yr, stop_yr, var_info, calc_how={},
+                num_workers=None, max_in_flight=None, lazy=False,
+                memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, prefetch_depth=0,
+                scratch_dir=None, catalog=None, cache=None):
+    """
+    Read several model variables, reading shared raw fields only once
+
+    Like read_model, but for a list of variables. Each annual file is opened
+    once per data_freq, and raw fields that are needed by more than one
+    variable (e.g. concno3f and concno3c for concNtno3, concNno3pm25 and
+    concNno3pm10) are read once and passed to every derivation that needs
+    them. NB: the derivation functions must therefore not modify their
+    input cubes.
+
+    Parameters
+    ----------
+    var_list : list
+        Variable names (in pyaerocom).
+    getfile, start_yr, stop_yr, calc_how, num_workers, max_in_flight, lazy, memory_budget_mb, prefetch_depth, scratch_dir, catalog
+        See read_model.
+    var_info : dict
+        See read_model. Must have an entry for each variable in var_list.
+    cache : model_cache.ModelCache, optional
+        See read_model. Raw fields are read only for the variables of a
+        year that are not in the cache.
+
+    Returns
+    -------
+    dict
+        pyaerocom.GriddedData for each variable in var_list.
+    """
+    print(f'Reading {var_list} from model output')
+    getfile = _catalog_getfile(catalog, getfile, var_list, start_yr, stop_yr,
+                               var_info, calc_how)
+
+    freqs = {}
+    for var in var_list:
+        try:
+            calculate_how = calc_how[var]
+        except KeyError:
+            calculate_how = {'req_vars': [var], 'function': dummy}
+        data_freq = var_info[var]['data_freq']
+        freqs.setdefault(data_freq, {})[var] = calculate_how
+
+    years = range(int(start_yr), int(stop_yr))
+
+    if lazy and num_workers is not None and num_workers > 1:
+        raise ValueError('lazy reading can not be combined with num_workers > 1')
+    if prefetch_depth > 0 and num_workers is not None and num_workers > 1:
+        raise ValueError('prefetch_depth can not be combined with num_workers > 1')
+
+    result = {}
+    for data_freq, calculate_hows in freqs.items():
+        # scratch copies that lazy data reads from
+        staged = []
+        read_year = partial(_read_models_year, getfile=getfile,
+                            data_freq=data_freq, calculate_hows=calculate_hows,
+                            lazy=lazy, memory_budget_mb=memory_budget_mb,
+                            var_info=var_info, cache=cache)
+        if prefetch_depth > 0:
+            raw_fields, _ = plan_shared_reads(calculate_hows)
+            skip = set()
+            if cache is not None:
+                # years with all variables in the cache
+                skip = {year for year in years
+                        if all(cache.make_key(var, year, data_freq,
+                                              calculate_how,
+                                              getfile(year, data_freq))[0]
+                               in cache
+                               for var, calculate_how
+                               in calculate_hows.items())}
+            stage = partial(_stage_model_year, getfile=getfile,
+                            data_freq=data_freq,
+                            names=model_var_names(raw_fields),
+                            scratch_dir=scratch_dir, skip=skip)
+            years_data = _read_ahead(read_year, stage, years, prefetch_depth,
+                                     desc=data_freq,
+                                     keep_staged=staged if lazy else None)
+        else:
+            years_data = _map_years(read_year, years, num_workers,
+                                    max_in_flight, desc=data_freq)
+        data = {var: [] for var in calculate_hows}
+        try:
+            for year_data in years_data:
+                for var, cube in year_data.items():
+                    data[var].append(cube)
+            for var in calculate_hows:
+                result[var] = _concatenate_years(var, data.pop(var), var_info)
+        except BaseException:
+            _release_all(staged)
+            raise
+        # the files are shared by all variables of data_freq
+        _keep_staged([result[var] for var in calculate_hows], staged)
+    if cache is not None:
+        cache.evict()
+    return result
+
+
+def validate_data_freq(var, getfile, year, units, calc_how={},
+                       ts_type='monthly'):
+    """
+    Compare model data averaged from daily files with data of coarser files
+
+    Reads one year of var from the daily file and from the file selected
+    by select_data_freq for ts_type, averages the daily data to ts_type and
+    computes the difference (coarse file - averaged daily data).
+
+    Parameters
+    ----------
+    var : str
+        Variable name (in pyaerocom).
+    getfile : function (int, str) -> str
+        See read_model.
+    year : int
+        Year to compare.
+    units : str
+        Expected units of var.
+    calc_how : dict, optional
+        See read_model.
+    ts_type : str, optional
+        Resolution to compare at. Default is 'monthly'.
+
+    Returns
+    -------
+    dict
+        Max. and mean absolute difference, mean absolute difference relative
+        to the mean absolute value and max. relative difference.
+    """
+    data_freq = select_data_freq(ts_type)
+    if data_freq == 'day':
+        raise ValueError(f'{ts_type} data is read from daily files anyway')
+    daily = read_model(var, getfile, year, int(year) + 1,
+                       {var: {'units': units, 'data_freq': 'day'}}, calc_how)
+    coarse = read_model(var, getfile, year, int(year) + 1,
+                        {var: {'units': units, 'data_freq': data_freq}},
+                        calc_how)
+    daily = daily.resample_time(ts_type)
+
+    ref = np.ma.filled(daily.cube.data.astype(float), np.nan)
+    vals = np.ma.filled(coarse.cube.data.astype(float), np.nan)
+    if ref.shape != vals.shape:
+        raise ValueError(f'Shape of data from daily files {ref.shape} differs '
+                         f'from shape of {data_freq} data {vals.shape}')
+    absdiff = np.abs(vals - ref)
+    nonzero = ref != 0
+    result = {'var': var,
+              'year': int(year),
+              'ts_type': ts_type,
+              'data_freq': data_freq,
+              'max_abs_diff': np.nanmax(absdiff),
+              'mean_abs_diff': np.nanmean(absdiff),
+              'rel_mean_abs_diff': np.nanmean(absdiff) / np.nanmean(np.abs(ref)),
+              'max_rel_diff': np.nanmax(absdiff[nonzero] / np.abs(ref[nonzero]))}
+    print(result)
+    return result
+
+
 if __name__ == '__main__':
     import derive_cubes as der
 
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resampling of the time series of many stations at once
+
+StationData.resample_time resamples one station at a time with pandas,
+step by step from the input to the output frequency (e.g. hourly -> daily
+-> monthly), and sets periods with less than the required number of values
+(min_num_obs, e.g. 18 hours per day and 21 days per month) to NaN.
+resample_stations does the same for the series of all stations of a
+variable: in each step the values are binned into a (station, day) or
+(station, month) masked array, the means of the bins are computed with
+array operations and bins with too few values are masked.
+
+The means are computed with the same compensated (Kahan) summation as
+pandas, so that the values and the NaN pattern are identical to the pandas
+path. Supported aggregations are mean, max and percentiles (e.g.
+'95percentile'), for hourly, daily, weekly and monthly input (see
+can_resample). resample_percentiles computes several percentiles in the
+last step at once, from one sorted copy of the values.
+"""
+import numpy as np
+import pandas as pd
+
+# base frequencies in the order used by pyaerocom.tstype.TsType
+TS_TYPES = ['minutely', 'hourly', 'daily', 'weekly', 'monthly', 'yearly']
+# frequencies of the input and output of the resampling steps
+INPUT_TS_TYPES = ['hourly', 'daily', 'weekly', 'monthly']
+OUTPUT_TS_TYPES = ['daily', 'monthly', 'yearly']
+# offset of the output time stamps (as pyaerocom.helpers.resample_timeseries)
+_OFFSETS = {'daily': None, 'monthly': pd.Timedelta('14D'),
+            'yearly': pd.Timedelta('181D')}
+_NUMPY_UNITS = {'daily': 'D', 'monthly': 'M', 'yearly': 'Y'}
+
+
+def _percentile(how):
+    """Percentile of an aggregation such as '95percentile' (or None)"""
+    if isinstance(how, str) and how.endswith('percentile'):
+        return int(how.split('percentile')[0])
+    return None
+
+
+def _step_how(from_ts_type, to_ts_type, how):
+    """Aggregation of one step, as TimeResampler._get_resample_how"""
+    if isinstance(how, dict):
+        return how.get(to_ts_type, {}).get(from_ts_type, 'mean')
+    if isinstance(how, str):
+        return how
+    return 'mean'
+
+
+def resample_chain(from_ts_type, to_ts_type, min_num_obs=None, how='mean'):
+    """
+    Resampling steps from one frequency to another
+
+    Same as TimeResampler._gen_idx in pyaerocom for base frequencies (without
+    multiplication factors).
+
+    Parameters
+    ----------
+    from_ts_type, to_ts_type : str
+        Input and output frequency, to_ts_type must not be higher than
+        from_ts_type.
+    min_num_obs : dict or int, optional
+        Resampling constraints, e.g. DEFAULT_RESAMPLE_CONSTRAINTS.
+    how : str or dict, optional
+        Aggregation, or aggregation of each step, e.g.
+        dict(daily=dict(hourly='max')) (default is mean).
+
+    Returns
+    -------
+    list
+        (ts_type, min_num, how) for each step.
+    """
+    start = TS_TYPES.index(from_ts_type)
+    stop = TS_TYPES.index(to_ts_type)
+    if stop < start:
+        raise ValueError(f'Cannot resample from {from_ts_type} to '
+                         f'{to_ts_type}')
+    if stop == start:
+        return [(to_ts_type, 0, 'mean')]
+    if min_num_obs is None or not isinstance(min_num_obs, dict):
+        if not isinstance(how, str):
+            raise ValueError(f'Need str how without constraints, got {how}')
+        return [(to_ts_type, int(min_num_obs or 0), how)]
+    chain = []
+    last = from_ts_type
+    for ts_type in TS_TYPES[start + 1:stop + 1]:
+        constraints = min_num_obs.get(ts_type, {})
+        if last in constraints:
+            chain.append((ts_type, int(constraints[last]),
+                          _step_how(last, ts_type, how)))
+            last = ts_type
+    if len(chain) == 0 or chain[-1][0] != to_ts_type:
+        chain.append((to_ts_type, 0, _step_how(last, to_ts_type, how)))
+    return chain
+
+
+def can_resample(from_ts_type, to_ts_type, min_num_obs=None, how='mean'):
+    """
+    Check if resample_stations supports a conversion
+
+    Returns False for conversions that resample_stations does not implement
+    (e.g. other aggregations, frequencies with multiplication factors), which
+    need StationData.resample_time. Conversions to a higher frequency are
+    supported (the result is None, see resample_stations).
+    """
+    if from_ts_type not in INPUT_TS_TYPES or \
+            to_ts_type not in OUTPUT_TS_TYPES:
+        return False
+    if TS_TYPES.index(to_ts_type) < TS_TYPES.index(from_ts_type):
+        return True
+    try:
+        chain = resample_chain(from_ts_type, to_ts_type, min_num_obs, how)
+    except ValueError:
+        return False
+    return all(step in OUTPUT_TS_TYPES and
+               (step_how in ['mean', 'max'] or
+                _percentile(step_how) is not None)
+               for step, _, step_how in chain)
+
+
+def _group_means(keys, values, num_keys):
+    """
+    Mean and number of the valid values with each key
+
+    The values of each key are summed in input order with compensated
+    summation, as in the groupby mean of pandas.
+    """
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    counts = np.bincount(keys, minlength=num_keys)
+    # position of each value within its key, values are processed position
+    # by position for all keys at once
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(keys)) - starts[keys]
+    order = np.argsort(rank, kind='stable')
+    keys, values = keys[order], values[order]
+    bounds = np.searchsorted(rank[order], np.arange(counts.max() + 1
+                                                    if len(keys) else 1))
+    sums = np.zeros(num_keys)
+    comp = np.zeros(num_keys)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        k = keys[lo:hi]
+        y = values[lo:hi] - comp[k]
+        t = sums[k] + y
+        c = t - sums[k] - y
+        c[np.isnan(c)] = 0
+        comp[k] = c
+        sums[k] = t
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return means, counts
+
+
+def _sorted_groups(keys, values, num_keys):
+    """Valid values sorted by key and value, and the number for each key"""
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    order = np.lexsort((values, keys))
+    return values[order], np.bincount(keys, minlength=num_keys)
+
+
+def _group_percentiles(keys, values, num_keys, percentiles, min_num):
+    """
+    Percentiles of the valid values with each key (if at least min_num)
+
+    Same values as numpy.nanpercentile of each group: the groups with the
+    same number of values are stacked and passed to numpy.percentile.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (num_keys, len(percentiles)).
+    numpy.ndarray
+        Number of valid values of each key.
+    """
+    values, counts = _sorted_groups(keys, values, num_keys)
+    starts = np.cumsum(counts) - counts
+    result = np.full((num_keys, len(percentiles)), np.nan)
+    for num in np.unique(counts[counts >= max(min_num, 1)]):
+        group = np.flatnonzero(counts == num)
+        rows = values[starts[group, np.newaxis] + np.arange(num)]
+        result[group] = np.percentile(rows, percentiles, axis=1).T
+    return result, counts
+
+
+def _group_max(keys, values, num_keys):
+    """Max. and number of the valid values with each key"""
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    result = np.full(num_keys, -np.inf)
+    np.maximum.at(result, keys, values)
+    counts = np.bincount(keys, minlength=num_keys)
+    result[counts == 0] = np.nan
+    return result, counts
+
+
+def _resample_step(stations, times, values, num_stations, ts_type, min_num,
+                   how='mean', percentiles=None):
+    """
+    One resampling step of the values of all stations
+
+    Parameters
+    ----------
+    stations : numpy.ndarray
+        Station index of each value.
+    times : numpy.ndarray
+        Time stamps (datetime64) of the values.
+    values : numpy.ndarray
+        Values.
+    num_stations : int
+        Number of stations.
+    ts_type : str
+        Output frequency (see OUTPUT_TS_TYPES).
+    min_num : int
+        Minimum number of valid values per output period.
+    how : str, optional
+        Aggregation ('mean', 'max' or e.g. '95percentile').
+    percentiles : list, optional
+        Compute these percentiles instead of how.
+
+    Returns
+    -------
+    stations, times, values : numpy.ndarray
+        Resampled values in the same format, with all periods between the
+        first and the last period of each station (NaN if masked). With
+        percentiles, values has one column for each percentile.
+    """
+    unit = _NUMPY_UNITS[ts_type]
+    bins = times.astype(f'datetime64[{unit}]').astype(np.int64)
+    b0 = bins.min() if len(bins) > 0 else 0
+    num_bins = bins.max() - b0 + 1 if len(bins) > 0 else 0
+    bins = bins - b0
+    keys = stations * num_bins + bins
+    num_keys = num_stations * num_bins
+    if percentiles is None and _percentile(how) is not None:
+        percentiles = [_percentile(how)]
+        single = True
+    else:
+        single = False
+    if percentiles is not None:
+        result, counts = _group_percentiles(keys, values, num_keys,
+                                            percentiles, min_num)
+    elif how == 'max':
+        result, counts = _group_max(keys, values, num_keys)
+    elif how == 'mean':
+        result, counts = _group_means(keys, values, num_keys)
+    else:
+        raise NotImplementedError(how)
+    # (station, period) array of the results, masked with the constraint
+    shape = (num_stations, num_bins) + result.shape[1:]
+    mask = np.broadcast_to((counts < max(min_num, 1)).reshape(
+        (num_stations, num_bins) + (1,) * (result.ndim - 1)), shape)
+    result = np.ma.masked_array(result.reshape(shape), mask=mask)
+
+    first = np.full(num_stations, num_bins)
+    last = np.full(num_stations, -1)
+    np.minimum.at(first, stations, bins)
+    np.maximum.at(last, stations, bins)
+    lengths = np.maximum(last - first + 1, 0)
+    out_stations = np.repeat(np.arange(num_stations), lengths)
+    offsets = (np.arange(lengths.sum()) -
+               np.repeat(np.cumsum(lengths) - lengths, lengths) +
+               np.repeat(np.minimum(first, num_bins), lengths))
+    out_values = result.filled(np.nan)[out_stations, offsets]
+    if single:
+        out_values = out_values[:, 0]
+    out_times = (b0 + offsets).astype(f'datetime64[{unit}]').astype(
+        'datetime64[ns]')
+    return out_stations, out_times, out_values
+
+
+def _pack(series_list):
+    """Station index, time stamps and values of a list of series"""
+    stations = np.repeat(np.arange(len(series_list)),
+                         [len(ts) for ts in series_list])
+    times = np.concatenate([ts.index.values.astype('datetime64[ns]')
+                            for ts in series_list] +
+                           [np.array([], dtype='datetime64[ns]')])
+    values = np.concatenate([ts.values.astype(np.float64)
+                             for ts in series_list] + [np.array([])])
+    return stations, times, values
+
+
+def _check_supported(ts_types, to_ts_type, min_num_obs, how):
+    for ts_type in set(ts_types):
+        if not can_resample(ts_type, to_ts_type, min_num_obs, how):
+            raise NotImplementedError(f'Resampling from {ts_type} to '
+                                      f'{to_ts_type} ({how})')
+
+
+def _groups(ts_types, to_ts_type):
+    """Stations of each input frequency that can be resampled"""
+    for ts_type in dict.fromkeys(ts_types):
+        if TS_TYPES.index(to_ts_type) < TS_TYPES.index(ts_type):
+            continue
+        yield ts_type, [i for i, tst in enumerate(ts_types) if tst == ts_type]
+
+
+def _unpack(stations, times, num_stations, to_ts_type):
+    """Time index and bounds of the values of each station"""
+    index = pd.DatetimeIndex(times)
+    if _OFFSETS[to_ts_type] is not None:
+        index = index + _OFFSETS[to_ts_type]
+    bounds = np.searchsorted(stations, np.arange(num_stations + 1))
+    return index, bounds
+
+
+def resample_stations(series_list, ts_types, to_ts_type, min_num_obs=None,
+                      how='mean'):
+    """
+    Resample the time series of many stations
+
+    Equivalent to StationData.resample_time(var, to_ts_type, how=how,
+    min_num_obs=min_num_obs)[var] for each station.
+
+    Parameters
+    ----------
+    series_list : list
+        pandas.Series of each station (with sorted DatetimeIndex).
+    ts_types : list
+        Frequency of each series (see StationData.get_var_ts_type).
+    to_ts_type : str
+        Output frequency.
+    min_num_obs : dict or int, optional
+        Resampling constraints, e.g. DEFAULT_RESAMPLE_CONSTRAINTS.
+    how : str or dict, optional
+        Aggregation, see resample_chain.
+
+    Returns
+    -------
+    list
+        Resampled pandas.Series of each station, or None where to_ts_type is
+        higher than the frequency of the series (where resample_time raises
+        TemporalResolutionError).
+    """
+    _check_supported(ts_types, to_ts_type, min_num_obs, how)
+    result = [None] * len(series_list)
+    # stations with the same input frequency go through the same steps
+    for ts_type, idx in _groups(ts_types, to_ts_type):
+        stations, times, values = _pack([series_list[i] for i in idx])
+        for step, min_num, step_how in resample_chain(ts_type, to_ts_type,
+                                                      min_num_obs, how):
+            stations, times, values = _resample_step(
+                stations, times, values, len(idx), step, min_num, step_how)
+        index, bounds = _unpack(stations, times, len(idx), to_ts_type)
+        for j, i in enumerate(idx):
+            lo, hi = bounds[j], bounds[j + 1]
+            result[i] = pd.Series(values[lo:hi], index=index[lo:hi],
+                                  name=series_list[i].name)
+    return result
+
+
+def resample_percentiles(series_list, ts_types, to_ts_type, percentiles,
+                         min_num_obs=None, how='mean'):
+    """
+    Resample the time series of many stations to several percentiles
+
+    Same result as resample_stations for each percentile, with the
+    percentile as aggregation of the last step (e.g. daily -> yearly), but
+    the steps before and the sorting of the values are done only once.
+
+    Parameters
+    ----------
+    series_list, ts_types, to_ts_type, min_num_obs
+        See resample_stations.
+    percentiles : list
+        Percentiles (int).
+    how : str or dict, optional
+        Aggregation of the steps before the last one, see resample_chain.
+
+    Returns
+    -------
+    list
+        pandas.DataFrame of each station with one column for each
+        percentile, or None (see resample_stations).
+    """
+    last_how = f'{percentiles[0]}percentile'
+    result = [None] * len(series_list)
+    for ts_type, idx in _groups(ts_types, to_ts_type):
+        chain = resample_chain(ts_type, to_ts_type, min_num_obs, how)
+        # the last step with a percentile as aggregation
+        last_from = chain[-2][0] if len(chain) > 1 else ts_type
+        if not isinstance(min_num_obs, dict):
+            how_last = last_how
+        elif isinstance(how, dict):
+            how_last = {**how, to_ts_type: {last_from: last_how}}
+        else:
+            how_last = {to_ts_type: {last_from: last_how}}
+        _check_supported([ts_type], to_ts_type, min_num_obs, how_last)
+        stations, times, values = _pack([series_list[i] for i in idx])
+        for step, min_num, step_how in chain[:-1]:
+            stations, times, values = _resample_step(
+                stations, times, values, len(idx), step, min_num, step_how)
+        step, min_num, _ = chain[-1]
+        stations, times, values = _resample_step(
+            stations, times, values, len(idx), step, min_num,
+            percentiles=percentiles)
+        index, bounds = _unpack(stations, times, len(idx), to_ts_type)
+        for j, i in enumerate(idx):
+            lo, hi = bounds[j], bounds[j + 1]
+            result[i] = pd.DataFrame(values[lo:hi], index=index[lo:hi],
+                                     columns=list(percentiles))
+    return result
+
+
+def resample_sites(sites, var, ts_types, min_num_obs=None, how='mean'):
+    """
+    Resample a variable of many stations to the highest possible frequency
+
+    For each station, same as calling StationData.resample_time for each
+    frequency in ts_types until it does not raise TemporalResolutionError.
+    Stations whose conversion is not supported by resample_stations are
+    resampled with StationData.resample_time.
+
+    Parameters
+    ----------
+    sites : list
+        pyaerocom.StationData of each station.
+    var : str
+        Variable name.
+    ts_types : list
+        Output frequencies in order of preference, e.g. ['daily', 'monthly'].
+    min_num_obs : dict or int, optional
+        Resampling constraints, e.g. DEFAULT_RESAMPLE_CONSTRAINTS.
+    how : str or dict, optional
+        Aggregation, see resample_chain.
+
+    Returns
+    -------
+    list
+        (pandas.Series, ts_type) of each station, or None if none of the
+        frequencies is possible.
+    """
+    from pyaerocom.exceptions import (MetaDataError,
+                                      TemporalResolutionError)
+    result = [None] * len(sites)
+    todo = list(range(len(sites)))
+    for to_ts_type in ts_types:
+        batch, series, from_ts_types, fallback = [], [], [], []
+        for i in todo:
+            try:
+                from_ts_type = sites[i].get_var_ts_type(var)
+            except (MetaDataError, TemporalResolutionError):
+                from_ts_type = None
+            if isinstance(sites[i][var], pd.Series) and can_resample(
+                    from_ts_type, to_ts_type, min_num_obs, how):
+                batch.append(i)
+                series.append(sites[i][var])
+                from_ts_types.append(from_ts_type)
+            else:
+                fallback.append(i)
+        todo = []
+        for i, ts in zip(batch, resample_stations(series, from_ts_types,
+                                                  to_ts_type, min_num_obs,
+                                                  how)):
+            if ts is None:
+                todo.append(i)
+            else:
+                result[i] = (ts, to_ts_type)
+        for i in fallback:
+            try:
+                site = sites[i].resample_time(var_name=var,
+                                              ts_type=to_ts_type,
+                                              min_num_obs=min_num_obs,
+                                              how=how)
+                result[i] = (site[var], to_ts_type)
+            except TemporalResolutionError:
+                todo.append(i)
+        todo.sort()
+    return result
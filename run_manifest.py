@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifest of the inputs of the output of each variable
+
+Each output directory keeps a manifest (manifest.json) with a fingerprint
+of the inputs each variable was processed from: the EBAS and model files
+(path, mtime and size), the periods, seasons, filters, resample settings
+and other options of the script that wrote it. A script can then skip a
+variable whose fingerprint did not change since its output was written,
+instead of deleting and rewriting all its files (pass --force to the
+scripts to process all variables).
+
+The fingerprint does not cover changes of the code; use --force (or clear
+the manifest) after changing the processing.
+
+Usage:
+    python run_manifest.py OUTPUT_DIR show
+    python run_manifest.py OUTPUT_DIR clear [--var VAR ...]
+"""
+import os, json, hashlib, argparse
+import pandas as pd
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_stats(paths):
+    """
+    mtime and size of files
+
+    Parameters
+    ----------
+    paths : list
+        File paths.
+
+    Returns
+    -------
+    dict
+        [mtime, size] for each absolute path (None if the file does not
+        exist).
+    """
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats[os.path.abspath(path)] = [stat.st_mtime, stat.st_size]
+        except FileNotFoundError:
+            stats[os.path.abspath(path)] = None
+    return stats
+
+
+def make_key(content):
+    """Fingerprint (hex digest) of the inputs of a variable"""
+    return hashlib.sha1(json.dumps(content, sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+class RunManifest(object):
+    """
+    Fingerprints of the inputs of each variable in an output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory, e.g. 'obs_output'.
+
+    Attributes
+    ----------
+    entries : dict
+        Key, content and time of the last update of each variable.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    @property
+    def path(self):
+        return os.path.join(self.output_dir, MANIFEST_FILE)
+
+    def is_current(self, var, content, outputs=()):
+        """
+        Check if the output of a variable was made from the same inputs
+
+        Parameters
+        ----------
+        var : str
+            Variable name.
+        content : dict
+            Inputs of the variable (file stats and settings, JSON
+            serialisable or converted with str).
+        outputs : list, optional
+            Output files of the variable, which must exist.
+
+        Returns
+        -------
+        bool
+            True if the fingerprint of content is the stored one.
+        """
+        entry = self.entries.get(var)
+        if entry is None or entry['key'] != make_key(content):
+            return False
+        return all(os.path.exists(path) for path in outputs)
+
+    def update(self, var, content):
+        """Store the fingerprint of the inputs of a variable and save"""
+        self.entries[var] = {'key': make_key(content),
+                             'content': json.loads(json.dumps(content,
+                                                              default=str)),
+                             'time': str(pd.Timestamp.now())}
+        self.save()
+
+    def remove(self, var):
+        """Remove the entry of a variable (it will be processed again)"""
+        if self.entries.pop(var, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Inspect or clear the run manifest of an output directory')
+    parser.add_argument('output_dir')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('show', help='list the variables in the manifest')
+    clear = subparsers.add_parser('clear', help='remove entries')
+    clear.add_argument('--var', nargs='+')
+    args = parser.parse_args()
+
+    manifest = RunManifest(args.output_dir)
+    if args.command == 'show':
+        for var, entry in manifest.entries.items():
+            content = entry['content']
+            files = {key: len(val) for key, val in content.items()
+                     if key.endswith('files') and isinstance(val, dict)}
+            print(f'{var}: {content.get("script")}, updated {entry["time"]}, '
+                  f'{files}')
+    elif args.command == 'clear':
+        for var in args.var or list(manifest.entries):
+            manifest.remove(var)
+        print(f'{len(manifest.entries)} entries left')
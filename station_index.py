@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the model grid cells at the stations
+
+Colocation looks up the model grid cell closest to each station, for every
+variable and run, although the model grid and the stations are the same.
+StationIndex computes the cells once and stores them on disk, keyed by the
+grid definition and the station coordinates. Extracting the model time
+series at the stations is then a gather operation on the model array.
+
+For grids with 1-D latitude and longitude coordinates (such as EMEP01) the
+nearest cell is found analytically per coordinate, with the same result as
+the nearest neighbour selection of xarray used by pyaerocom (ties go to the
+larger coordinate value). For 2-D coordinates a KD-tree is used. Optionally
+bilinear interpolation weights are stored as well (1-D coordinates only).
+The indices are only stored if an index directory is given, e.g.
+INDEX_DIR, which is also the default of the command line interface.
+
+Usage:
+    python station_index.py [--index-dir DIR] info
+    python station_index.py [--index-dir DIR] purge
+"""
+import os, glob, hashlib, argparse
+import numpy as np
+
+# suggested directory of the stored indices
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'emep_trends',
+                         'station_index')
+
+
+def nearest_index(coord, points):
+    """
+    Index of the nearest value of a monotonic coordinate for each point
+
+    Same as pandas.Index.get_indexer(points, method='nearest'), i.e. ties
+    are resolved in favour of the larger coordinate value.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        Strictly monotonic 1-D coordinate.
+    points : numpy.ndarray
+        Points to look up.
+
+    Returns
+    -------
+    numpy.ndarray
+        Integer index into coord.
+    """
+    coord = np.asarray(coord, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    n = len(coord)
+    decreasing = n > 1 and coord[0] > coord[-1]
+    asc = coord[::-1] if decreasing else coord
+    # last value <= point and the next one
+    lo = np.searchsorted(asc, points, side='right') - 1
+    hi = lo + 1
+    lo_c, hi_c = np.clip(lo, 0, n - 1), np.clip(hi, 0, n - 1)
+    use_hi = ((lo < 0) |
+              ((hi < n) &
+               (np.abs(asc[hi_c] - points) <= np.abs(asc[lo_c] - points))))
+    idx = np.where(use_hi, hi_c, lo_c)
+    if decreasing:
+        idx = n - 1 - idx
+    return idx
+
+
+def _bilinear_1d(coord, points):
+    """Lower index and weight of the upper neighbour for each point"""
+    coord = np.asarray(coord, dtype=np.float64)
+    n = len(coord)
+    decreasing = n > 1 and coord[0] > coord[-1]
+    asc = coord[::-1] if decreasing else coord
+    lo = np.clip(np.searchsorted(asc, points, side='right') - 1, 0, n - 2)
+    weight = (points - asc[lo]) / (asc[lo + 1] - asc[lo])
+    weight = np.clip(weight, 0, 1)
+    if decreasing:
+        # lower neighbour in ascending order is the upper one in coord
+        return n - 2 - lo, 1 - weight
+    return lo, weight
+
+
+class StationIndex(object):
+    """
+    Model grid cells (and optionally bilinear weights) of stations
+
+    Parameters
+    ----------
+    iy, ix : numpy.ndarray
+        Index of the nearest cell of each station along the latitude (or y)
+        and longitude (or x) dimension.
+    corners : numpy.ndarray, optional
+        Indices of the 4 cells around each station, shape (stations, 4, 2).
+    weights : numpy.ndarray, optional
+        Bilinear weights of the corners, shape (stations, 4).
+    """
+    def __init__(self, iy, ix, corners=None, weights=None):
+        self.iy = np.asarray(iy, dtype=int)
+        self.ix = np.asarray(ix, dtype=int)
+        self.corners = corners
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.iy)
+
+    @staticmethod
+    def make_key(grid_lats, grid_lons, lats, lons, bilinear=False):
+        """Key of the grid definition, station coordinates and method"""
+        key = hashlib.sha1()
+        for arr in [grid_lats, grid_lons, lats, lons]:
+            arr = np.ascontiguousarray(arr, dtype=np.float64)
+            key.update(str(arr.shape).encode())
+            key.update(arr.tobytes())
+        key.update(b'bilinear' if bilinear else b'nearest')
+        return key.hexdigest()
+
+    @classmethod
+    def build(cls, grid_lats, grid_lons, lats, lons, bilinear=False):
+        """
+        Compute the index
+
+        Parameters
+        ----------
+        grid_lats, grid_lons : numpy.ndarray
+            Latitudes and longitudes of the grid cell centres, either 1-D
+            coordinates or 2-D arrays (y, x).
+        lats, lons : numpy.ndarray
+            Station coordinates.
+        bilinear : bool, optional
+            Also compute bilinear weights (only for 1-D coordinates).
+
+        Raises
+        ------
+        ValueError
+            If bilinear is requested for a grid with 2-D coordinates.
+        """
+        grid_lats, grid_lons = np.asarray(grid_lats), np.asarray(grid_lons)
+        if bilinear and grid_lats.ndim != 1:
+            raise ValueError(f'bilinear weights need 1-D lat and lon '
+                             f'coordinates, not a curvilinear grid with 2-D '
+                             f'coordinates of shape {grid_lats.shape}')
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if grid_lats.ndim == 1:
+            index = cls(nearest_index(grid_lats, lats),
+                        nearest_index(grid_lons, lons))
+            if bilinear:
+                y0, wy = _bilinear_1d(grid_lats, lats)
+                x0, wx = _bilinear_1d(grid_lons, lons)
+                index.corners = np.stack([np.stack([y0, x0], axis=1),
+                                          np.stack([y0, x0 + 1], axis=1),
+                                          np.stack([y0 + 1, x0], axis=1),
+                                          np.stack([y0 + 1, x0 + 1], axis=1)],
+                                         axis=1)
+                index.weights = np.stack([(1 - wy) * (1 - wx),
+                                          (1 - wy) * wx,
+                                          wy * (1 - wx),
+                                          wy * wx], axis=1)
+            return index
+
+        from scipy.spatial import cKDTree
+        tree = cKDTree(_to_xyz(grid_lats.ravel(), grid_lons.ravel()))
+        _, flat = tree.query(_to_xyz(lats, lons))
+        iy, ix = np.unravel_index(flat, grid_lats.shape)
+        return cls(iy, ix)
+
+    @classmethod
+    def load_or_build(cls, grid_lats, grid_lons, lats, lons, bilinear=False,
+                      index_dir=None):
+        """
+        Load the index from index_dir, or build and store it
+
+        Parameters are as in build. If index_dir is None (default), the index
+        is built and not stored.
+        """
+        if index_dir is None:
+            return cls.build(grid_lats, grid_lons, lats, lons, bilinear)
+        key = cls.make_key(grid_lats, grid_lons, lats, lons, bilinear)
+        path = os.path.join(index_dir, f'{key}.npz')
+        if os.path.exists(path):
+            with np.load(path) as f:
+                arrays = {name: f[name] for name in f.files}
+            return cls(**arrays)
+        index = cls.build(grid_lats, grid_lons, lats, lons, bilinear)
+        os.makedirs(index_dir, exist_ok=True)
+        arrays = {'iy': index.iy, 'ix': index.ix}
+        if bilinear:
+            arrays.update(corners=index.corners, weights=index.weights)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        return index
+
+    def gather(self, arr, bilinear=False):
+        """
+        Values of an array at the stations
+
+        Parameters
+        ----------
+        arr : numpy.ndarray or dask.array.Array
+            Array whose last two dimensions are latitude (y) and longitude
+            (x), e.g. (time, lat, lon).
+        bilinear : bool, optional
+            Interpolate bilinearly instead of taking the nearest cell.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (..., stations).
+        """
+        if not bilinear:
+            return _take_cells(arr, self.iy, self.ix)
+        if self.weights is None:
+            raise ValueError('index has no bilinear weights')
+        result = 0
+        for c in range(4):
+            values = _take_cells(arr, self.corners[:, c, 0],
+                                 self.corners[:, c, 1])
+            result = result + values * self.weights[:, c]
+        return result
+
+
+def _take_cells(arr, iy, ix):
+    if hasattr(arr, 'vindex'):
+        # dask array, only the chunks containing the cells are computed
+        arr = np.moveaxis(arr, [-2, -1], [0, 1])
+        return np.moveaxis(np.asanyarray(arr.vindex[iy, ix]), 0, -1)
+    return np.asanyarray(arr)[..., iy, ix]
+
+
+def _to_xyz(lats, lons):
+    """Points on the unit sphere"""
+    lats, lons = np.deg2rad(lats), np.deg2rad(lons)
+    return np.stack([np.cos(lats) * np.cos(lons),
+                     np.cos(lats) * np.sin(lons),
+                     np.sin(lats)], axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Inspect or purge stored station indices')
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('info', help='list stored indices')
+    subparsers.add_parser('purge', help='remove all stored indices')
+    args = parser.parse_args()
+
+    paths = glob.glob(os.path.join(args.index_dir, '*.npz'))
+    if args.command == 'info':
+        for path in paths:
+            with np.load(path) as f:
+                kind = 'bilinear' if 'weights' in f.files else 'nearest'
+                print(f'{os.path.basename(path)[:-len(".npz")]}: '
+                      f'{len(f["iy"])} stations, {kind}')
+        print(f'{len(paths)} indices in {args.index_dir}')
+    elif args.command == 'purge':
+        for path in paths:
+            os.remove(path)
+        print(f'Removed {len(paths)} indices')
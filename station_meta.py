@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Station metadata of ungridded data, without converting the station data
+
+UngriddedData.to_station_data converts (and merges, if a station has several
+metadata blocks) the data of a station only to provide its metadata.
+StationMetaIndex reads the metadata blocks of all stations once and merges
+the metadata of each station and variable in the same way as
+pyaerocom.helpers.merge_station_data: the blocks with data in the time range
+are sorted by the preferred merge attribute of the data source (e.g.
+revision_date for EBAS) or else by the number of values, coordinates are
+taken from the first block and string items are joined with ';'.
+
+Counting the values of a block needs the data array of UngriddedData, which
+has no public accessor, so the blocks are only read with the pyaerocom
+versions in META_INDEX_VERSIONS. Stations that are not in the index (e.g.
+with other pyaerocom versions) are looked up with to_station_data.
+"""
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+
+META_FIELDS = ['station_id', 'station_name', 'latitude', 'longitude',
+               'altitude', 'framework', 'unit', 'matrix']
+
+# pyaerocom versions whose UngriddedData layout the metadata blocks are read
+# with
+META_INDEX_VERSIONS = ['0.10', '0.11', '0.12']
+
+
+def _has_meta_index():
+    """Whether the metadata blocks can be read with this pyaerocom"""
+    version = '.'.join(pya.__version__.split('.')[:2])
+    return version in META_INDEX_VERSIONS
+
+
+def _join_items(current, val):
+    """Merge two str meta items as StationData._merge_meta_item"""
+    if current is None:
+        return val
+    if val is None or current == val:
+        return current
+    for item in [x.strip() for x in val.split(';')]:
+        if not item in current:
+            current += f';{item}'
+    return current
+
+
+def _join_var_info(current, val):
+    """Merge two str var_info items as StationData.merge_varinfo"""
+    if current is None:
+        return val
+    if val is None:
+        return current
+    vals = [x.strip() for x in current.split(';')]
+    for item in [x.strip() for x in val.split(';')]:
+        if not item in vals:
+            current += f';{item}'
+    return current
+
+
+class StationMetaIndex(object):
+    """
+    Metadata of each station and variable in ungridded data
+
+    Parameters
+    ----------
+    data : pyaerocom.UngriddedData
+        Observations.
+    var_list : str or list
+        Variables.
+    start, stop : optional
+        Only metadata blocks with valid values in this time range are used
+        (as in UngriddedData.to_station_data).
+
+    Attributes
+    ----------
+    rows : dict
+        Metadata (dict with META_FIELDS) for each (var, station_name).
+    """
+    def __init__(self, data, var_list, start=None, stop=None):
+        from pyaerocom.helpers import start_stop
+        if isinstance(var_list, str):
+            var_list = [var_list]
+        self._data = data
+        self._start, self._stop = start, stop
+        self.rows = {}
+        if not _has_meta_index():
+            print(f'Station metadata index not available for pyaerocom '
+                  f'{pya.__version__}, using to_station_data')
+            return
+        if start is None and stop is None:
+            start, stop = pd.Timestamp('1970'), pd.Timestamp('2200')
+        else:
+            start, stop = start_stop(start, stop)
+        start, stop = np.datetime64(start), np.datetime64(stop)
+
+        arr = data._data
+        time_col, data_col = data.index['time'], data.index['data']
+        blocks = {}
+        pref_attrs = {}
+        for meta_idx, meta in data.metadata.items():
+            for var in var_list:
+                if not var in data.meta_idx[meta_idx]:
+                    continue
+                var_idx = data.meta_idx[meta_idx][var]
+                dtime = arr[var_idx, time_col].astype('datetime64[s]')
+                vals = arr[var_idx, data_col]
+                vals = vals[(dtime >= start) & (dtime <= stop)]
+                num = np.sum(~np.isnan(vals))
+                if num == 0:
+                    continue
+                blocks.setdefault((var, meta['station_name']), []).append(
+                    (meta, num))
+                data_id = meta.get('data_id')
+                if not data_id in pref_attrs:
+                    pref_attrs[data_id] = self._pref_attr(data_id)
+
+        for key, items in blocks.items():
+            var = key[0]
+            data_ids = {meta.get('data_id') for meta, _ in items}
+            pref_attr = (pref_attrs[data_ids.pop()]
+                         if len(data_ids) == 1 else None)
+            if pref_attr is not None and any(meta.get(pref_attr) is None
+                                             for meta, _ in items):
+                pref_attr = None
+            if len(items) > 1 and pref_attr is not None:
+                items = sorted(items, key=lambda x: x[0][pref_attr])[::-1]
+            elif len(items) > 1:
+                items = sorted(items, key=lambda x: x[1])[::-1]
+            self.rows[key] = self._merge(var, [meta for meta, _ in items])
+
+    @staticmethod
+    def _pref_attr(data_id):
+        """Preferred merge attribute of a data source (or None)"""
+        from pyaerocom.metastandards import DataSource
+        if data_id is None:
+            return None
+        return DataSource(data_id=data_id).stat_merge_pref_attr
+
+    @staticmethod
+    def _merge(var, metas):
+        first = metas[0]
+        row = {'station_name': first['station_name'],
+               'latitude': first.get('latitude'),
+               'longitude': first.get('longitude'),
+               'altitude': first.get('altitude'),
+               'station_id': None,
+               'framework': None,
+               'unit': None,
+               'matrix': None}
+        for meta in metas:
+            for key in ['station_id', 'framework']:
+                row[key] = _join_items(row[key], meta.get(key))
+            var_info = meta.get('var_info', {}).get(var, {})
+            row['unit'] = _join_var_info(row['unit'], var_info.get('units'))
+            row['matrix'] = _join_var_info(row['matrix'],
+                                           var_info.get('matrix'))
+        return row
+
+    @staticmethod
+    def _from_station_data(var, stat):
+        """Metadata of a variable in StationData"""
+        var_info = stat.var_info.get(var, {})
+        return {'station_name': stat.station_name,
+                'latitude': stat.latitude,
+                'longitude': stat.longitude,
+                'altitude': stat.altitude,
+                'station_id': stat.station_id,
+                'framework': stat.framework,
+                'unit': var_info.get('units'),
+                'matrix': var_info.get('matrix')}
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __getitem__(self, key):
+        """
+        Metadata of (var, station_name)
+
+        Stations that are not in the index are converted with
+        UngriddedData.to_station_data (and added to the index).
+        """
+        try:
+            return self.rows[key]
+        except KeyError:
+            pass
+        var, station_name = key
+        stat = self._data.to_station_data(station_name, var,
+                                          start=self._start, stop=self._stop)
+        self.rows[key] = self._from_station_data(var, stat)
+        return self.rows[key]
+
+    def table(self, var=None):
+        """
+        Metadata as table
+
+        Parameters
+        ----------
+        var : str, optional
+            Only stations of this variable.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per station (and variable), columns var and META_FIELDS.
+        """
+        rows = [dict(var=key[0], **row) for key, row in self.rows.items()
+                if var is None or key[0] == var]
+        return pd.DataFrame(rows, columns=['var'] + META_FIELDS)
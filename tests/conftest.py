@@ -0,0 +1,42 @@
+import os, sys
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+# the scripts and modules are in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_emep_file(path, year, freq='day', seed=0, units='ug/m3'):
+    """Write a small EMEP-like model file with SURF_ug_PM10_rh50"""
+    rng = np.random.default_rng(seed + year)
+    times = pd.date_range(f'{year}-01-01', f'{year}-12-31',
+                          freq={'day': 'D', 'month': 'MS'}[freq])
+    lats = np.arange(50., 56.)
+    lons = np.arange(0., 8.)
+    values = rng.random((len(times), len(lats), len(lons))) * 20
+    attrs = {} if units is None else {'units': units}
+    ds = xr.Dataset(
+        {'SURF_ug_PM10_rh50': (('time', 'lat', 'lon'), values, attrs)},
+        coords={'time': times,
+                'lat': ('lat', lats, {'units': 'degrees_north',
+                                      'standard_name': 'latitude'}),
+                'lon': ('lon', lons, {'units': 'degrees_east',
+                                      'standard_name': 'longitude'})})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_netcdf(path)
+
+
+@pytest.fixture
+def emep_files(tmp_path):
+    """getfile function (see read_mods.read_model) of model files 2010-2012"""
+    root = tmp_path / 'model'
+    for year in [2010, 2011, 2012]:
+        for freq in ['day', 'month']:
+            write_emep_file(str(root / str(year) / f'Base_{freq}.nc'), year,
+                            freq)
+
+    def getfile(year, data_freq):
+        return str(root / str(year) / f'Base_{data_freq}.nc')
+    return getfile
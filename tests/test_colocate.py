@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+import pytest
+
+import colocate
+import read_mods
+
+VAR_INFO = {'concpm10': {'units': 'ug m-3', 'data_freq': 'day'}}
+MIN_NUM_OBS = {'monthly': {'daily': 10}}
+
+
+@pytest.fixture
+def obs():
+    """Daily observations with gaps at three stations in the model domain"""
+    rng = np.random.default_rng(1)
+    times = pd.date_range('2010-01-01', '2011-12-31', freq='D')
+    stats = []
+    for name, lat, lon in [('A', 50.2, 0.1), ('B', 53.4, 4.6),
+                           ('C', 54.6, 6.8)]:
+        values = rng.random(len(times)) * 20
+        values[rng.random(len(times)) < 0.3] = np.nan
+        stat = pya.StationData(station_name=name, station_id=name,
+                               latitude=lat, longitude=lon, altitude=10.,
+                               data_id='obs', dataset_name='obs',
+                               ts_type='daily')
+        stat['concpm10'] = pd.Series(values, index=times)
+        stat.var_info['concpm10'] = {'units': 'ug m-3'}
+        stats.append(stat)
+    return pya.UngriddedData.from_station_data(stats)
+
+
+@pytest.mark.parametrize('colocate_time', [False, True])
+def test_index_colocation_same_as_pyaerocom(emep_files, obs, tmp_path,
+                                            colocate_time):
+    data = read_mods.read_model('concpm10', emep_files, 2010, 2012, VAR_INFO)
+    kwargs = dict(ts_type='monthly', start=2010, stop=2012,
+                  min_num_obs=MIN_NUM_OBS, colocate_time=colocate_time,
+                  resample_how='mean')
+    ref = pya.colocation.colocate_gridded_ungridded(data, obs, **kwargs)
+    coldata = colocate.colocate_gridded_ungridded(
+        data, obs, use_index=True, index_dir=str(tmp_path / 'index'),
+        **kwargs)
+    assert list(coldata.data['station_name'].values) == ['A', 'B', 'C']
+    np.testing.assert_allclose(coldata.data.values, ref.data.values)
+    assert coldata.data.attrs == ref.data.attrs
+
+
+def test_fallback_to_pyaerocom(emep_files, obs, monkeypatch):
+    data = read_mods.read_model('concpm10', emep_files, 2010, 2011, VAR_INFO)
+    monkeypatch.setattr(colocate, 'INDEX_COLOCATION_VERSIONS', [])
+    ref = pya.colocation.colocate_gridded_ungridded(data, obs,
+                                                    ts_type='monthly')
+    coldata = colocate.colocate_gridded_ungridded(data, obs,
+                                                  ts_type='monthly',
+                                                  use_index=True)
+    np.testing.assert_allclose(coldata.data.values, ref.data.values)
+    with pytest.raises(ValueError, match='bilinear'):
+        colocate.colocate_gridded_ungridded(data, obs, ts_type='monthly',
+                                            bilinear=True)
@@ -0,0 +1,47 @@
+import numpy as np
+import iris
+
+import model_cache
+from model_cache import ModelCache
+
+CALCULATE_HOW = {'req_vars': ['concpm10'], 'function': lambda cube: cube}
+
+
+def test_key_changes_with_version(emep_files, monkeypatch):
+    path = emep_files(2010, 'day')
+    key, content = ModelCache.make_key('concpm10', 2010, 'day', CALCULATE_HOW,
+                                       path)
+    assert content['version'] == model_cache.CACHE_VERSION
+    monkeypatch.setattr(model_cache, 'CACHE_VERSION',
+                        model_cache.CACHE_VERSION + 1)
+    assert ModelCache.make_key('concpm10', 2010, 'day', CALCULATE_HOW,
+                               path)[0] != key
+
+
+def test_key_changes_with_function_source(emep_files):
+    path = emep_files(2010, 'day')
+
+    def derive(cube):
+        return cube
+    key = ModelCache.make_key('concpm10', 2010, 'day',
+                              {'req_vars': ['concpm10'], 'function': derive},
+                              path)[0]
+
+    def derive(cube):
+        return cube * 2
+    assert ModelCache.make_key('concpm10', 2010, 'day',
+                               {'req_vars': ['concpm10'], 'function': derive},
+                               path)[0] != key
+
+
+def test_save_load_cube_with_pyaerocom_attributes(tmp_path):
+    cache = ModelCache(str(tmp_path))
+    cube = iris.cube.Cube(np.arange(6.).reshape(2, 3), var_name='concpm10',
+                          units='ug m-3',
+                          attributes={'computed': True, 'reader': object()})
+    cache.save('abc', {'var': 'concpm10'}, cube)
+    assert cube.attributes['computed'] is True
+    loaded = cache.load('abc')
+    np.testing.assert_array_equal(loaded.data, cube.data)
+    assert loaded.attributes['computed'] == 1
+    assert isinstance(loaded.attributes['reader'], str)
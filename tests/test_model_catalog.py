@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import read_mods
+from model_catalog import ModelCatalog
+from conftest import write_emep_file
+
+VAR_INFO = {'concpm10': {'units': 'ug m-3', 'data_freq': 'day'}}
+
+
+@pytest.fixture
+def catalog(emep_files):
+    return ModelCatalog.build(emep_files, years=[2010, 2011, 2012],
+                              data_freqs=['day'])
+
+
+def test_check_passes(catalog):
+    catalog.check(['concpm10'], VAR_INFO, 2010, 2013)
+
+
+def test_check_missing_year(catalog):
+    with pytest.raises(ValueError, match='No day model data for year 2013'):
+        catalog.check(['concpm10'], VAR_INFO, 2010, 2014)
+
+
+def test_check_unexpected_units(catalog):
+    var_info = {'concpm10': {'units': 'ug m-2', 'data_freq': 'day'}}
+    with pytest.raises(ValueError, match='expected are ug m-2'):
+        catalog.check(['concpm10'], var_info, 2010, 2013)
+
+
+def test_check_unconvertible_file_units(tmp_path):
+    path = str(tmp_path / '2010' / 'Base_day.nc')
+    write_emep_file(path, 2010, units='mm')
+    catalog = ModelCatalog.build(lambda year, freq: path, years=[2010],
+                                 data_freqs=['day'])
+    with pytest.raises(ValueError, match='can not be converted'):
+        catalog.check(['concpm10'], VAR_INFO, 2010, 2011)
+
+
+def test_read_model_with_catalog(emep_files, catalog):
+    ref = read_mods.read_model('concpm10', emep_files, 2010, 2013, VAR_INFO)
+    data = read_mods.read_model('concpm10', None, 2010, 2013, VAR_INFO,
+                                catalog=catalog)
+    np.testing.assert_allclose(data.cube.data, ref.cube.data)
+
+
+def test_read_model_with_catalog_fails_before_reading(catalog, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('model file read')
+    monkeypatch.setattr(read_mods, '_read_model_year', fail)
+    var_info = {'concpm10': {'units': 'ug m-2', 'data_freq': 'day'}}
+    with pytest.raises(ValueError, match='Model data check failed'):
+        read_mods.read_model('concpm10', None, 2010, 2013, var_info,
+                             catalog=catalog)
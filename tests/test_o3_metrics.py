@@ -0,0 +1,123 @@
+import importlib
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from o3_metrics import grid_percentiles, station_daily_max
+from resample_batch import resample_percentiles
+
+YEARS = [2010, 2011]
+MIN_NUM_OBS = dict(yearly=dict(daily=330), daily=dict(hourly=18))
+PERCENTILES = [10, 50, 95]
+LATS = np.arange(50., 54.)
+LONS = np.arange(0., 5.)
+
+
+def write_hourly_file(path, year, seed=0):
+    """Hourly O3 file of a year, from 01:00 on Jan 1 to 00:00 on Jan 1 of
+    the next year (as the EMEP output)"""
+    rng = np.random.default_rng(seed + year)
+    times = pd.date_range(f'{year}-01-01 01:00', f'{year + 1}-01-01 00:00',
+                          freq='H')
+    values = rng.random((len(times), len(LATS), len(LONS))) * 60
+    values[rng.random(values.shape) < 0.02] = np.nan
+    # the maximum of Jan 1 of the next year is at 00:00, in this file
+    values[-1] = 100
+    # a year with too few valid days at the first cell
+    if year == 2011:
+        values[:24 * 60, 0, 0] = np.nan
+    ds = xr.Dataset(
+        {'SURF_ppb_O3': (('time', 'lat', 'lon'), values, {'units': 'ppb'})},
+        coords={'time': times,
+                'lat': ('lat', LATS, {'units': 'degrees_north',
+                                      'standard_name': 'latitude'}),
+                'lon': ('lon', LONS, {'units': 'degrees_east',
+                                      'standard_name': 'longitude'})})
+    ds.to_netcdf(path)
+    return ds['SURF_ppb_O3'].to_series()
+
+
+@pytest.fixture
+def hourly(tmp_path):
+    """getfile function and hourly values (pandas.Series) of all files"""
+    series = []
+    for year in YEARS:
+        series.append(write_hourly_file(str(tmp_path / f'Base_hour_{year}.nc'),
+                                        year))
+
+    def getfile(year, data_freq):
+        assert data_freq == 'hour'
+        return str(tmp_path / f'Base_hour_{year}.nc')
+    return getfile, pd.concat(series)
+
+
+def ref_daily_max(values, lat, lon):
+    """Daily maxima at a cell with pandas"""
+    ts = values.xs((lat, lon), level=('lat', 'lon'))
+    days = ts.resample('D')
+    daily = days.max().where(days.count() >= 18)
+    return daily[daily.index.year.isin(YEARS)]
+
+
+def test_station_daily_max(hourly):
+    getfile, values = hourly
+    stations = pd.DataFrame({'latitude': [50.1, 52.9], 'longitude': [0.2, 3.8]})
+    # chunks of a few days, so that days are split between chunks and the
+    # first day of 2011 between the two files
+    daily = station_daily_max('vmro3', getfile, YEARS, stations, MIN_NUM_OBS,
+                              memory_budget_mb=0.02)
+    assert len(daily) == 2
+    for ts, (lat, lon) in zip(daily, [(50., 0.), (53., 4.)]):
+        ref = ref_daily_max(values, lat, lon)
+        pd.testing.assert_index_equal(ts.index, ref.index, check_names=False)
+        np.testing.assert_allclose(ts.values, ref.values)
+    assert daily[0].index[0] == pd.Timestamp('2010-01-01')
+    assert daily[1]['2011-01-01'] == 100
+    assert daily[0].index[-1] == pd.Timestamp('2011-12-31')
+
+
+def test_resample_percentiles_of_daily_max(hourly):
+    getfile, values = hourly
+    stations = pd.DataFrame({'latitude': [50., 52.], 'longitude': [0., 2.]})
+    daily = station_daily_max('vmro3', getfile, YEARS, stations, MIN_NUM_OBS,
+                              memory_budget_mb=0.02)
+    yearly = resample_percentiles(daily, ['daily'] * len(daily), 'yearly',
+                                  PERCENTILES, min_num_obs=MIN_NUM_OBS)
+    for df, (lat, lon) in zip(yearly, [(50., 0.), (52., 2.)]):
+        ref = ref_daily_max(values, lat, lon)
+        for year in YEARS:
+            days = ref[ref.index.year == year].dropna()
+            row = df[df.index.year == year].iloc[0]
+            if len(days) < 330:
+                assert np.isnan(row[PERCENTILES]).all()
+            else:
+                np.testing.assert_allclose(
+                    row[PERCENTILES].values.astype(float),
+                    np.percentile(days.values, PERCENTILES))
+    # the first cell lacks two months of 2011
+    assert np.isnan(yearly[0].loc[yearly[0].index.year == 2011,
+                                  PERCENTILES[0]]).all()
+
+
+def test_grid_percentiles_same_as_stations(hourly, tmp_path):
+    getfile, values = hourly
+    stations = pd.DataFrame({'latitude': [51., 53.], 'longitude': [1., 4.]})
+    daily = station_daily_max('vmro3', getfile, YEARS, stations, MIN_NUM_OBS)
+    yearly = resample_percentiles(daily, ['daily'] * len(daily), 'yearly',
+                                  PERCENTILES, min_num_obs=MIN_NUM_OBS)
+    fields = dict(grid_percentiles('vmro3', getfile, YEARS, PERCENTILES,
+                                   MIN_NUM_OBS, memory_budget_mb=0.02,
+                                   scratch_dir=str(tmp_path)))
+    assert sorted(fields) == YEARS
+    for df, (lat, lon) in zip(yearly, [(51., 1.), (53., 4.)]):
+        for year in YEARS:
+            row = df[df.index.year == year].iloc[0]
+            np.testing.assert_allclose(
+                fields[year].sel(lat=lat, lon=lon).values,
+                row[PERCENTILES].values.astype(float), rtol=1e-6)
+
+
+def test_import_calc_modtrends_o3():
+    script = importlib.import_module('calc_modtrends_o3')
+    assert script.PERIODS == importlib.import_module('variables').O3_PERIODS
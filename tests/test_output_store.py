@@ -0,0 +1,56 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from output_store import BackgroundWriter, OutputStore, export_csv
+
+
+def write_output(store):
+    """Series and trend table of two sites"""
+    times = pd.date_range('2010-01-01', periods=5, freq='D', name='time')
+    for i, site in enumerate(['AT0002R', 'NO0002R']):
+        ts = pd.Series(np.arange(5.) + i, index=times, name='concpm10')
+        store.write_series(f'data_concpm10_{site}_daily.csv', ts,
+                           station_id=site, ts_type='daily')
+        store.write_series(f'concpm10_{site}_2010-2014_all_yearly.csv',
+                           ts.iloc[:0], kind='yearly', station_id=site,
+                           period='2010-2014', season='all')
+    trends = pd.DataFrame({'station_id': ['AT0002R', 'NO0002R'],
+                           'trend [%/yr]': [1.5, -0.5]})
+    store.write_table('trends', trends)
+    store.close()
+
+
+def csv_files(path):
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name)) as f:
+                files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+    return files
+
+
+def test_export_csv_same_as_csv_output(tmp_path):
+    pytest.importorskip('pyarrow')
+    write_output(OutputStore(str(tmp_path / 'csv'), 'concpm10', 'csv'))
+    write_output(OutputStore(str(tmp_path / 'parquet'), 'concpm10',
+                             'parquet'))
+    # the csv directory does not exist yet
+    num = export_csv(str(tmp_path / 'parquet'), 'concpm10',
+                     str(tmp_path / 'export' / 'csv'))
+    assert num == 5
+    assert csv_files(tmp_path / 'export' / 'csv') == csv_files(tmp_path / 'csv')
+
+
+def test_background_writer_raises_error(tmp_path):
+    def fail(path):
+        raise OSError(f'can not write {path}')
+    writer = BackgroundWriter(num_threads=2, batch_size=2)
+    written = []
+    for i in range(5):
+        writer.submit(written.append, i)
+    writer.submit(fail, 'x.csv')
+    with pytest.raises(OSError, match='can not write x.csv'):
+        writer.shutdown()
+    assert sorted(written) == list(range(5))
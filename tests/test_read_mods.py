@@ -0,0 +1,165 @@
+import gc, os, time
+import numpy as np
+import pandas as pd
+from xarray.backends.file_manager import FILE_CACHE
+
+import read_mods
+from model_cache import ModelCache
+from conftest import write_emep_file
+
+VAR_INFO = {'concpm10': {'units': 'ug m-3', 'data_freq': 'day'}}
+
+
+def test_read_model_lazy_prefetch_realised_later(emep_files, tmp_path):
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    ref = read_mods.read_model('concpm10', emep_files, 2010, 2013, VAR_INFO)
+    data = read_mods.read_model('concpm10', emep_files, 2010, 2013, VAR_INFO,
+                                lazy=True, prefetch_depth=1,
+                                scratch_dir=str(scratch_dir))
+    assert data.cube.has_lazy_data()
+    # the data is read from the scratch copies, also after the open files
+    # were closed
+    FILE_CACHE.clear()
+    np.testing.assert_allclose(data.cube.data, ref.cube.data)
+    assert len(os.listdir(scratch_dir)) == 3
+
+    del data
+    gc.collect()
+    assert os.listdir(scratch_dir) == []
+
+
+def test_iter_model_years_lazy_prefetch(emep_files, tmp_path):
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+    years = []
+    for year, data in read_mods.iter_model_years(
+            'concpm10', emep_files, 2010, 2013, VAR_INFO, lazy=True,
+            prefetch_depth=1, scratch_dir=str(scratch_dir)):
+        ref = read_mods.read_model('concpm10', emep_files, year, year + 1,
+                                   VAR_INFO)
+        np.testing.assert_allclose(data.cube.data, ref.cube.data)
+        years.append(year)
+    assert years == [2010, 2011, 2012]
+    assert os.listdir(scratch_dir) == []
+
+
+def test_iter_model_years_evicts_cache(emep_files, tmp_path):
+    cache = ModelCache(str(tmp_path / 'cache'), max_size_gb=0)
+    years = [year for year, _ in read_mods.iter_model_years(
+        'concpm10', emep_files, 2010, 2013, VAR_INFO, cache=cache)]
+    assert years == [2010, 2011, 2012]
+    assert len(cache.entries()) == 0
+
+
+STATIONS = pd.DataFrame({'station_id': ['A', 'B', 'C'],
+                         'latitude': [50.2, 53.4, 55.9],
+                         'longitude': [0.1, 4.6, 7.8]})
+
+
+def _station_values(sites):
+    return np.stack([site['concpm10'].values for site in sites], axis=-1)
+
+
+def _grid_values(data):
+    return np.ma.filled(data.cube.data.astype(float), np.nan)
+
+
+def test_read_model_stations_nearest_cell(emep_files):
+    grid = read_mods.read_model('concpm10', emep_files, 2010, 2012, VAR_INFO)
+    sites = read_mods.read_model('concpm10', emep_files, 2010, 2012, VAR_INFO,
+                                 stations=STATIONS)
+    ilat = [0, 3, 5]
+    ilon = [0, 5, 7]
+    np.testing.assert_allclose(_station_values(sites),
+                               _grid_values(grid)[:, ilat, ilon])
+
+
+def test_read_model_stations_public_read_var(emep_files, monkeypatch):
+    ref = read_mods.read_model('concpm10', emep_files, 2010, 2012, VAR_INFO,
+                               stations=STATIONS, neighbourhood=1)
+    monkeypatch.setattr(read_mods, 'LOAD_VAR_VERSIONS', [])
+    sites = read_mods.read_model('concpm10', emep_files, 2010, 2012, VAR_INFO,
+                                 stations=STATIONS, neighbourhood=1)
+    np.testing.assert_allclose(_station_values(sites), _station_values(ref))
+
+
+def square(cube):
+    result = cube * cube
+    result.var_name = cube.var_name
+    return result
+
+
+def test_read_model_stations_neighbourhood_after_derivation(emep_files):
+    var_info = {'concpm10': {'units': 'ug2 m-6', 'data_freq': 'day'}}
+    calc_how = {'concpm10': {'req_vars': ['concpm10'], 'function': square}}
+    grid = read_mods.read_model('concpm10', emep_files, 2010, 2011, var_info,
+                                calc_how)
+    sites = read_mods.read_model('concpm10', emep_files, 2010, 2011, var_info,
+                                 calc_how, stations=STATIONS, neighbourhood=1)
+    values = _grid_values(grid)
+    expected = np.stack([values[:, 0:2, 0:2].mean(axis=(1, 2)),
+                         values[:, 2:5, 4:7].mean(axis=(1, 2)),
+                         values[:, 4:6, 6:8].mean(axis=(1, 2))], axis=-1)
+    np.testing.assert_allclose(_station_values(sites), expected)
+
+
+def test_read_model_stations_unknown_units(tmp_path):
+    path = tmp_path / '2010' / 'Base_day.nc'
+    write_emep_file(str(path), 2010, units='unknown')
+    sites = read_mods.read_model('concpm10', lambda year, freq: str(path),
+                                 2010, 2011, VAR_INFO, stations=STATIONS)
+    assert sites[0].var_info['concpm10']['units'] == 'ug m-3'
+
+
+def test_read_model_unknown_units(tmp_path):
+    path = tmp_path / '2010' / 'Base_day.nc'
+    write_emep_file(str(path), 2010, units='unknown')
+    data = read_mods.read_model('concpm10', lambda year, freq: str(path),
+                                2010, 2011, VAR_INFO)
+    assert data.cube.units == 'ug m-3'
+
+
+def test_read_models_unknown_units(tmp_path):
+    path = tmp_path / '2010' / 'Base_day.nc'
+    write_emep_file(str(path), 2010, units='unknown')
+    data = read_mods.read_models(['concpm10'], lambda year, freq: str(path),
+                                 2010, 2011, VAR_INFO)
+    assert data['concpm10'].cube.units == 'ug m-3'
+
+
+def test_read_models_with_cache(emep_files, tmp_path, monkeypatch):
+    cache = ModelCache(str(tmp_path / 'cache'))
+    ref = read_mods.read_models(['concpm10'], emep_files, 2010, 2013,
+                                VAR_INFO, cache=cache)
+    assert len(cache.entries()) == 3
+
+    def fail(*args, **kwargs):
+        raise AssertionError('model file read')
+    monkeypatch.setattr(read_mods, '_open_reader', fail)
+    data = read_mods.read_models(['concpm10'], emep_files, 2010, 2013,
+                                 VAR_INFO, cache=cache, prefetch_depth=1)
+    np.testing.assert_allclose(data['concpm10'].cube.data,
+                               ref['concpm10'].cube.data)
+
+
+def test_read_ahead_stages_prefetch_depth_years(monkeypatch):
+    stage_calls, released, live = [], [], []
+
+    def stage(year):
+        stage_calls.append(year)
+        return year
+
+    def func(year, staged=None):
+        # time for the background thread to stage the years ahead
+        time.sleep(0.05)
+        live.append(len(stage_calls) - len(released))
+        return year
+
+    monkeypatch.setattr(read_mods, '_release_staged', released.append)
+    results = list(read_mods._read_ahead(func, stage, range(2000, 2010),
+                                         prefetch_depth=2))
+    assert results == list(range(2000, 2010))
+    assert released == list(range(2000, 2010))
+    # the year being processed and two years ahead
+    assert max(live) == 3
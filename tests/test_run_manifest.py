@@ -0,0 +1,28 @@
+import os
+
+from run_manifest import RunManifest, file_stats
+
+
+def test_is_current_after_input_change(tmp_path):
+    inp = tmp_path / 'Base_day.nc'
+    inp.write_text('model')
+    out = tmp_path / 'output' / 'trends_concpm10.csv'
+    out.parent.mkdir()
+    out.write_text('trends')
+
+    def inputs():
+        return dict(script='calc_trends', model_files=file_stats([str(inp)]))
+
+    manifest = RunManifest(str(out.parent))
+    assert not manifest.is_current('concpm10', inputs(), [str(out)])
+    manifest.update('concpm10', inputs())
+    # also after reading the saved manifest
+    manifest = RunManifest(str(out.parent))
+    assert manifest.is_current('concpm10', inputs(), [str(out)])
+    stat = os.stat(inp)
+    os.utime(inp, (stat.st_atime, stat.st_mtime + 10))
+    assert not manifest.is_current('concpm10', inputs(), [str(out)])
+    manifest.update('concpm10', inputs())
+    assert manifest.is_current('concpm10', inputs(), [str(out)])
+    out.unlink()
+    assert not manifest.is_current('concpm10', inputs(), [str(out)])
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pytest
+
+from station_index import StationIndex
+
+LATS = np.array([50.2, 53.4, 55.9])
+LONS = np.array([0.1, 4.6, 7.8])
+
+
+def test_nearest_1d():
+    index = StationIndex.build(np.arange(50., 56.), np.arange(0., 8.), LATS,
+                               LONS)
+    np.testing.assert_array_equal(index.iy, [0, 3, 5])
+    np.testing.assert_array_equal(index.ix, [0, 5, 7])
+
+
+def test_bilinear_2d_grid_rejected():
+    grid_lons, grid_lats = np.meshgrid(np.arange(0., 8.), np.arange(50., 56.))
+    index = StationIndex.build(grid_lats, grid_lons, LATS, LONS)
+    np.testing.assert_array_equal(index.iy, [0, 3, 5])
+    np.testing.assert_array_equal(index.ix, [0, 5, 7])
+    with pytest.raises(ValueError, match=r'2-D coordinates of shape \(6, 8\)'):
+        StationIndex.build(grid_lats, grid_lons, LATS, LONS, bilinear=True)
+
+
+def test_stored_only_with_index_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    grid_lats, grid_lons = np.arange(50., 56.), np.arange(0., 8.)
+    StationIndex.load_or_build(grid_lats, grid_lons, LATS, LONS)
+    assert os.listdir(tmp_path) == []
+    index_dir = tmp_path / 'index'
+    StationIndex.load_or_build(grid_lats, grid_lons, LATS, LONS, True,
+                               str(index_dir))
+    assert len(os.listdir(index_dir)) == 1
+    index = StationIndex.load_or_build(grid_lats, grid_lons, LATS, LONS, True,
+                                       str(index_dir))
+    assert index.weights.shape == (3, 4)
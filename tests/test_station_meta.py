@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pyaerocom as pya
+import pytest
+
+import station_meta
+from station_meta import StationMetaIndex
+
+
+def _stat(name, lat, values, start, framework, matrix):
+    times = pd.date_range(start, periods=len(values), freq='D')
+    stat = pya.StationData(station_name=name, station_id=f'{name}01',
+                           latitude=lat, longitude=5., altitude=100.,
+                           data_id='obs', dataset_name='obs', ts_type='daily',
+                           framework=framework)
+    stat['concpm10'] = pd.Series(values, index=times)
+    stat.var_info['concpm10'] = {'units': 'ug m-3', 'matrix': matrix}
+    return stat
+
+
+@pytest.fixture
+def obs():
+    """Observations of two stations, one with two metadata blocks"""
+    return pya.UngriddedData.from_station_data([
+        _stat('A', 50., np.arange(10.), '2010-01-01', 'EMEP', 'pm10'),
+        _stat('A', 50., np.arange(30.), '2010-06-01', 'GAW', 'aerosol'),
+        _stat('B', 52., [1., np.nan, 3.], '2010-01-01', 'EMEP', 'pm10')])
+
+
+def _expected(obs, name):
+    stat = obs.to_station_data(name, 'concpm10', start=2010, stop=2011)
+    return StationMetaIndex._from_station_data('concpm10', stat)
+
+
+def test_same_as_to_station_data(obs):
+    index = StationMetaIndex(obs, 'concpm10', start=2010, stop=2011)
+    assert ('concpm10', 'A') in index
+    for name in ['A', 'B']:
+        assert index[('concpm10', name)] == _expected(obs, name)
+    assert index[('concpm10', 'A')]['framework'] == 'GAW;EMEP'
+
+
+def test_missing_station_uses_to_station_data(obs, monkeypatch):
+    monkeypatch.setattr(station_meta, 'META_INDEX_VERSIONS', [])
+    index = StationMetaIndex(obs, 'concpm10', start=2010, stop=2011)
+    assert index.rows == {}
+    for name in ['A', 'B']:
+        assert index[('concpm10', name)] == _expected(obs, name)
+    assert ('concpm10', 'A') in index
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from trends_batch import SEASONS, BatchTrends, yearly_aggregates
+from trend_store import TrendStore, affected_periods, merge_trend_table
+
+PERIODS = [(2005, 2017, 8), (2000, 2015, 10), (2010, 2017, 6)]
+
+
+def _series(seed):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2000-01-01', '2017-12-01', freq='MS')
+    values = (10 + rng.normal(0, 2, len(times))
+              + 0.1 * np.arange(len(times)) / 12)
+    values[rng.random(len(times)) < 0.1] = np.nan
+    keep = rng.random(len(times)) > 0.1
+    return pd.Series(values[keep], index=times[keep])
+
+
+def _trend_table(trends, ids, periods):
+    """Trend table as written by the scripts"""
+    rows = []
+    for i, site_id in enumerate(ids):
+        for start, stop, _ in periods:
+            for seas in SEASONS:
+                trend = trends.result(i, start, stop, seas)
+                rows.append([site_id, trend['period'], trend['season'],
+                             trend[f'slp_{start}'], trend['m'], trend['n'],
+                             trend['pval']])
+    return pd.DataFrame(rows, columns=['station_id', 'period', 'season',
+                                       'trend [%/yr]', 'slope', 'num yrs',
+                                       'pval'])
+
+
+def test_update_same_as_full_recompute(tmp_path):
+    full = {f'site{i}': _series(i) for i in range(6)}
+    # a site that only has data from the new years
+    full['new'] = _series(10).loc['2016':]
+
+    store = TrendStore(str(tmp_path / 'store.pkl'))
+    store.update({sid: ts.loc[:'2015'] for sid, ts in full.items()
+                  if sid != 'new'}, 2000, 2015)
+    store.save()
+    old_path = str(tmp_path / 'trends.csv')
+    _trend_table(store.trends(PERIODS), store.ids, PERIODS).to_csv(old_path)
+
+    store = TrendStore.load(str(tmp_path / 'store.pkl'))
+    changed = store.update({sid: ts.loc['2016':] for sid, ts in full.items()},
+                           2016, 2017)
+    assert changed == [2016, 2017]
+    periods = affected_periods(PERIODS, changed)
+    assert periods == [PERIODS[0], PERIODS[2]]
+    table = _trend_table(store.trends(periods), store.ids, periods)
+    merged = merge_trend_table(old_path, table, periods)
+
+    ids = list(full)
+    ref = BatchTrends.from_series(list(full.values()), PERIODS)
+    expected = _trend_table(ref, ids, PERIODS)
+    # the new site has rows of the updated periods only
+    expected = expected[(expected['station_id'] != 'new')
+                        | expected['period'].isin(['2005-2017', '2010-2017'])]
+    # num yrs is float where some rows have None
+    pd.testing.assert_frame_equal(merged, expected.reset_index(drop=True),
+                                  check_dtype=False)
+
+    # stored series and aggregates
+    for sid, ts in full.items():
+        pd.testing.assert_series_equal(store.series(sid), ts,
+                                       check_freq=False)
+    times = store.times
+    for seas in SEASONS:
+        agg = yearly_aggregates(times, store.values, store.present, seas)
+        for key, arr in agg.items():
+            np.testing.assert_array_equal(store.aggregates[seas][key], arr)
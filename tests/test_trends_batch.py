@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import kendalltau, norm
+from pyaerocom.trends_engine import TrendsEngine
+
+from trends_batch import (SEASONS, BatchTrends, _kendall_pval, mann_kendall)
+
+PERIODS = [(2000, 2019, 14), (2005, 2019, 10), (2010, 2019, 7)]
+KEYS = ['pval', 'm', 'm_err', 'n', 'yoffs']
+
+
+def _monthly_series(seed):
+    """Monthly series with a trend, missing months and NaNs"""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('1999-01-01', '2019-12-01', freq='MS')
+    values = (10 + rng.normal(0, 2, len(times))
+              + rng.choice([-0.1, 0, 0.2]) * (times.year.values - 1999))
+    values[rng.random(len(times)) < 0.15] = np.nan
+    keep = rng.random(len(times)) > 0.15
+    if seed % 3 == 0:
+        # several years without data
+        keep &= (times.year < 2003) | (times.year > 2006)
+    return pd.Series(values[keep], index=times[keep], name=f'site{seed}')
+
+
+@pytest.fixture(scope='module')
+def series():
+    return [_monthly_series(seed) for seed in range(12)]
+
+
+def _assert_same(result, expected, start):
+    for key in KEYS + [f'slp_{start}', f'slp_{start}_err', f'reg0_{start}']:
+        if expected[key] is None:
+            assert result[key] is None, key
+        else:
+            np.testing.assert_allclose(result[key], expected[key],
+                                       rtol=1e-12, err_msg=key)
+    if expected['data'] is None:
+        assert result['data'] is None
+    else:
+        pd.testing.assert_series_equal(result['data'], expected['data'],
+                                       check_names=False,
+                                       check_index_type=False)
+
+
+def test_same_as_compute_trend(series):
+    trends = BatchTrends.from_series(series, PERIODS)
+    for i, ts in enumerate(series):
+        for start, stop, min_yrs in PERIODS:
+            for seas in SEASONS:
+                expected = TrendsEngine.compute_trend(ts, 'monthly', start,
+                                                      stop, min_yrs, seas)
+                _assert_same(trends.result(i, start, stop, seas), expected,
+                             start)
+
+
+def test_add_periods_same_as_all_at_once(series):
+    trends = BatchTrends.from_series(series, PERIODS[:1])
+    trends.add_periods(PERIODS[1:])
+    ref = BatchTrends.from_series(series, PERIODS)
+    for start, stop, _ in PERIODS:
+        for seas in SEASONS:
+            for i in range(len(series)):
+                _assert_same(trends.result(i, start, stop, seas),
+                             ref.result(i, start, stop, seas), start)
+
+
+@pytest.mark.parametrize('n', [5, 20, 40])
+def test_kendall_pval_same_as_scipy(n):
+    rng = np.random.default_rng(n)
+    # with and without ties
+    y = np.concatenate([rng.normal(size=(20, n)),
+                        rng.integers(0, 4, (20, n)).astype(float)])
+    y[0] = np.arange(n)
+    x = np.arange(n)
+    expected = [kendalltau(x, row).pvalue for row in y]
+    np.testing.assert_allclose(_kendall_pval(y), expected, rtol=1e-10)
+
+
+def test_mann_kendall_same_as_scipy():
+    n = 25
+    rng = np.random.default_rng(0)
+    # with and without ties
+    y = np.concatenate([rng.normal(size=(20, n)) + 0.05 * np.arange(n),
+                        rng.integers(0, 5, (20, n)).astype(float)])
+    x = np.arange(n)
+    _, z, pval = mann_kendall(y)
+    expected = np.array([kendalltau(x, row, method='asymptotic').pvalue
+                         for row in y])
+    # kendalltau has no continuity correction, i.e. uses S instead of
+    # S - sign(S), with the same variance of S
+    s = np.sign(y[:, np.newaxis, :] - y[:, :, np.newaxis])
+    s = np.triu(s, 1).sum(axis=(1, 2))
+    z_scipy = np.where(s == 0, 0, z * s / (s - np.sign(s)))
+    np.testing.assert_allclose(2 * norm.sf(np.abs(z_scipy)), expected,
+                               rtol=1e-10)
+    assert np.all(pval >= expected)
+
+
+def test_mann_kendall_in_results(series):
+    trends = BatchTrends.from_series(series, PERIODS, mann_kendall=True)
+    for i in range(len(series)):
+        result = trends.result(i, 2000, 2019, 'all')
+        y = result['data'].dropna().values
+        s, _, pval = mann_kendall(y[np.newaxis])
+        assert result['mk_s'] == s[0]
+        assert result['mk_pval'] == pval[0]
+
+
+def test_bootstrap_reproducible(series):
+    seasons = ['all', 'summer']
+    results = []
+    for seed, num_workers in [(1, None), (1, None), (1, 2), (2, None)]:
+        trends = BatchTrends.from_series(series, PERIODS[:1], seasons)
+        trends.bootstrap(num_samples=200, seed=seed, num_workers=num_workers)
+        results.append(np.array(
+            [[trends.result(i, 2000, 2019, seas)[key]
+              for key in ['slp_boot_low', 'slp_boot_high']]
+             for i in range(len(series)) for seas in seasons], dtype=float))
+    assert np.isfinite(results[0]).any()
+    # same seed, also with worker processes
+    np.testing.assert_array_equal(results[1], results[0])
+    np.testing.assert_array_equal(results[2], results[0])
+    assert not np.array_equal(results[3], results[0], equal_nan=True)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stored series and yearly aggregates for incremental trend updates
+
+Each reporting cycle adds one year of data. A new year only changes the
+yearly (seasonal) values of that year and the winter of the next year, and
+thus only the trends of the periods containing these years. TrendStore
+keeps the monthly (or daily) series of all sites of a variable together
+with their yearly aggregates and coverage counts (see
+trends_batch.yearly_aggregates). When the data of some years is updated,
+only the aggregates of the affected years are recomputed, and the trends
+of the affected periods are computed from the stored aggregates.
+
+The Theil-Sen slope and Kendall p-value used for the trends have no
+additive sufficient statistics (unlike an OLS fit), but computing them
+from the stored yearly values takes a fraction of a second. The expensive
+part, reading and resampling the data of all years, is avoided.
+
+Usage:
+    python trend_store.py STORE_FILE
+"""
+import os, sys, pickle
+import numpy as np
+import pandas as pd
+
+from trends_batch import SEASONS, BatchTrends, yearly_aggregates
+
+
+class TrendStore(object):
+    """
+    Series of one variable and their yearly aggregates
+
+    Parameters
+    ----------
+    path : str
+        File where the store is saved.
+    seasons : list, optional
+        Seasons for which the aggregates are kept, default is SEASONS.
+
+    Attributes
+    ----------
+    ids : list
+        Series IDs (e.g. station IDs).
+    info : dict
+        Additional information of each series ID (e.g. unit, meta data).
+    times : pandas.DatetimeIndex
+        Common time axis of all series.
+    values, present : numpy.ndarray
+        Values and time stamp mask (series, time), see
+        trends_batch.stack_series.
+    aggregates : dict
+        Output of yearly_aggregates for each season.
+    """
+    def __init__(self, path, seasons=None):
+        if seasons is None:
+            seasons = SEASONS
+        self.path = path
+        self.seasons = list(seasons)
+        self.ids = []
+        self.info = {}
+        self.times = pd.DatetimeIndex([])
+        self.values = np.zeros((0, 0))
+        self.present = np.zeros((0, 0), dtype=bool)
+        self.aggregates = {}
+
+    @classmethod
+    def load(cls, path, seasons=None):
+        """Load store from path (an empty store if the file does not exist)"""
+        store = cls(path, seasons)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state['seasons'] != store.seasons:
+                raise ValueError(f'{path} was created for seasons '
+                                 f'{state["seasons"]}')
+            for key in ['ids', 'info', 'times', 'values', 'present',
+                        'aggregates']:
+                setattr(store, key, state[key])
+        return store
+
+    def save(self):
+        """Save store to its path"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        state = {key: getattr(self, key) for key in
+                 ['seasons', 'ids', 'info', 'times', 'values', 'present',
+                  'aggregates']}
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def years(self):
+        """Years of the time axis"""
+        if len(self.times) == 0:
+            return np.arange(0)
+        return np.arange(self.times.year.min(), self.times.year.max() + 1)
+
+    def series(self, series_id):
+        """Stored series of one ID as pandas.Series"""
+        i = self.ids.index(series_id)
+        present = self.present[i]
+        return pd.Series(self.values[i, present], index=self.times[present])
+
+    def update(self, series, start, stop, info=None):
+        """
+        Replace the data of all series in the years start to stop
+
+        Data of the stored series in these years is removed, and the new
+        data is added (series that are not in the store yet are added).
+        Then the aggregates of the affected years are recomputed.
+
+        Parameters
+        ----------
+        series : dict
+            New data (pandas.Series within the years start to stop) of each
+            series ID.
+        start, stop : int
+            First and last year of the new data.
+        info : dict, optional
+            New additional information of series IDs (see info).
+
+        Returns
+        -------
+        list
+            Years whose aggregates changed (start to stop + 1, since the
+            winter of a year contains December of the year before).
+        """
+        if info is not None:
+            self.info.update(info)
+        new_ids = [sid for sid in series if sid not in self.ids]
+        ids = self.ids + new_ids
+        times = self.times
+        for ts in series.values():
+            times = times.union(ts.index)
+
+        # stored data on the new time axis, without the updated years
+        values = np.full((len(ids), len(times)), np.nan)
+        present = np.zeros((len(ids), len(times)), dtype=bool)
+        idx = times.get_indexer(self.times)
+        values[:len(self.ids), idx] = self.values
+        present[:len(self.ids), idx] = self.present
+        i0 = times.searchsorted(pd.Timestamp(f'{start}-01-01'))
+        i1 = times.searchsorted(pd.Timestamp(f'{stop + 1}-01-01'))
+        values[:, i0:i1] = np.nan
+        present[:, i0:i1] = False
+        for sid, ts in series.items():
+            ts = ts.loc[str(start):str(stop)]
+            i = ids.index(sid)
+            idx = times.get_indexer(ts.index)
+            values[i, idx] = ts.values
+            present[i, idx] = True
+        old_years, old_num = self.years, len(self.ids)
+        self.ids, self.times = ids, times
+        self.values, self.present = values, present
+
+        years = self.years
+        changed = [yr for yr in range(start, stop + 2) if yr in years]
+        # data from December before the first changed year
+        w0 = times.searchsorted(pd.Timestamp(f'{start - 1}-12-01'))
+        w1 = times.searchsorted(pd.Timestamp(f'{stop + 2}-01-01'))
+        for seas in self.seasons:
+            agg = _empty_aggregates(len(ids), years)
+            if seas in self.aggregates:
+                cols = np.searchsorted(years, old_years)
+                for key, arr in self.aggregates[seas].items():
+                    if key != 'years':
+                        agg[key][:old_num, cols] = arr
+            if len(changed) > 0:
+                window = yearly_aggregates(times[w0:w1], values[:, w0:w1],
+                                           present[:, w0:w1], seas)
+                cols = np.searchsorted(years, changed)
+                wcols = np.searchsorted(window['years'], changed)
+                for key in agg:
+                    if key != 'years':
+                        agg[key][:, cols] = window[key][:, wcols]
+            self.aggregates[seas] = agg
+        return changed
+
+    def trends(self, periods, **kwargs):
+        """
+        Trends of all stored series for some periods
+
+        Additional keyword arguments are passed to BatchTrends.
+
+        Returns
+        -------
+        trends_batch.BatchTrends
+            Trends (series in the order of ids).
+        """
+        trends = BatchTrends(self.values, self.times, periods, self.seasons,
+                             self.present, aggregates=self.aggregates,
+                             **kwargs)
+        trends.names = list(self.ids)
+        return trends
+
+
+def _empty_aggregates(num, years):
+    shape = (num, len(years))
+    return {'years': years,
+            'values': np.full(shape, np.nan),
+            'counts': np.zeros(shape, dtype=int),
+            'stamps': np.zeros(shape, dtype=bool),
+            'first': np.zeros(shape, dtype=bool),
+            'lead': np.zeros(shape, dtype=bool)}
+
+
+def affected_periods(periods, years):
+    """Periods containing any of years"""
+    return [period for period in periods
+            if any(period[0] <= yr <= period[1] for yr in years)]
+
+
+def merge_trend_table(old, table, periods):
+    """
+    Replace the rows of some periods in a stored trend table
+
+    Parameters
+    ----------
+    old : str or pandas.DataFrame
+        Stored trend table (e.g. OutputStore.read_table('trends')) or path
+        of trends_{var}.csv, may be None or not exist.
+    table : pandas.DataFrame
+        New rows, in the format of the trend tables.
+    periods : list
+        (start, stop, min_num_yrs) tuples of the new rows.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of the other periods from old and the new rows, sorted by
+        station, period and season in the order of old (as a full
+        recompute), followed by those that are only in table.
+    """
+    if isinstance(old, str):
+        old = pd.read_csv(old, index_col=0) if os.path.exists(old) else None
+    if old is None:
+        return table
+    replaced = [f'{start}-{stop}' for start, stop, _ in periods]
+    merged = pd.concat([old[~old['period'].isin(replaced)], table],
+                       ignore_index=True)
+    # keep the order of stations, periods and seasons
+    order = {}
+    for col in ['station_id', 'period', 'season']:
+        values = list(dict.fromkeys(list(old[col]) + list(table[col])))
+        order[col] = merged[col].map({val: i for i, val in
+                                      enumerate(values)})
+    merged = merged.iloc[np.lexsort([order['season'], order['period'],
+                                     order['station_id']])]
+    return merged.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    store = TrendStore.load(sys.argv[1])
+    years = store.years
+    print(f'{len(store.ids)} series, years {years[0]}-{years[-1]}'
+          if len(years) > 0 else 'empty store')
+    if len(years) > 0:
+        coverage = pd.DataFrame(store.aggregates['all']['counts'],
+                                index=store.ids, columns=years)
+        with pd.option_context('display.max_rows', None,
+                               'display.width', None):
+            print('Number of values per year:')
+            print(coverage)
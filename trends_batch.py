@@ -0,0 +1,855 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch computation of trends for many time series at once
+
+Computes the same results as pyaerocom.trends_engine.TrendsEngine.compute_trend
+(yearly/seasonal aggregation, Theil-Sen slope and its error, offset, relative
+trend slp_{start} and Kendall p-value) for all series, periods and seasons
+using array operations, instead of calling compute_trend in a loop over
+site x period x season.
+
+The series are put on a common time axis (see stack_series). Since
+compute_trend takes into account which time stamps exist in a series (also
+if their value is NaN, e.g. for the check that all 4 seasons are covered),
+a mask of the existing time stamps is used next to the values.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+from scipy.stats import norm, rankdata
+from pyaerocom.trends_helpers import (SEASONS as _SEASON_MONTHS, _mid_season,
+                                      _start_season, _end_season,
+                                      _compute_trend_error)
+
+SEASONS = ['all'] + list(_SEASON_MONTHS)
+
+# default confidence of slope in compute_trend
+SLOPE_CONFIDENCE = .68
+
+# significance level of the autocorrelation lags used in the Hamed and Rao
+# correction of the Mann-Kendall test
+MK_ACF_ALPHA = .05
+
+# keys of the Mann-Kendall results and corresponding columns of the trend
+# tables
+MK_KEYS = ['mk_s', 'mk_z', 'mk_pval']
+MK_COLUMNS = ['mk S', 'mk Z', 'mk pval']
+
+# confidence of the bootstrap interval of the relative trend
+BOOTSTRAP_CONFIDENCE = .95
+
+# keys of the bootstrap interval and corresponding columns of the trend
+# tables
+BOOTSTRAP_KEYS = ['slp_boot_low', 'slp_boot_high']
+BOOTSTRAP_COLUMNS = ['trend boot low [%/yr]', 'trend boot high [%/yr]']
+
+
+def stack_series(series_list):
+    """
+    Put time series on a common time axis
+
+    Parameters
+    ----------
+    series_list : list
+        List of pandas.Series with DatetimeIndex.
+
+    Returns
+    -------
+    pandas.DatetimeIndex
+        Union of the time stamps of all series.
+    numpy.ndarray
+        Values of shape (series, time), NaN where a series has no value.
+    numpy.ndarray
+        Boolean array of shape (series, time), True where the time stamp
+        exists in a series.
+    """
+    times = pd.DatetimeIndex([])
+    for ts in series_list:
+        times = times.union(ts.index)
+    values = np.full((len(series_list), len(times)), np.nan)
+    present = np.zeros((len(series_list), len(times)), dtype=bool)
+    for i, ts in enumerate(series_list):
+        idx = times.get_indexer(ts.index)
+        values[i, idx] = ts.values
+        present[i, idx] = True
+    return times, values, present
+
+
+def _season_ids(times):
+    """Index of the season (in _SEASON_MONTHS) of each time stamp"""
+    ids = np.zeros(len(times), dtype=int)
+    for i, months in enumerate(_SEASON_MONTHS.values()):
+        ids[np.isin(times.month, months)] = i
+    return ids
+
+
+def _day_after(datestr):
+    return pd.Timestamp(datestr) + pd.Timedelta(days=1)
+
+
+def _pack(arr, mask):
+    """
+    Move the entries of arr where mask is True to the start of each row
+
+    Returns the packed array and the number of entries in each row.
+    """
+    order = np.argsort(~mask, axis=1, kind='stable')
+    return np.take_along_axis(arr, order, axis=1), mask.sum(axis=1)
+
+
+def _nanmean_rows(values, present):
+    """
+    Mean of the non-NaN values at the present time stamps of each row
+
+    Computed group-wise for rows with the same number of present time stamps,
+    which gives bitwise the same result as numpy.nanmean of each subset.
+
+    Returns the means and the number of values they were computed from.
+    """
+    packed, num = _pack(values, present)
+    result = np.full(len(values), np.nan)
+    counts = np.zeros(len(values), dtype=int)
+    for length in np.unique(num):
+        if length == 0:
+            continue
+        rows = np.where(num == length)[0]
+        subset = np.ascontiguousarray(packed[rows, :length])
+        isnan = np.isnan(subset)
+        cnt = (~isnan).sum(axis=1)
+        tot = np.where(isnan, 0, subset).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[rows] = np.where(cnt > 0, tot / cnt, np.nan)
+        counts[rows] = cnt
+    return result, counts
+
+
+def yearly_aggregates(times, values, present, season):
+    """
+    Yearly (or seasonal) values of each series for all years of the time axis
+
+    These are the values computed by _get_yearly in pyaerocom. They do not
+    depend on the period, except for which time stamps exist in the first
+    year of a period, so they are computed once per season and sliced for
+    each period (see slice_period).
+
+    Parameters
+    ----------
+    times : pandas.DatetimeIndex
+        Common time axis.
+    values, present : numpy.ndarray
+        See stack_series.
+    season : str
+        Season.
+
+    Returns
+    -------
+    dict
+        Arrays of shape (series, years): "values" (yearly values), "counts"
+        (number of values averaged, i.e. the coverage), "stamps" (series has
+        time stamps in the year), "first" (series has time stamps from the
+        start of the season until the end of the year) and "lead" (series
+        has time stamps from the start of the season until the start of the
+        year, only for winter), and the corresponding "years".
+    """
+    if len(times) == 0:
+        years = np.arange(0)
+    else:
+        years = np.arange(times.year.min(), times.year.max() + 1)
+    seas_ids = _season_ids(times)
+    shape = (len(values), len(years))
+    agg = {'years': years,
+           'values': np.full(shape, np.nan),
+           'counts': np.zeros(shape, dtype=int),
+           'stamps': np.zeros(shape, dtype=bool),
+           'first': np.zeros(shape, dtype=bool),
+           'lead': np.zeros(shape, dtype=bool)}
+    for j, yr in enumerate(years):
+        y0 = times.searchsorted(pd.Timestamp(f'{yr}-01-01'))
+        y1 = times.searchsorted(pd.Timestamp(f'{yr + 1}-01-01'))
+        s0 = times.searchsorted(pd.Timestamp(_start_season(season, yr)))
+        agg['stamps'][:, j] = present[:, y0:y1].any(axis=1)
+        agg['first'][:, j] = present[:, max(s0, y0):y1].any(axis=1)
+        agg['lead'][:, j] = present[:, s0:y0].any(axis=1)
+
+        if season == 'all':
+            w0, w1 = y0, y1
+        else:
+            w0 = s0
+            w1 = times.searchsorted(_day_after(_end_season(season, yr)))
+        if w1 <= w0:
+            continue
+        vals, counts = _nanmean_rows(values[:, w0:w1], present[:, w0:w1])
+        if season == 'all':
+            # all 4 seasons need to be covered by time stamps
+            num_seas = np.zeros(len(values), dtype=int)
+            for seas_id in range(len(_SEASON_MONTHS)):
+                num_seas += (present[:, w0:w1]
+                             & (seas_ids[w0:w1] == seas_id)).any(axis=1)
+            vals[num_seas != 4] = np.nan
+        agg['values'][:, j] = vals
+        agg['counts'][:, j] = counts
+    return agg
+
+
+def slice_period(agg, start, stop):
+    """
+    Yearly values of a period from the output of yearly_aggregates
+
+    Parameters
+    ----------
+    agg : dict
+        Output of yearly_aggregates.
+    start, stop : int
+        Period.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (series, stop - start + 1) with the yearly values.
+    numpy.ndarray
+        Boolean array of the same shape, True where the year is part of the
+        yearly series returned by _get_yearly.
+    numpy.ndarray
+        True for series with data in the period (else compute_trend returns
+        no results at all).
+    numpy.ndarray
+        Coverage of the yearly values (see yearly_aggregates).
+    """
+    years = np.arange(start, stop + 1)
+    idx = np.searchsorted(agg['years'], years)
+    idx = np.minimum(idx, len(agg['years']) - 1)
+    # years outside the time axis have no data
+    inside = ((years >= agg['years'][0]) & (years <= agg['years'][-1])
+              if len(agg['years']) > 0 else np.zeros(len(years), dtype=bool))
+    num = len(agg['values'])
+
+    def take(key, fill):
+        out = np.full((num, len(years)), fill, dtype=agg[key].dtype)
+        out[:, inside] = agg[key][:, idx[inside]]
+        return out
+
+    yearly = take('values', np.nan)
+    counts = take('counts', 0)
+    in_series = take('stamps', False)
+    first, lead = take('first', False), take('lead', False)
+    # compute_trend only uses the data from the start of the season
+    in_series[:, 0] = first[:, 0]
+    has_data = lead[:, 0] | in_series.any(axis=1)
+    return yearly, in_series, has_data, counts
+
+
+def _tie_stats(y):
+    """
+    Tie statistics of each row of y
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of tied pairs, sum(cnt * (cnt - 1) / 2) over groups of equal
+        values.
+    numpy.ndarray
+        sum(cnt * (cnt - 1) * (2 * cnt + 5)) over groups of equal values.
+    """
+    k, n = y.shape
+    ysorted = np.sort(y, axis=1)
+    new_group = np.ones((k, n), dtype=bool)
+    new_group[:, 1:] = ysorted[:, 1:] != ysorted[:, :-1]
+    group = np.cumsum(new_group.ravel()) - 1
+    cnt = np.bincount(group).astype(np.int64)
+    group_row = np.repeat(np.arange(k), n)[new_group.ravel()]
+    ties = np.zeros(k, dtype=np.int64)
+    np.add.at(ties, group_row, cnt * (cnt - 1) // 2)
+    ties_var = np.zeros(k, dtype=np.int64)
+    np.add.at(ties_var, group_row, cnt * (cnt - 1) * (2 * cnt + 5))
+    return ties, ties_var
+
+
+@lru_cache(maxsize=None)
+def _kendall_p_exact(n, c):
+    """
+    Exact two-sided p-value of Kendall's tau without ties
+
+    Same as scipy.stats._mstats_basic._kendall_p_exact, with n values and c
+    concordant pairs.
+    """
+    c = int(min(c, (n * (n - 1)) // 2 - c))
+    if n == 1:
+        prob = 1.0
+    elif n == 2:
+        prob = 1.0
+    elif c == 0:
+        prob = 2.0 / math.factorial(n) if n < 171 else 0.0
+    elif c == 1:
+        prob = 2.0 / math.factorial(n - 1) if n < 172 else 0.0
+    elif 4 * c == n * (n - 1):
+        prob = 1.0
+    elif n < 171:
+        new = np.zeros(c + 1)
+        new[0:2] = 1.0
+        for j in range(3, n + 1):
+            new = np.cumsum(new)
+            if j <= c:
+                new[j:] -= new[:c + 1 - j]
+        prob = 2.0 * np.sum(new) / math.factorial(n)
+    else:
+        new = np.zeros(c + 1)
+        new[0:2] = 1.0
+        for j in range(3, n + 1):
+            new = np.cumsum(new) / j
+            if j <= c:
+                new[j:] -= new[:c + 1 - j]
+        prob = np.sum(new)
+    return np.clip(prob, 0, 1)
+
+
+def _kendall_pval(y):
+    """
+    p-value of Kendall's tau between time and each row of y
+
+    Same as scipy.stats.kendalltau (method 'auto') for x values without ties.
+
+    Parameters
+    ----------
+    y : numpy.ndarray
+        Values of shape (series, n), in time order.
+
+    Returns
+    -------
+    numpy.ndarray
+        p-values.
+    """
+    k, n = y.shape
+    tot = n * (n - 1) // 2
+    iu, ju = np.triu_indices(n, 1)
+    diff = y[:, ju] - y[:, iu]
+    dis = (diff < 0).sum(axis=1)
+    con_minus_dis = np.sign(diff).sum(axis=1)
+
+    ytie, y1 = _tie_stats(y)
+
+    pval = np.full(k, np.nan)
+    exact = (ytie == 0) & ((n <= 33) | (np.minimum(dis, tot - dis) <= 1))
+    for i in np.where(exact)[0]:
+        pval[i] = _kendall_p_exact(n, int(tot - dis[i]))
+    asymp = ~exact & (ytie < tot)
+    if asymp.any():
+        m = n * (n - 1.)
+        var = (m * (2 * n + 5) - y1[asymp]) / 18
+        z = con_minus_dis[asymp] / np.sqrt(var)
+        pval[asymp] = 2 * ndtr(-np.abs(z))
+    return pval
+
+
+def _theilslopes(y, x, alpha=SLOPE_CONFIDENCE):
+    """
+    Theil-Sen slope of each row (same as scipy.stats.mstats.theilslopes)
+
+    Parameters
+    ----------
+    y, x : numpy.ndarray
+        Arrays of shape (series, n), x without ties and increasing.
+    alpha : float, optional
+        Confidence degree.
+
+    Returns
+    -------
+    tuple
+        Arrays of slope, intercept and lower and upper bound of slope.
+    """
+    k, n = y.shape
+    iu, ju = np.triu_indices(n, 1)
+    slopes = np.sort((y[:, ju] - y[:, iu]) / (x[:, ju] - x[:, iu]), axis=1)
+    nt = slopes.shape[1]
+    medslope = _median_sorted(slopes)
+    medinter = (_median_sorted(np.sort(y, axis=1))
+                - medslope * _median_sorted(x))
+
+    if alpha > 0.5:
+        alpha = 1. - alpha
+    z = norm.ppf(alpha / 2.)
+    # ties in y (x has no ties)
+    _, reps = _tie_stats(y)
+    sigsq = 1 / 18. * (n * (n - 1) * (2 * n + 5) - reps)
+    sigma = np.sqrt(sigsq)
+    Ru = np.minimum(np.round((nt - z * sigma) / 2.).astype(int), nt - 1)
+    Rl = np.maximum(np.round((nt + z * sigma) / 2.).astype(int) - 1, 0)
+    rows = np.arange(k)
+    return medslope, medinter, slopes[rows, Rl], slopes[rows, Ru]
+
+
+def mann_kendall(y, x=None, slope=None, autocorr=False):
+    """
+    Mann-Kendall trend test of each row of y
+
+    The variance of S is corrected for ties. Optionally, it is also
+    corrected for autocorrelation following Hamed and Rao (1998), using the
+    significant lags of the autocorrelation of the ranks of the detrended
+    series.
+
+    Parameters
+    ----------
+    y : numpy.ndarray
+        Values of shape (series, n), in time order, without NaNs.
+    x : numpy.ndarray, optional
+        Times of y (e.g. years), needed for autocorr.
+    slope : numpy.ndarray, optional
+        Theil-Sen slope of each row, needed for autocorr.
+    autocorr : bool, optional
+        If True, apply the Hamed and Rao correction.
+
+    Returns
+    -------
+    numpy.ndarray
+        S statistic.
+    numpy.ndarray
+        Normalised test statistic Z (with continuity correction).
+    numpy.ndarray
+        Two-sided p-value.
+    """
+    k, n = y.shape
+    iu, ju = np.triu_indices(n, 1)
+    s = np.sign(y[:, ju] - y[:, iu]).sum(axis=1)
+    _, ties_var = _tie_stats(y)
+    var = (n * (n - 1) * (2 * n + 5) - ties_var) / 18.
+
+    if autocorr and n > 2:
+        detrended = y - slope[:, np.newaxis] * x
+        ranks = rankdata(detrended, axis=1)
+        ranks -= ranks.mean(axis=1)[:, np.newaxis]
+        denom = (ranks**2).sum(axis=1)
+        limit = norm.ppf(1 - MK_ACF_ALPHA / 2) / np.sqrt(n)
+        corr_sum = np.zeros(k)
+        for lag in range(1, n - 2):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                acf = (ranks[:, :-lag] * ranks[:, lag:]).sum(axis=1) / denom
+            acf = np.where(np.abs(acf) > limit, acf, 0)
+            corr_sum += (n - lag) * (n - lag - 1) * (n - lag - 2) * acf
+        var = var * (1 + 2 * corr_sum / (n * (n - 1) * (n - 2)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # NaN if the corrected variance is negative
+        z = np.where(s == 0, 0, (s - np.sign(s)) / np.sqrt(var))
+    return s, z, 2 * ndtr(-np.abs(z))
+
+
+def _median_sorted(arr):
+    """Median of each row of an array that is sorted along axis 1"""
+    n = arr.shape[1]
+    if n % 2 == 1:
+        return arr[:, n // 2]
+    return (arr[:, n // 2 - 1] + arr[:, n // 2]) / 2
+
+
+def block_bootstrap(y, x, v0, num_samples, block_size,
+                    confidence=BOOTSTRAP_CONFIDENCE, rng=None):
+    """
+    Moving block bootstrap interval of the relative trend of one series
+
+    The residuals of the Theil-Sen fit are resampled in blocks of
+    consecutive values (which keeps their serial correlation within a
+    block) and added to the fit. All samples are computed at once.
+
+    Parameters
+    ----------
+    y, x : numpy.ndarray
+        Yearly values and years (since 1970) used for the trend.
+    v0 : float
+        Value of the fit at the period start, used to normalise the slopes
+        (as reg0 in compute_trend).
+    num_samples : int
+        Number of bootstrap samples.
+    block_size : int
+        Number of consecutive years in a block.
+    confidence : float, optional
+        Confidence of the interval.
+    rng : numpy.random.Generator, optional
+        Random number generator.
+
+    Returns
+    -------
+    numpy.ndarray
+        Lower and upper bound of the relative trend in %/yr.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n = len(y)
+    slope, yoffs, _, _ = _theilslopes(y[np.newaxis], x[np.newaxis])
+    fit = slope[0] * x + yoffs[0]
+    resid = y - fit
+    block_size = min(block_size, n)
+    num_blocks = -(-n // block_size)
+    starts = rng.integers(0, n - block_size + 1, (num_samples, num_blocks))
+    idx = (starts[:, :, np.newaxis] + np.arange(block_size))
+    idx = idx.reshape(num_samples, -1)[:, :n]
+    samples = fit + resid[idx]
+    slopes, _, _, _ = _theilslopes(samples,
+                                   np.broadcast_to(x, samples.shape))
+    q = (1 - confidence) / 2
+    return np.quantile(slopes / v0 * 100, [q, 1 - q])
+
+
+def _bootstrap_tasks(tasks, num_samples, block_size, confidence, seed):
+    """
+    Bootstrap intervals of a list of (key, i, y, x, v0) tasks
+
+    Each task has its own random numbers (seeded with seed, i and key), so
+    that the results do not depend on how the tasks are distributed.
+    """
+    results = []
+    for key, i, y, x, v0 in tasks:
+        rng = np.random.default_rng([seed, i, *key])
+        results.append(block_bootstrap(y, x, v0, num_samples, block_size,
+                                       confidence, rng))
+    return results
+
+
+def _trend_stats(yearly, valid, start, min_num_yrs, mk=False,
+                 mk_autocorr=False):
+    """
+    Trend statistics of the yearly values of each series in a period
+
+    Parameters
+    ----------
+    yearly : numpy.ndarray
+        Yearly values of shape (series, years), first year is start.
+    valid : numpy.ndarray
+        Boolean array, True for years that are used.
+    start : int
+        First year of period.
+    min_num_yrs : int
+        Minimum number of valid years.
+    mk : bool, optional
+        If True, add the results of the Mann-Kendall test (see
+        mann_kendall).
+    mk_autocorr : bool, optional
+        Apply the autocorrelation correction in the Mann-Kendall test.
+
+    Returns
+    -------
+    dict
+        Arrays with n and (NaN where not computed) m, m_err, yoffs, pval,
+        slp, slp_err and reg0 (the last 3 for the period start), and mk_s,
+        mk_z and mk_pval if mk is True.
+    """
+    num = len(yearly)
+    years = np.arange(start, start + yearly.shape[1])
+    out = {'n': valid.sum(axis=1)}
+    keys = ['m', 'm_err', 'yoffs', 'pval', 'slp', 'slp_err', 'reg0']
+    if mk:
+        keys += MK_KEYS
+    for key in keys:
+        out[key] = np.full(num, np.nan)
+
+    packed_vals, _ = _pack(yearly, valid)
+    packed_years, _ = _pack(np.broadcast_to(years, yearly.shape), valid)
+    t0_period = float(start - 1970)
+    for n in np.unique(out['n']):
+        if n < min_num_yrs or n < 2:
+            continue
+        rows = np.where(out['n'] == n)[0]
+        y = np.ascontiguousarray(packed_vals[rows, :n])
+        x = (packed_years[rows, :n] - 1970).astype(np.float64)
+
+        out['pval'][rows] = _kendall_pval(y)
+        slope, yoffs, low, up = _theilslopes(y, x)
+        slope_err = (np.abs(slope - low) + np.abs(slope - up)) / 2
+
+        reg_data = slope[:, np.newaxis] * x + yoffs[:, np.newaxis]
+        v0_period = slope * t0_period + yoffs
+        mean_residual = np.ascontiguousarray(np.abs(y - reg_data)).mean(axis=1)
+        t0_data, tN_data = x[:, 0], x[:, -1]
+        dt_ratio = (t0_data - t0_period) / (tN_data - t0_data)
+        v0_err_period = mean_residual * (1 + dt_ratio)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slp = slope / v0_period * 100
+            # scalar arithmetic, so that the result is identical to
+            # TrendsEngine (powers of numpy scalars and arrays may differ
+            # in the last bit)
+            slp_err = np.array([_compute_trend_error(*args) for args in
+                                zip(slope, slope_err, v0_period,
+                                    v0_err_period)])
+
+        out['m'][rows] = slope
+        out['m_err'][rows] = slope_err
+        out['yoffs'][rows] = yoffs
+        # relative trend only if the regression is positive at period start
+        positive = v0_period > 0
+        out['slp'][rows] = np.where(positive, slp, np.nan)
+        out['slp_err'][rows] = np.where(positive, slp_err, np.nan)
+        out['reg0'][rows] = np.where(positive, v0_period, np.nan)
+        if mk:
+            mk_results = mann_kendall(y, x, slope, mk_autocorr)
+            for key, mk_result in zip(MK_KEYS, mk_results):
+                out[key][rows] = mk_result
+    return out
+
+
+class BatchTrends(object):
+    """
+    Trends of many series for several periods and seasons
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Array of shape (series, time).
+    times : pandas.DatetimeIndex
+        Time stamps of values.
+    periods : list
+        List of (start, stop, min_num_yrs) tuples, as PERIODS in the scripts.
+    seasons : list, optional
+        Seasons, default is SEASONS.
+    present : numpy.ndarray, optional
+        Boolean array of the shape of values, True where a series has a time
+        stamp (see stack_series). Default is all True.
+    ts_type : str, optional
+        Frequency of the input data, 'monthly' (or any higher frequency,
+        aggregated to yearly/seasonal values) or 'yearly' (used as is).
+    mann_kendall : bool, optional
+        If True, also compute the Mann-Kendall test (see mann_kendall).
+    mk_autocorr : bool, optional
+        Correct the Mann-Kendall test for autocorrelation.
+    aggregates : dict, optional
+        Precomputed output of yearly_aggregates for each season (e.g. from
+        trend_store.TrendStore), only for ts_type 'monthly'.
+    """
+    def __init__(self, values, times, periods, seasons=None, present=None,
+                 ts_type='monthly', mann_kendall=False, mk_autocorr=False,
+                 aggregates=None):
+        if seasons is None:
+            seasons = SEASONS
+        if not ts_type in ['yearly', 'monthly']:
+            raise ValueError(ts_type)
+        values = np.asarray(values, dtype=np.float64)
+        if present is None:
+            present = np.ones(values.shape, dtype=bool)
+        self.times = pd.DatetimeIndex(times)
+        self.ts_type = ts_type
+        self.mann_kendall = mann_kendall
+        self.mk_autocorr = mk_autocorr
+        self.bootstrapped = False
+        self.seasons = list(seasons)
+        self.names = None
+        self.aggregates = {} if aggregates is None else dict(aggregates)
+        self._values = values
+        self._present = present
+        self.results = {}
+        self._data = {}
+        self.add_periods(periods)
+
+    def add_periods(self, periods):
+        """
+        Compute trends for (more) periods
+
+        The yearly values of each season are computed once (see
+        yearly_aggregates) and reused for all periods, so that trends of
+        other periods can be added with little cost.
+
+        Parameters
+        ----------
+        periods : list
+            List of (start, stop, min_num_yrs) tuples.
+        """
+        for start, stop, min_num_yrs in periods:
+            for seas in self.seasons:
+                if self.ts_type == 'monthly':
+                    if seas not in self.aggregates:
+                        self.aggregates[seas] = yearly_aggregates(
+                            self.times, self._values, self._present, seas)
+                    yearly, in_series, has_data, counts = slice_period(
+                        self.aggregates[seas], start, stop)
+                else:
+                    yearly, in_series, has_data = self._yearly_input(
+                        self._values, self._present, seas, start, stop)
+                    counts = (in_series & ~np.isnan(yearly)).astype(int)
+                valid = in_series & ~np.isnan(yearly)
+                stats = _trend_stats(yearly, valid, start, min_num_yrs,
+                                     self.mann_kendall, self.mk_autocorr)
+                stats['has_data'] = has_data
+                self.results[(start, stop, seas)] = stats
+                self._data[(start, stop, seas)] = (yearly, in_series, counts)
+
+    @classmethod
+    def from_series(cls, series_list, periods, seasons=None,
+                    ts_type='monthly', **kwargs):
+        """
+        Compute trends of a list of pandas.Series (see stack_series)
+
+        Additional keyword arguments are passed to BatchTrends.
+        """
+        times, values, present = stack_series(series_list)
+        trends = cls(values, times, periods, seasons, present, ts_type,
+                     **kwargs)
+        trends.names = [ts.name for ts in series_list]
+        return trends
+
+    def _yearly_input(self, values, present, season, start, stop):
+        """Yearly input data, with the selection done by compute_trend"""
+        times = self.times
+        i0 = times.searchsorted(pd.Timestamp(_start_season(season, start)))
+        i1 = times.searchsorted(pd.Timestamp(f'{stop + 1}-01-01'))
+        has_data = present[:, i0:i1].any(axis=1)
+        # only dates between the mid season dates of start and stop are used
+        t0 = times.searchsorted(pd.Timestamp(_mid_season(season, start)))
+        t1 = times.searchsorted(pd.Timestamp(_mid_season(season, stop)),
+                                side='right')
+        years = np.arange(start, stop + 1)
+        yearly = np.full((len(values), len(years)), np.nan)
+        in_series = np.zeros((len(values), len(years)), dtype=bool)
+        for t in range(max(t0, i0), min(t1, i1)):
+            j = times[t].year - start
+            if np.any(in_series[:, j] & present[:, t]):
+                raise ValueError('yearly input must have one value per year')
+            yearly[present[:, t], j] = values[present[:, t], t]
+            in_series[:, j] |= present[:, t]
+        return yearly, in_series, has_data
+
+    def result(self, i, start, stop, season):
+        """
+        Trend of one series, in the format of TrendsEngine.compute_trend
+
+        Parameters
+        ----------
+        i : int
+            Index of series.
+        start, stop : int
+            Period.
+        season : str
+            Season.
+
+        Returns
+        -------
+        dict
+            Same keys and values as returned by compute_trend: "period",
+            "season", "n", "pval", "m", "m_err", "yoffs", f"slp_{start}",
+            f"slp_{start}_err", f"reg0_{start}" and "data" (values that were
+            not computed are None), plus MK_KEYS if mann_kendall is True and
+            BOOTSTRAP_KEYS after bootstrap was called.
+        """
+        stats = self.results[(start, stop, season)]
+        keys = ['pval', 'm', 'm_err', 'n', 'yoffs', f'slp_{start}',
+                f'slp_{start}_err', f'reg0_{start}', 'data']
+        if self.mann_kendall:
+            keys += MK_KEYS
+        if self.bootstrapped:
+            keys += BOOTSTRAP_KEYS
+        result = dict.fromkeys(keys)
+        result['period'] = f'{start}-{stop}'
+        result['season'] = season
+        if not stats['has_data'][i]:
+            return result
+        result['data'] = self.yearly_series(i, start, stop, season)
+        result['n'] = int(stats['n'][i])
+        if np.isnan(stats['m'][i]):
+            return result
+        for key in ['pval', 'm', 'm_err', 'yoffs']:
+            result[key] = np.float64(stats[key][i])
+        if self.mann_kendall:
+            for key in MK_KEYS:
+                result[key] = np.float64(stats[key][i])
+        if not np.isnan(stats['reg0'][i]):
+            result[f'slp_{start}'] = np.float64(stats['slp'][i])
+            result[f'slp_{start}_err'] = np.float64(stats['slp_err'][i])
+            result[f'reg0_{start}'] = np.float64(stats['reg0'][i])
+            if self.bootstrapped and 'slp_boot_low' in stats:
+                for key in BOOTSTRAP_KEYS:
+                    result[key] = np.float64(stats[key][i])
+        return result
+
+    def yearly_series(self, i, start, stop, season):
+        """
+        Yearly values of one series as pandas.Series (as result['data'] of
+        compute_trend)
+        """
+        yearly, in_series, _ = self._data[(start, stop, season)]
+        if self.ts_type == 'yearly':
+            # input data of the period
+            times = self.times
+            i0 = times.searchsorted(pd.Timestamp(_start_season(season, start)))
+            i1 = times.searchsorted(pd.Timestamp(f'{stop + 1}-01-01'))
+            present = self._present[i, i0:i1]
+            name = None if self.names is None else self.names[i]
+            return pd.Series(self._values[i, i0:i1][present],
+                             index=times[i0:i1][present], name=name)
+        dates, values = [], []
+        for j, yr in enumerate(range(start, stop + 1)):
+            if in_series[i, j]:
+                dates.append(_mid_season(season, yr))
+                values.append(yearly[i, j])
+        return pd.Series(values, index=dates)
+
+    def coverage(self, i, start, stop, season):
+        """
+        Number of values each yearly value of one series was computed from
+
+        Returns
+        -------
+        pandas.Series
+            Counts for each year of the period (0 for years without data).
+        """
+        _, _, counts = self._data[(start, stop, season)]
+        return pd.Series(counts[i], index=np.arange(start, stop + 1))
+
+    def bootstrap(self, num_samples=1000, block_size=3,
+                  confidence=BOOTSTRAP_CONFIDENCE, seed=0, num_workers=None):
+        """
+        Compute moving block bootstrap intervals of the relative trends
+
+        The intervals (see block_bootstrap) are computed for all series,
+        periods and seasons with a relative trend and added to the results
+        (BOOTSTRAP_KEYS). The series are distributed over a pool of
+        processes. Results are reproducible for a given seed, independent
+        of num_workers.
+
+        Parameters
+        ----------
+        num_samples : int, optional
+            Number of bootstrap samples.
+        block_size : int, optional
+            Number of consecutive years in a block.
+        confidence : float, optional
+            Confidence of the intervals.
+        seed : int, optional
+            Seed of the random numbers.
+        num_workers : int, optional
+            Number of worker processes. None or 1 computes the intervals in
+            the current process.
+        """
+        if num_workers is None:
+            num_workers = 1
+        tasks = []
+        for (start, stop, season), stats in self.results.items():
+            yearly, in_series, _ = self._data[(start, stop, season)]
+            valid = in_series & ~np.isnan(yearly)
+            years = np.arange(start, stop + 1) - 1970.
+            key = (start, stop, self.seasons.index(season))
+            for key_name in BOOTSTRAP_KEYS:
+                stats[key_name] = np.full(len(yearly), np.nan)
+            for i in np.where(~np.isnan(stats['reg0']))[0]:
+                tasks.append((key, i, yearly[i, valid[i]], years[valid[i]],
+                              stats['reg0'][i]))
+        # chunks of series, several per worker to balance the load
+        series_ids = np.array([task[1] for task in tasks], dtype=int)
+        chunks = np.array_split(np.arange(len(self._values)),
+                                num_workers * 4)
+        chunk_tasks = [[tasks[j] for j in np.where(np.isin(series_ids, ids))[0]]
+                       for ids in chunks]
+        args = (num_samples, block_size, confidence, seed)
+        if num_workers <= 1:
+            chunk_results = [_bootstrap_tasks(chunk, *args)
+                             for chunk in chunk_tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                futures = [pool.submit(_bootstrap_tasks, chunk, *args)
+                           for chunk in chunk_tasks]
+                chunk_results = [future.result() for future in futures]
+        for chunk, results in zip(chunk_tasks, chunk_results):
+            for (key, i, _, _, _), (low, high) in zip(chunk, results):
+                start, stop, seas_idx = key
+                stats = self.results[(start, stop, self.seasons[seas_idx])]
+                stats['slp_boot_low'][i] = low
+                stats['slp_boot_high'][i] = high
+        self.bootstrapped = True
@@ -35,3 +35,18 @@ ALL_EBAS_VARS = ['concno2',
                  'vmrisop',
                  'concglyoxal'
                  ]
+
+# O3 settings shared by calc_obstrends_o3.py and calc_modtrends_o3.py
+
+# email with Sverre and David on 22 June 2021
+O3_RESAMPLE_CONSTRAINTS = dict(yearly     =   dict(daily      = 330),
+                               daily      =   dict(hourly     = 18))
+
+# O3 percentiles for daily -> yearly
+O3_PERCENTILES = [10, 50, 75, 95, 98, 99]
+
+# analysis periods and minimum no. of years required for O3 trends retrieval
+O3_PERIODS = [(2000, 2019, 14),
+              (2000, 2010, 7),
+              (2010, 2019, 7),
+              (2005, 2019, 10)]